@@ -37,6 +37,11 @@ class ParamsMissingError(MelangeError):
     message = _("Data Missing")
 
 
+class InvalidParamsError(MelangeError):
+
+    message = _("%(param)s has an invalid value %(value)s")
+
+
 class MelangeServiceResponseError(MelangeError):
 
     message = _("Error while responding to service call")
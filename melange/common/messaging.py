@@ -34,13 +34,16 @@ class Queue(object):
         self.queue_class = queue_class
 
     def __enter__(self):
-        self.connect()
-        self.queue = self.conn.SimpleQueue(self.name, no_ack=False)
-        return self
+        return self.open()
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+    def open(self):
+        self.connect()
+        self.queue = self.conn.SimpleQueue(self.name, no_ack=False)
+        return self
+
     def connect(self):
         options = queue_connection_options(self.queue_class)
         LOG.info("Connecting to message queue.")
@@ -0,0 +1,303 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""In-process registry of counters, gauges and histograms.
+
+Pre-forked server processes each have their own registry. When metrics_dir
+is set, every process periodically writes a snapshot of its registry to a
+file named after its pid in that directory, and collect() adds up the
+snapshots of all processes, so whichever worker answers a metrics request
+reports the whole server.
+
+"""
+
+import bisect
+import eventlet
+import glob
+import json
+import logging
+import os
+import re
+
+from melange.common import config
+
+
+LOG = logging.getLogger('melange.common.metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_COUNTERS = {}
+_GAUGES = {}
+_HISTOGRAMS = {}
+
+
+def increment(name, value=1):
+    _COUNTERS[name] = _COUNTERS.get(name, 0) + value
+
+
+def register_gauge(name, func):
+    """Registers a callable that is sampled whenever metrics are read.
+
+    The callable may return a number or a dict of numbers, in which case
+    every key is reported as '<name>.<key>'.
+
+    """
+    _GAUGES[name] = func
+
+
+def unregister_gauge(name):
+    _GAUGES.pop(name, None)
+
+
+def counters():
+    return _COUNTERS.copy()
+
+
+def gauges():
+    values = {}
+    for name, func in _GAUGES.items():
+        try:
+            value = func()
+        except Exception:
+            LOG.exception("Failed to read gauge %s" % name)
+            continue
+        if isinstance(value, dict):
+            for key, sub_value in value.iteritems():
+                values["%s.%s" % (name, key)] = sub_value
+        else:
+            values[name] = value
+    return values
+
+
+class Histogram(object):
+    """Counts observations in buckets given by their upper bounds.
+
+    counts has one entry per bucket, not cumulative, plus a last one for
+    observations above the largest bound.
+
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, counts=None, total=0.0):
+        self.buckets = tuple(buckets)
+        self.counts = counts or [0] * (len(self.buckets) + 1)
+        self.sum = total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, other):
+        if other.buckets != self.buckets:
+            raise ValueError(_("Cannot merge histograms with different "
+                               "buckets"))
+        self.counts = [mine + theirs
+                       for mine, theirs in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def data(self):
+        return dict(buckets=list(self.buckets),
+                    counts=list(self.counts),
+                    sum=self.sum)
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data['buckets'], list(data['counts']), data['sum'])
+
+
+def observe(name, value, **labels):
+    """Records value, typically a duration in seconds, in a histogram.
+
+    Observations with different label values go to separate histograms.
+
+    """
+    key = (name, tuple(sorted(labels.items())))
+    histogram = _HISTOGRAMS.get(key)
+    if histogram is None:
+        histogram = _HISTOGRAMS[key] = Histogram()
+    histogram.observe(value)
+
+
+def histograms():
+    return [dict(name=name, labels=dict(labels), **histogram.data())
+            for (name, labels), histogram in sorted(_HISTOGRAMS.items())]
+
+
+def snapshot():
+    return {'counters': counters(),
+            'gauges': gauges(),
+            'histograms': histograms()}
+
+
+def reset():
+    """Forgets all counters, histograms and registered gauges."""
+    _COUNTERS.clear()
+    _GAUGES.clear()
+    _HISTOGRAMS.clear()
+
+
+def write_snapshot(directory):
+    """Writes this process's snapshot to <directory>/<pid>.json."""
+    path = os.path.join(directory, "%d.json" % os.getpid())
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as snapshot_file:
+        json.dump(snapshot(), snapshot_file)
+    os.rename(temp_path, path)
+
+
+def aggregate(directory):
+    """Adds up the snapshots of all processes written to directory.
+
+    Counters and histograms of processes that have exited are kept, as the
+    requests they counted were served, but their gauges are dropped.
+
+    """
+    write_snapshot(directory)
+    counter_totals = {}
+    gauge_totals = {}
+    histogram_totals = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path) as snapshot_file:
+                process_snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            LOG.exception("Could not read metrics snapshot %s" % path)
+            continue
+        for name, value in process_snapshot['counters'].iteritems():
+            counter_totals[name] = counter_totals.get(name, 0) + value
+        if _is_alive(path):
+            for name, value in process_snapshot['gauges'].iteritems():
+                gauge_totals[name] = gauge_totals.get(name, 0) + value
+        for data in process_snapshot['histograms']:
+            key = (data['name'], tuple(sorted(data['labels'].items())))
+            histogram = Histogram.from_data(data)
+            if key in histogram_totals:
+                histogram_totals[key].merge(histogram)
+            else:
+                histogram_totals[key] = histogram
+    return {'counters': counter_totals,
+            'gauges': gauge_totals,
+            'histograms': [dict(name=name, labels=dict(labels),
+                                **histogram.data())
+                           for (name, labels), histogram
+                           in sorted(histogram_totals.items())]}
+
+
+def clear_snapshots(directory):
+    """Removes the snapshots of a previous run of the server."""
+    for path in glob.glob(os.path.join(directory, "*.json*")):
+        os.remove(path)
+
+
+def collect():
+    """Returns a snapshot of all server processes, or just this one."""
+    directory = config.Config.get('metrics_dir', None)
+    if directory:
+        return aggregate(directory)
+    return snapshot()
+
+
+def exposition(metrics_snapshot):
+    """Formats a snapshot in the prometheus text exposition format."""
+    lines = []
+    for name, value in sorted(metrics_snapshot['counters'].items()):
+        metric = _metric_name(name) + "_total"
+        lines.append("# TYPE %s counter" % metric)
+        lines.append("%s %s" % (metric, _number(value)))
+    for name, value in sorted(metrics_snapshot['gauges'].items()):
+        metric = _metric_name(name)
+        lines.append("# TYPE %s gauge" % metric)
+        lines.append("%s %s" % (metric, _number(value)))
+    typed = set()
+    for data in metrics_snapshot['histograms']:
+        metric = _metric_name(data['name'])
+        if metric not in typed:
+            lines.append("# TYPE %s histogram" % metric)
+            typed.add(metric)
+        labels = sorted(data['labels'].items())
+        cumulative = 0
+        bounds = [_number(bound) for bound in data['buckets']] + ["+Inf"]
+        for bound, count in zip(bounds, data['counts']):
+            cumulative += count
+            lines.append("%s_bucket%s %d"
+                         % (metric, _labels(labels + [("le", bound)]),
+                            cumulative))
+        lines.append("%s_sum%s %s" % (metric, _labels(labels),
+                                      _number(data['sum'])))
+        lines.append("%s_count%s %d" % (metric, _labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
+
+
+class SnapshotWriter(object):
+    """Writes this process's snapshot to directory every interval seconds."""
+
+    def __init__(self, directory, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        self._thread = eventlet.spawn(self._write_forever)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        self.write()
+
+    def write(self):
+        try:
+            write_snapshot(self.directory)
+        except Exception:
+            LOG.exception("Could not write metrics snapshot")
+
+    def _write_forever(self):
+        while True:
+            self.write()
+            eventlet.sleep(self.interval)
+
+
+def _is_alive(path):
+    try:
+        os.kill(int(os.path.basename(path).split(".")[0]), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def _metric_name(name):
+    return "melange_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in labels)
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -15,15 +15,30 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import eventlet
+from eventlet import corolocal
+import eventlet.queue
+import json
 import logging
 import socket
+import time
 
+from melange import db
 from melange.common import config
 from melange.common import exception
 from melange.common import messaging
 from melange.common import utils
 
 
+LOG = logging.getLogger('melange.common.notifier')
+
+_HOSTNAME = None
+_ASYNC_NOTIFIER = None
+_BATCH = corolocal.local()
+
+
 class Notifier(object):
 
     def error(self, event_type, payload):
@@ -36,13 +51,17 @@ class Notifier(object):
         self._send_message("info", event_type, payload)
 
     def _send_message(self, level, event_type, payload):
+        pending = getattr(_BATCH, 'pending', None)
+        if pending is not None:
+            pending.setdefault((level, event_type), []).append(payload)
+            return
         msg = self._generate_message(event_type, level, payload)
         self.notify(level, msg)
 
     def _generate_message(self, event_type, priority, payload):
         return {
             "message_id": str(utils.generate_uuid()),
-            "publisher_id": socket.gethostname(),
+            "publisher_id": _hostname(),
             "event_type": event_type,
             "priority": priority,
             "payload": payload,
@@ -52,6 +71,13 @@ class Notifier(object):
     def notify(self, level, msg):
         pass
 
+    def notify_batch(self, messages):
+        for level, msg in messages:
+            self.notify(level, msg)
+
+    def close(self):
+        pass
+
 
 class NoopNotifier(Notifier):
 
@@ -69,23 +95,307 @@ class LoggingNotifier(Notifier):
 
 class QueueNotifier(Notifier):
 
-    def notify(self, level, msg):
-        topic = "%s.%s" % ("melange.notifier", level.upper())
+    def __init__(self):
+        self._queues = {}
 
-        with messaging.Queue(topic, "notifier") as queue:
+    def notify(self, level, msg):
+        with messaging.Queue(self._topic(level), "notifier") as queue:
             queue.put(msg)
 
+    def notify_batch(self, messages):
+        """Publishes over connections that stay open between batches."""
+        try:
+            for level, msg in messages:
+                self._open_queue(level).put(msg)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        for queue in self._queues.values():
+            queue.close()
+        self._queues.clear()
+
+    def _open_queue(self, level):
+        topic = self._topic(level)
+        if topic not in self._queues:
+            self._queues[topic] = messaging.Queue(topic, "notifier").open()
+        return self._queues[topic]
+
+    def _topic(self, level):
+        return "%s.%s" % ("melange.notifier", level.upper())
+
+
+class OutboxNotifier(Notifier):
+    """Stores messages in the notification_outbox table for OutboxRelay.
+
+    Within transaction() a message is written in the same database
+    transaction as the change it describes, so it is stored exactly when
+    the change is and publishing never slows the change down.
+
+    """
+
+    def notify(self, level, msg):
+        db.db_api.save_outbox_message(level, json.dumps(msg, default=str))
+
+
+class OutboxRelay(object):
+    """Publishes the outbox through another notifier from a green thread.
+
+    Messages are deleted from the outbox only once the delegate has
+    published them, so each is delivered at least once.
+
+    """
+
+    def __init__(self, delegate, batch_size=100, interval=1.0):
+        self.delegate = delegate
+        self.batch_size = batch_size
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        self._thread = eventlet.spawn(self._relay_forever)
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        self.delegate.close()
+
+    def relay(self):
+        """Publishes batches until the outbox is empty."""
+        relayed = 0
+        while True:
+            count = db.db_api.relay_outbox_messages(self._publish,
+                                                    self.batch_size)
+            relayed += count
+            if count < self.batch_size:
+                return relayed
+
+    def _publish(self, rows):
+        self.delegate.notify_batch([(level, json.loads(message))
+                                    for level, message in rows])
+
+    def _relay_forever(self):
+        while True:
+            try:
+                self.relay()
+            except Exception:
+                LOG.exception("Could not relay notifications")
+            eventlet.sleep(self.interval)
+
+
+class AsyncNotifier(Notifier):
+    """Publishes messages through another notifier from a green thread.
+
+    Sending a message only appends it to a buffer of buffer_size messages.
+    The publisher thread sends the buffer to the delegate in batches of up
+    to batch_size messages, waiting at most flush_interval seconds for a
+    batch to fill. When the buffer is full, overflow decides whether the
+    new message is dropped (drop_newest), the oldest buffered message is
+    dropped (drop_oldest) or the sender waits for room (block).
+
+    """
+
+    OVERFLOW_POLICIES = ["drop_newest", "drop_oldest", "block"]
+    _STOP = object()
+
+    def __init__(self, delegate, buffer_size=10000, batch_size=100,
+                 flush_interval=1.0, overflow="drop_oldest"):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise exception.InvalidNotifier(
+                _("notifier overflow policy %s is not one of %s")
+                % (overflow, ", ".join(self.OVERFLOW_POLICIES)))
+        self.delegate = delegate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.dropped = 0
+        self._buffer = eventlet.queue.LightQueue(buffer_size)
+        self._publisher = None
+        self._stopping = False
+
+    def notify(self, level, msg):
+        if self._publisher is None:
+            self._publisher = eventlet.spawn(self._publish_forever)
+        if self.overflow == "block":
+            self._buffer.put((level, msg))
+            return
+        try:
+            self._buffer.put_nowait((level, msg))
+        except eventlet.queue.Full:
+            if self.overflow == "drop_oldest":
+                self._buffer.get_nowait()
+                self._buffer.put_nowait((level, msg))
+            self._dropped(1)
+
+    def flush(self):
+        """Publishes everything buffered so far from the calling thread."""
+        while self._buffer.qsize():
+            self._publish(self._take(self.batch_size))
+
+    def drain(self):
+        """Stops the publisher thread and publishes what is left."""
+        if self._publisher is not None:
+            # NOTE: the publisher is asked to stop rather than killed, so
+            # it first publishes the batch it has already taken.
+            self._stopping = True
+            try:
+                self._buffer.put_nowait(self._STOP)
+            except eventlet.queue.Full:
+                pass
+            self._publisher.wait()
+            self._publisher = None
+            self._stopping = False
+        self.flush()
+        self.delegate.close()
+
+    def _publish_forever(self):
+        while not self._stopping:
+            message = self._buffer.get()
+            if message is self._STOP:
+                return
+            batch = [message]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = (0 if self._stopping
+                           else max(deadline - time.time(), 0))
+                try:
+                    message = self._buffer.get(timeout=timeout)
+                except eventlet.queue.Empty:
+                    break
+                if message is self._STOP:
+                    break
+                batch.append(message)
+            self._publish(batch)
+
+    def _take(self, count):
+        batch = []
+        while len(batch) < count and self._buffer.qsize():
+            message = self._buffer.get_nowait()
+            if message is not self._STOP:
+                batch.append(message)
+        return batch
+
+    def _publish(self, batch):
+        for attempt in range(2):
+            try:
+                self.delegate.notify_batch(batch)
+                return
+            except Exception:
+                LOG.exception("Could not publish %d notifications"
+                              % len(batch))
+        self._dropped(len(batch))
+
+    def _dropped(self, count):
+        # NOTE: warns on the first loss and then once per thousand lost
+        # messages, so a stalled broker does not flood the logs.
+        previous = self.dropped
+        self.dropped += count
+        if previous == 0 or previous // 1000 != self.dropped // 1000:
+            LOG.warn("Dropped %d notifications so far" % self.dropped)
+
 
 def notifier():
+    notifier_class = _strategy(config.Config.get("notifier", "noop"))
+    if not utils.bool_from_string(config.Config.get("notifier_async",
+                                                    "false")):
+        return notifier_class()
+    return _async_notifier(notifier_class)
+
+
+@contextlib.contextmanager
+def batch():
+    """Coalesces the notifications sent in the block, if configured to.
+
+    With notifier_batch_events set, the messages sent in the block are held
+    back and, when it ends, sent grouped by priority and event type as
+    messages of event type "<event type> batch", whose payload is a list of
+    up to notifier_batch_event_size of the original payloads. Otherwise, and
+    in a batch() nested in another, messages are sent one by one as usual.
+
+    """
+    batch_events = utils.bool_from_string(
+        config.Config.get("notifier_batch_events", "false"))
+    if not batch_events or getattr(_BATCH, 'pending', None) is not None:
+        yield
+        return
+
+    _BATCH.pending = collections.OrderedDict()
+    try:
+        yield
+    finally:
+        pending, _BATCH.pending = _BATCH.pending, None
+        _send_batches(pending)
+
+
+def _send_batches(pending):
+    size = int(config.Config.get("notifier_batch_event_size", 1000))
+    for (level, event_type), payloads in pending.iteritems():
+        for rows in utils.chunks(payloads, size):
+            getattr(notifier(), level)("%s batch" % event_type, rows)
 
-    STRATEGIES = {
+
+def transaction():
+    """Context for a model change and the notifications it sends.
+
+    With the outbox notifier both are written in one database transaction.
+
+    """
+    if config.Config.get("notifier", "noop") == "outbox":
+        return db.db_api.transaction()
+    return _no_transaction()
+
+
+def outbox_relay():
+    relay_class = _strategy(config.Config.get("notifier_relay", "queue"))
+    return OutboxRelay(
+        relay_class(),
+        batch_size=int(config.Config.get("notifier_batch_size", 100)),
+        interval=float(config.Config.get("notifier_flush_interval", 1.0)))
+
+
+def drain():
+    """Publishes buffered notifications, for use when a process exits."""
+    if _ASYNC_NOTIFIER is not None:
+        _ASYNC_NOTIFIER.drain()
+
+
+def _async_notifier(notifier_class):
+    global _ASYNC_NOTIFIER
+    if (_ASYNC_NOTIFIER is None
+            or type(_ASYNC_NOTIFIER.delegate) is not notifier_class):
+        drain()
+        _ASYNC_NOTIFIER = AsyncNotifier(
+            notifier_class(),
+            buffer_size=int(config.Config.get("notifier_buffer_size", 10000)),
+            batch_size=int(config.Config.get("notifier_batch_size", 100)),
+            flush_interval=float(config.Config.get("notifier_flush_interval",
+                                                   1.0)),
+            overflow=config.Config.get("notifier_overflow", "drop_oldest"))
+    return _ASYNC_NOTIFIER
+
+
+def _strategy(name):
+    strategies = {
         "logging": LoggingNotifier,
         "queue": QueueNotifier,
         "noop": NoopNotifier,
+        "outbox": OutboxNotifier,
     }
-
-    strategy = config.Config.get("notifier", "noop")
     try:
-        return STRATEGIES[strategy]()
+        return strategies[name]
     except KeyError:
-        raise exception.InvalidNotifier(notifier=strategy)
+        raise exception.InvalidNotifier(notifier=name)
+
+
+@contextlib.contextmanager
+def _no_transaction():
+    yield
+
+
+def _hostname():
+    global _HOSTNAME
+    if _HOSTNAME is None:
+        _HOSTNAME = socket.gethostname()
+    return _HOSTNAME
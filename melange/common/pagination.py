@@ -15,9 +15,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+import types
 import urllib
 import urlparse
-from xml.dom import minidom
+
+from melange.common import utils
 
 
 class AtomLink(object):
@@ -26,23 +29,32 @@ class AtomLink(object):
         self.rel = rel
         self.href = href
 
-    def to_xml(self):
-        ATOM_NAMESPACE = "http://www.w3.org/2005/Atom"
-        doc = minidom.Document()
-        atom_elem = doc.createElementNS(ATOM_NAMESPACE, "link")
-        atom_elem.setAttribute("rel", self.rel)
-        atom_elem.setAttribute("href", self.href)
-        return atom_elem
+    def to_xml(self, indent=""):
+        return "%s%s\n" % (indent,
+                            utils.xml_tag("link",
+                                          dict(rel=self.rel, href=self.href),
+                                          empty=True))
 
 
 class PaginatedDataView(object):
+    """Collection data with a link to the next page.
+
+    With streaming, or when collection is a generator, the response is
+    written element by element. A generator produces each element's data
+    only as the response is written, after the request has returned, so
+    an error it raises can only cut the response short.
+
+    """
 
     def __init__(self, collection_type, collection, current_page_url,
-                 next_page_marker=None):
+                 next_page_marker=None, streaming=None):
         self.collection_type = collection_type
         self.collection = collection
         self.current_page_url = current_page_url
         self.next_page_marker = next_page_marker
+        if streaming is None:
+            streaming = isinstance(collection, types.GeneratorType)
+        self.streaming = streaming
 
     def data_for_json(self):
         json_dict = {self.collection_type: self.collection}
@@ -54,7 +66,8 @@ class PaginatedDataView(object):
     def data_for_xml(self):
         atom_links = [AtomLink(link['rel'], link['href'])
                       for link in self._links()]
-        return {self.collection_type: self.collection + atom_links}
+        return {self.collection_type: itertools.chain(self.collection,
+                                                      atom_links)}
 
     def _create_link(self, marker):
         app_url = AppUrl(self.current_page_url)
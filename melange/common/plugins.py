@@ -0,0 +1,85 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Per process registry of pluggable generators."""
+
+import imp
+import logging
+import os
+import pkg_resources
+import re
+import sys
+
+from melange.common import utils
+
+
+LOG = logging.getLogger('melange.common.plugins')
+
+_REGISTRY = {}
+_LOADERS = []
+
+
+def load(group, spec):
+    """Returns the module or class named by spec, importing it only once.
+
+    spec may be the path of a python file, the name of an entry point in the
+    given setuptools entry point group, or a dotted module or class path.
+    Results are cached by (group, spec), so changing the configured spec
+    loads the new plugin while repeated lookups cost a dict access.
+
+    """
+    key = (group, spec)
+    if key not in _REGISTRY:
+        _REGISTRY[key] = _load(group, spec)
+    return _REGISTRY[key]
+
+
+def reset(group=None):
+    for key in _REGISTRY.keys():
+        if group is None or key[0] == group:
+            del _REGISTRY[key]
+
+
+def loader(func):
+    """Registers a function that loads a configured plugin, for warm()."""
+    _LOADERS.append(func)
+    return func
+
+
+def warm():
+    """Loads every configured plugin, so no request pays for imports."""
+    for func in _LOADERS:
+        func()
+
+
+def _load(group, spec):
+    LOG.debug("Loading %s plugin %s" % (group, spec))
+    if spec.endswith(".py") or os.sep in spec:
+        return _load_source(spec)
+
+    for entry_point in pkg_resources.iter_entry_points(group, spec):
+        return entry_point.load()
+
+    return utils.import_object(spec)
+
+
+def _load_source(path):
+    path = os.path.abspath(path)
+    module_name = "melange_plugin_%s" % re.sub(r"\W", "_", path)
+    if module_name not in sys.modules:
+        imp.load_source(module_name, path)
+    return sys.modules[module_name]
@@ -0,0 +1,152 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Sampling profiler for live server processes.
+
+A SIGPROF interval timer interrupts the process every interval seconds of
+cpu time and the handler records the stack of whichever green thread is
+running, so time spent in the hub, in requests and in background jobs is
+all sampled without tracing every call. Samples are reported as collapsed
+stacks, one 'frame;frame;... count' line per distinct stack, the input
+format of flame graph tools.
+
+"""
+
+import collections
+import contextlib
+import eventlet
+import eventlet.greenthread
+import logging
+import os
+import re
+import signal
+import time
+
+from melange.common import exception
+
+
+LOG = logging.getLogger('melange.common.profiler')
+
+_ACTIVE = None
+
+
+class SamplingProfiler(object):
+    """Samples stacks while running, optionally only of some requests.
+
+    With route, a regular expression, only green threads serving requests
+    whose path matches it are sampled.
+
+    """
+
+    def __init__(self, interval=0.005, route=None):
+        self.interval = interval
+        self.route = re.compile(route) if route else None
+        self.samples = collections.defaultdict(int)
+        self._greenlets = set()
+        self._previous_handler = None
+
+    def start(self):
+        global _ACTIVE
+        if _ACTIVE is not None:
+            raise ProfilerBusyError()
+        _ACTIVE = self
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        global _ACTIVE
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        _ACTIVE = None
+
+    def profile(self, seconds):
+        """Samples for seconds of wall time and returns collapsed stacks."""
+        self.start()
+        try:
+            eventlet.sleep(seconds)
+        finally:
+            self.stop()
+        return self.collapsed()
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count)
+                       for stack, count in sorted(self.samples.items()))
+
+    def watch(self, path):
+        if self.route is not None and self.route.search(path):
+            self._greenlets.add(eventlet.greenthread.getcurrent())
+
+    def unwatch(self):
+        self._greenlets.discard(eventlet.greenthread.getcurrent())
+
+    def _sample(self, signum, frame):
+        if (self.route is not None and
+                eventlet.greenthread.getcurrent() not in self._greenlets):
+            return
+        self.samples[_collapse(frame)] += 1
+
+
+@contextlib.contextmanager
+def request(path):
+    """Marks the current green thread as serving a request for path."""
+    profiler = _ACTIVE
+    if profiler is None:
+        yield
+        return
+    profiler.watch(path)
+    try:
+        yield
+    finally:
+        profiler.unwatch()
+
+
+def install_signal_handler(seconds, directory, signum=signal.SIGUSR2):
+    """Profiles for seconds whenever the process receives signum.
+
+    The collapsed stacks are written to
+    <directory>/melange-<pid>-<timestamp>.collapsed.
+
+    """
+    def profile_to_file():
+        path = os.path.join(directory, "melange-%d-%d.collapsed"
+                            % (os.getpid(), time.time()))
+        try:
+            stacks = SamplingProfiler().profile(seconds)
+        except ProfilerBusyError:
+            LOG.warn("Not profiling, a profile is already running")
+            return
+        with open(path, "w") as profile_file:
+            profile_file.write(stacks)
+        LOG.info("Wrote profile to %s" % path)
+
+    signal.signal(signum, lambda signum, frame: eventlet.spawn_n(
+        profile_to_file))
+
+
+def _collapse(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s:%s" % (code.co_filename, code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(frames))
+
+
+class ProfilerBusyError(exception.MelangeError):
+
+    message = _("A profile is already running")
@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Records api traffic to a file, for replaying against test deployments."""
+
+import json
+import logging
+import logging.handlers
+import os
+import random
+import re
+import time
+import webob.dec
+
+from melange.common import utils
+from melange.common import wsgi
+
+
+LOG = logging.getLogger('melange.common.recording')
+
+_HANDLERS = {}
+
+
+class RecordingMiddleware(wsgi.Middleware):
+    """Appends a sample of requests to a rotating newline delimited json file.
+
+    Each line holds the request's start time, method, path, tenant, a few
+    headers, its json body with the values of redact_keys masked, and the
+    response status and duration. path may contain {pid} so that each
+    server process writes its own file.
+
+    """
+
+    RECORDED_HEADERS = ['Accept', 'Content-Type', 'X-Role', 'X-Tenant']
+    MAX_BODY_LENGTH = 65536
+    tenant_in_path = re.compile(r"/tenants/(?P<tenant_id>[^/]+)")
+
+    def __init__(self, application, path, sample_rate=1.0,
+                 max_bytes=104857600, backup_count=5,
+                 redact_keys=("password", "secret", "token")):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.redact_keys = set(redact_keys)
+        super(RecordingMiddleware, self).__init__(application)
+
+    @webob.dec.wsgify
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return request.get_response(self.application)
+
+        body = self._body(request)
+        started_at = time.time()
+        response = request.get_response(self.application)
+        duration = time.time() - started_at
+        try:
+            self._write(dict(time=started_at,
+                             method=request.method,
+                             path=request.path_qs,
+                             tenant=self._tenant(request),
+                             headers=dict((name, request.headers[name])
+                                          for name in self.RECORDED_HEADERS
+                                          if name in request.headers),
+                             body=body,
+                             status=response.status_int,
+                             duration_ms=duration * 1000))
+        except Exception:
+            LOG.exception("Could not record request")
+        return response
+
+    def _body(self, request):
+        if (not request.content_length or
+                request.content_length > self.MAX_BODY_LENGTH or
+                request.content_type != "application/json"):
+            return None
+        request.make_body_seekable()
+        try:
+            return self._redact(json.loads(request.body))
+        except ValueError:
+            return None
+
+    def _redact(self, data):
+        if isinstance(data, dict):
+            return dict((key, "***" if key in self.redact_keys
+                         else self._redact(value))
+                        for key, value in data.iteritems())
+        if isinstance(data, list):
+            return [self._redact(item) for item in data]
+        return data
+
+    def _tenant(self, request):
+        tenant_id = request.headers.get('X-Tenant')
+        if tenant_id:
+            return tenant_id
+        match = self.tenant_in_path.search(request.path_info)
+        return match.group('tenant_id') if match else None
+
+    def _write(self, record):
+        path = self.path.format(pid=os.getpid())
+        handler = _HANDLERS.get(path)
+        if handler is None:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=self.max_bytes, backupCount=self.backup_count)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _HANDLERS[path] = handler
+        handler.handle(logging.makeLogRecord(dict(msg=json.dumps(record))))
+
+
+def factory(global_config, **local_config):
+    """Paste filter factory, leaving the pipeline as is unless enabled."""
+    options = dict(global_config, **local_config)
+
+    def _factory(app):
+        if not utils.bool_from_string(options.get('record_traffic',
+                                                  'false')):
+            return app
+        return RecordingMiddleware(
+            app,
+            options.get('record_file', "melange-traffic-{pid}.ndjson"),
+            sample_rate=float(options.get('record_sample_rate', 1.0)),
+            max_bytes=int(options.get('record_max_bytes', 104857600)),
+            backup_count=int(options.get('record_backup_count', 5)),
+            redact_keys=[key.strip() for key in options.get(
+                'record_redact_keys', "password,secret,token").split(",")])
+    return _factory
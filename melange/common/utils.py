@@ -17,13 +17,17 @@
 
 """System-level utilities and helper functions."""
 
+import calendar
 import datetime
 import inspect
+import os
 import re
 import uuid
+from xml.sax import saxutils
 
 from melange.openstack.common import utils as openstack_utils
 
+from melange.common import config
 from melange.common import exception
 
 
@@ -75,9 +79,47 @@ def find(predicate, items):
 
 
 def generate_uuid():
+    if config.Config.get('uuid_generator', 'random') == 'time_ordered':
+        return str(time_ordered_uuid())
     return str(uuid.uuid4())
 
 
+def time_ordered_uuid():
+    """Generates a UUID that sorts by creation time, laid out like UUIDv7.
+
+    The first 48 bits are the unix time in milliseconds, which keeps new
+    rows together at the end of an index on the id. The remaining bits are
+    random, taken from os.urandom so forked processes do not share them.
+
+    """
+    now = utcnow()
+    millis = (calendar.timegm(now.utctimetuple()) * 1000
+              + now.microsecond // 1000)
+    random_bits = int(os.urandom(10).encode('hex'), 16)
+    value = ((millis & 0xffffffffffff) << 80
+             | 0x7 << 76
+             | (random_bits >> 68) << 64
+             | 0x2 << 62
+             | random_bits & ((1 << 62) - 1))
+    return uuid.UUID(int=value)
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def xml_tag(name, attributes=None, empty=False):
+    """Returns the start tag, or empty element tag, of an xml element."""
+    attributes = "".join(' %s="%s"' % (key, xml_escape(value))
+                         for key, value in sorted((attributes or {}).items()))
+    return u"<%s%s%s>" % (name, attributes, "/" if empty else "")
+
+
+def xml_escape(value):
+    return saxutils.escape(unicode(value), {'"': "&quot;"})
+
+
 def remove_nones(hash):
     return dict((key, value)
                 for key, value in hash.iteritems() if value is not None)
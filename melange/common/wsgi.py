@@ -17,19 +17,31 @@
 
 """Utility methods for working with WSGI servers."""
 
+import errno
+import eventlet
 import eventlet.wsgi
+import json
 import logging
+import os
 import paste.urlmap
 import re
+import signal
+import time
 import traceback
+import types
 import webob
 import webob.dec
 import webob.exc
+import zlib
 
 
 from melange.openstack.common import wsgi as openstack_wsgi
 
+from melange import db
+from melange.common import config
 from melange.common import exception
+from melange.common import metrics
+from melange.common import profiler
 from melange.common import utils
 
 
@@ -48,6 +60,17 @@ def versioned_urlmap(*args, **kwargs):
     return VersionedURLMap(urlmap)
 
 
+def gzip_chunks(chunks):
+    """Compresses an iterable of strings into chunks of a gzip stream."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
 class VersionedURLMap(object):
 
     def __init__(self, urlmap):
@@ -110,12 +133,115 @@ class Request(openstack_wsgi.Request):
         return match.group("version_no") if match else None
 
 
+class MultiProcessServer(object):
+    """Pre-fork server that shares one listening socket between workers.
+
+    The parent binds the socket, forks the workers and restarts any worker
+    that exits until it is asked to stop with SIGTERM or SIGINT. Each worker
+    calls on_fork before serving, which is where per process resources such
+    as database engines have to be created, and on_exit once it has been
+    asked to stop.
+
+    """
+
+    def __init__(self, workers, threads=1000, on_fork=None, on_exit=None):
+        self.workers = workers
+        self.threads = threads
+        self.on_fork = on_fork
+        self.on_exit = on_exit
+        self.children = {}
+        self.running = False
+
+    def start(self, application, port, host='0.0.0.0', backlog=128):
+        self.application = application
+        self.socket = eventlet.listen((host, port), backlog=backlog)
+        self.running = True
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        for i in range(self.workers):
+            self._spawn_worker()
+
+    def wait(self):
+        while self.running:
+            self._wait_for_worker()
+        self._stop_workers()
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            self._run_worker()
+        LOG.info("Started worker %s" % pid)
+        self.children[pid] = time.time()
+        return pid
+
+    def _run_worker(self):
+        # NOTE: Server.wait returns on KeyboardInterrupt, which
+        # default_int_handler raises, so that on_exit gets to run.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        status = 0
+        try:
+            if self.on_fork:
+                self.on_fork()
+            server = Server(self.threads)
+            server.pool.spawn_n(server._run, self.application, self.socket)
+            server.wait()
+            if self.on_exit:
+                self.on_exit()
+        except Exception:
+            LOG.exception("Worker %s failed" % os.getpid())
+            status = 1
+        os._exit(status)
+
+    def _wait_for_worker(self):
+        try:
+            pid, status = os.wait()
+        except OSError as error:
+            if error.errno not in (errno.EINTR, errno.ECHILD):
+                raise
+            return
+        started_at = self.children.pop(pid, None)
+        if started_at is None or not self.running:
+            return
+        LOG.warn("Worker %s exited with status %s, restarting it"
+                 % (pid, status))
+        if time.time() - started_at < 1:
+            # NOTE: keeps a worker that dies on startup from fork bombing.
+            time.sleep(1)
+        self._spawn_worker()
+
+    def _handle_stop(self, signum, frame):
+        self.running = False
+
+    def _stop_workers(self):
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    break
+                if error.errno != errno.EINTR:
+                    raise
+                continue
+            self.children.pop(pid, None)
+
+
 class Result(object):
 
     def __init__(self, data, status=200):
         self._data = data
         self.status = status
 
+    @property
+    def streaming(self):
+        return getattr(self._data, "streaming", False)
+
     def data(self, serialization_type):
         if (serialization_type == "application/xml" and
                 hasattr(self._data, "data_for_xml")):
@@ -135,11 +261,22 @@ class Resource(openstack_wsgi.Resource):
 
     @webob.dec.wsgify(RequestClass=Request)
     def __call__(self, request):
-        return super(Resource, self).__call__(request)
+        with profiler.request(request.path):
+            return super(Resource, self).__call__(request)
 
     def execute_action(self, action, request, **action_args):
         if getattr(self.controller, action, None) is None:
             return Fault(webob.exc.HTTPNotFound())
+        started_at = time.time()
+        result = self._execute_action(action, request, **action_args)
+        metrics.observe("api.request_seconds",
+                        time.time() - started_at,
+                        controller=self.controller.__class__.__name__,
+                        action=action,
+                        status=str(self._status(result)))
+        return result
+
+    def _execute_action(self, action, request, **action_args):
         try:
             result = super(Resource, self).execute_action(action,
                                                           request,
@@ -150,6 +287,8 @@ class Resource(openstack_wsgi.Resource):
 
         except exception.MelangeError as melange_error:
             LOG.debug(traceback.format_exc())
+            metrics.increment("api.errors.%s"
+                              % melange_error.__class__.__name__)
             httpError = self._get_http_error(melange_error)
             return Fault(httpError(str(melange_error), request=request))
         except webob.exc.HTTPError as http_error:
@@ -160,6 +299,13 @@ class Resource(openstack_wsgi.Resource):
             return Fault(webob.exc.HTTPInternalServerError(str(error),
                                                            request=request))
 
+    def _status(self, result):
+        if isinstance(result, Fault):
+            return result.wrapped_exc.status_int
+        if isinstance(result, Result):
+            return result.status
+        return getattr(result, 'status_int', 200)
+
     def _get_http_error(self, error):
         return self.model_exception_map.get(type(error),
                                             webob.exc.HTTPBadRequest)
@@ -183,30 +329,119 @@ class Controller(object):
     """Base controller that creates a Resource with default serializers."""
 
     exception_map = {}
+    resource_class = Resource
 
     def create_resource(self):
         serializer = MelangeResponseSerializer(
-            body_serializers={'application/xml': MelangeXMLDictSerializer()})
-        return Resource(self,
-                        openstack_wsgi.RequestDeserializer(),
-                        serializer,
-                        self.exception_map)
+            body_serializers={'application/json': MelangeJSONDictSerializer(),
+                              'application/xml': MelangeXMLDictSerializer()})
+        return self.resource_class(self,
+                                   openstack_wsgi.RequestDeserializer(),
+                                   serializer,
+                                   self.exception_map)
+
+    def _number_param(self, params, name, default, convert=float,
+                      positive=False):
+        """Parses ?name, which must be at least 0, or above it if positive."""
+        value = params.get(name, default)
+        try:
+            number = convert(value)
+        except (TypeError, ValueError):
+            raise exception.InvalidParamsError(param=name, value=value)
+        if number < 0 or (positive and number == 0):
+            raise exception.InvalidParamsError(param=name, value=value)
+        return number
+
+
+class MelangeJSONDictSerializer(openstack_wsgi.JSONDictSerializer):
+
+    def stream(self, data):
+        """Yields json chunks, one per element of any list or generator."""
+        if isinstance(data, dict):
+            yield "{"
+            for index, (key, value) in enumerate(data.items()):
+                yield "%s%s: " % (", " if index else "", json.dumps(key))
+                for chunk in self.stream(value):
+                    yield chunk
+            yield "}"
+        elif isinstance(data, (list, types.GeneratorType)):
+            yield "["
+            for index, item in enumerate(data):
+                yield "%s%s" % (", " if index else "", self.default(item))
+            yield "]"
+        else:
+            yield self.default(data)
 
 
 class MelangeXMLDictSerializer(openstack_wsgi.XMLDictSerializer):
+    """Writes indented xml incrementally instead of through minidom.
+
+    Objects with a to_xml method write themselves, given the indent.
+
+    """
 
-    def _to_xml_node(self, doc, metadata, nodename, data):
+    INDENT = "    "
+
+    def default(self, data):
+        return "".join(self.stream(data))
+
+    def stream(self, data):
+        # We expect data to contain a single key which is the XML root.
+        root_key = data.keys()[0]
+        attributes = dict(xmlns=self.xmlns) if self.xmlns else {}
+        for chunk in self._xml_chunks(self.metadata, root_key,
+                                      data[root_key], "", attributes):
+            yield chunk.encode('utf-8')
+
+    def _xml_chunks(self, metadata, nodename, data, indent, attributes):
         if hasattr(data, "to_xml"):
-            return data.to_xml()
-        return super(MelangeXMLDictSerializer, self)._to_xml_node(doc,
-                                                                  metadata,
-                                                                  nodename,
-                                                                  data)
+            yield data.to_xml(indent)
+            return
+        if metadata.get('xmlns'):
+            attributes['xmlns'] = metadata['xmlns']
+        if isinstance(data, dict):
+            attribute_keys = metadata.get('attributes', {}).get(nodename, {})
+            attributes.update((key, value) for key, value in data.items()
+                              if key in attribute_keys)
+            children = [(key, value) for key, value in data.items()
+                        if key not in attribute_keys]
+        elif hasattr(data, "__iter__"):
+            singular = metadata.get('plurals', {}).get(nodename)
+            if singular is None:
+                singular = nodename[:-1] if nodename.endswith('s') else 'item'
+            children = ((singular, item) for item in data)
+        else:
+            yield "%s%s%s</%s>\n" % (indent,
+                                     utils.xml_tag(nodename, attributes),
+                                     utils.xml_escape(data),
+                                     nodename)
+            return
+
+        empty = True
+        for name, value in children:
+            if empty:
+                yield "%s%s\n" % (indent, utils.xml_tag(nodename, attributes))
+                empty = False
+            for chunk in self._xml_chunks(metadata, name, value,
+                                          indent + self.INDENT, {}):
+                yield chunk
+        if empty:
+            yield "%s%s\n" % (indent,
+                              utils.xml_tag(nodename, attributes, empty=True))
+        else:
+            yield "%s</%s>\n" % (indent, nodename)
 
 
 class MelangeResponseSerializer(openstack_wsgi.ResponseSerializer):
 
     def serialize_body(self, response, data, content_type, action):
+        # NOTE: a streamed body is written after the status has been sent,
+        # so an error while writing it can only cut the response short.
+        if isinstance(data, Result) and data.streaming:
+            response.headers['Content-Type'] = content_type
+            serializer = self.get_body_serializer(content_type)
+            response.app_iter = serializer.stream(data.data(content_type))
+            return
         if isinstance(data, Result):
             data = data.data(content_type)
         super(MelangeResponseSerializer, self).serialize_body(response,
@@ -222,6 +457,73 @@ class MelangeResponseSerializer(openstack_wsgi.ResponseSerializer):
             response.status = data.status
 
 
+class QueryStatsMiddleware(Middleware):
+    """Measures the database statements each request runs.
+
+    Statements, database time and rows are logged per request and added up
+    in metrics per controller action. With sql_stats_headers they are also
+    returned in X-Melange-SQL-* response headers. A request running more
+    than sql_query_budget statements is logged as a warning or, with
+    sql_query_budget_action = fail, answered with a 500 instead, so that
+    tests catch N+1 regressions.
+
+    """
+
+    @webob.dec.wsgify(RequestClass=Request)
+    def __call__(self, request):
+        with db.db_api.statement_stats() as stats:
+            response = request.get_response(self.application)
+
+        action = routed_action(request.environ)
+        LOG.debug("sql_stats action=%s statements=%d time_ms=%.1f rows=%d"
+                  % (action, stats.statements, stats.seconds * 1000,
+                     stats.rows))
+        metrics.increment("sql.%s.requests" % action)
+        metrics.increment("sql.%s.statements" % action, stats.statements)
+        metrics.increment("sql.%s.seconds" % action, stats.seconds)
+        metrics.increment("sql.%s.rows" % action, stats.rows)
+
+        budget = int(config.Config.get('sql_query_budget', 0))
+        if budget and stats.statements > budget:
+            message = (_("%(action)s ran %(statements)d statements, over "
+                         "the budget of %(budget)d")
+                       % dict(action=action,
+                              statements=stats.statements,
+                              budget=budget))
+            LOG.warn(message)
+            metrics.increment("sql.%s.over_budget" % action)
+            if config.Config.get('sql_query_budget_action', 'warn') == 'fail':
+                return Fault(webob.exc.HTTPInternalServerError(message))
+
+        if utils.bool_from_string(config.Config.get('sql_stats_headers',
+                                                    'false')):
+            response.headers['X-Melange-SQL-Statements'] = str(
+                stats.statements)
+            response.headers['X-Melange-SQL-Time'] = "%.6f" % stats.seconds
+            response.headers['X-Melange-SQL-Rows'] = str(stats.rows)
+        return response
+
+    @classmethod
+    def factory(cls, global_config, **local_config):
+        def _factory(app):
+            return cls(app)
+        return _factory
+
+
+def routed_action(environ):
+    """Names the controller action a request was routed to.
+
+    Returns '<Controller>.<action>', or 'unrouted' for requests no route
+    matched.
+
+    """
+    match = environ.get('wsgiorg.routing_args', (None, None))[1]
+    if not match or 'action' not in match:
+        return "unrouted"
+    controller = getattr(match.get('controller'), 'controller', None)
+    return "%s.%s" % (controller.__class__.__name__, match['action'])
+
+
 class Fault(webob.exc.HTTPException):
     """Error codes for API faults."""
 
@@ -17,7 +17,10 @@
 
 import sqlalchemy.exc
 from sqlalchemy import and_
+from sqlalchemy import func
 from sqlalchemy import or_
+from sqlalchemy import orm
+from sqlalchemy import select
 from sqlalchemy.orm import aliased
 from sqlalchemy.orm import clear_mappers
 
@@ -27,6 +30,7 @@ from melange.common import utils
 from melange.db.sqlalchemy import migration
 from melange.db.sqlalchemy import mappers
 from melange.db.sqlalchemy import session
+from melange.db.sqlalchemy import tables
 
 
 def list(query_func, *args, **kwargs):
@@ -70,6 +74,7 @@ def delete(model, db_session=None):
 
 
 def delete_all(query_func, model, **conditions):
+    session.use_primary()
     query_func(model, **conditions).delete()
 
 
@@ -79,6 +84,7 @@ def update(model, **values):
 
 
 def update_all(query_func, model, conditions, values):
+    session.use_primary()
     query_func(model, **conditions).update(values)
 
 
@@ -134,6 +140,7 @@ def remove_inside_locals(global_address_id, inside_local_address=None):
 
 def _remove_natted_ips(filter_by_natted_address_func,
                        natted_address, **kwargs):
+    session.use_primary()
     natted_ips = find_natted_ips(**kwargs)
     if natted_address is not None:
         natted_ips = filter_by_natted_address_func(natted_ips, natted_address)
@@ -195,9 +202,65 @@ def find_all_allocated_ips(model, used_by_device=None, used_by_tenant=None,
     return query
 
 
+def export_ip_blocks(tenant_id=None, batch_size=1000):
+    IpBlock = ipam.models.IpBlock
+    return _exported(_base_query(IpBlock), IpBlock.tenant_id, tenant_id,
+                     IpBlock.id, batch_size)
+
+
+def export_ip_routes(tenant_id=None, batch_size=1000):
+    IpBlock = ipam.models.IpBlock
+    IpRoute = ipam.models.IpRoute
+    query = _base_query(IpRoute).\
+        join((IpBlock, IpRoute.source_block_id == IpBlock.id))
+    return _exported(query, IpBlock.tenant_id, tenant_id, IpRoute.id,
+                     batch_size)
+
+
+def export_interfaces(tenant_id=None, batch_size=1000):
+    """Yields (interface, mac address or None) pairs."""
+    Interface = ipam.models.Interface
+    MacAddress = ipam.models.MacAddress
+    query = session.get_session(read_only=True).\
+        query(Interface, MacAddress).\
+        outerjoin((MacAddress, MacAddress.interface_id == Interface.id))
+    return _exported(query, Interface.tenant_id, tenant_id, Interface.id,
+                     batch_size)
+
+
+def export_ip_addresses(tenant_id=None, batch_size=1000):
+    """Yields (ip address, interface) pairs of allocated addresses.
+
+    A tenant's addresses are those in its blocks and those allocated to its
+    interfaces.
+
+    """
+    IpAddress = ipam.models.IpAddress
+    IpBlock = ipam.models.IpBlock
+    Interface = ipam.models.Interface
+    deallocated_on = None
+    query = session.get_session(read_only=True).\
+        query(IpAddress, Interface).\
+        join((Interface, IpAddress.interface_id == Interface.id)).\
+        filter(or_(IpAddress.marked_for_deallocation == deallocated_on,
+                   IpAddress.marked_for_deallocation == False))
+    if tenant_id is not None:
+        query = query.\
+            join((IpBlock, IpAddress.ip_block_id == IpBlock.id)).\
+            filter(or_(IpBlock.tenant_id == tenant_id,
+                       Interface.tenant_id == tenant_id))
+    return query.order_by(IpAddress.id).yield_per(batch_size)
+
+
+def _exported(query, tenant_column, tenant_id, order_column, batch_size):
+    if tenant_id is not None:
+        query = query.filter(tenant_column == tenant_id)
+    return query.order_by(order_column).yield_per(batch_size)
+
+
 def pop_allocatable_address(address_model, **conditions):
     db_session = session.get_session()
-    with db_session.begin():
+    with db_session.begin(subtransactions=True):
         address_rec = _query_by(
             address_model,
             db_session=db_session,
@@ -209,6 +272,113 @@ def pop_allocatable_address(address_model, **conditions):
         return address_rec.address
 
 
+def find_all_in(model, field, values, **conditions):
+    if not values:
+        return []
+    return _query_by(model, **conditions).\
+        filter(getattr(model, field).in_(values)).all()
+
+
+def delete_all_in(model, field, values):
+    if not values:
+        return
+    session.use_primary()
+    _delete_in(session.get_session(), model, field, values)
+
+
+def delete_ip_blocks(ip_block_ids):
+    """Deletes blocks and what hangs off them with one statement per table.
+
+    Removes the blocks' addresses along with their nat and allowed ip
+    relationships, the routes sourced from the blocks and then the blocks,
+    in a single transaction. Callers delete subnets before their parents.
+
+    """
+    if not ip_block_ids:
+        return
+    IpAddress = ipam.models.IpAddress
+    db_session = session.get_session()
+    with db_session.begin(subtransactions=True):
+        address_ids = db_session.query(IpAddress.id).\
+            filter(IpAddress.ip_block_id.in_(ip_block_ids)).subquery()
+        for model, field, values in [
+                (mappers.AllowedIp, 'ip_address_id', address_ids),
+                (mappers.IpNat, 'inside_local_address_id', address_ids),
+                (mappers.IpNat, 'inside_global_address_id', address_ids),
+                (IpAddress, 'ip_block_id', ip_block_ids),
+                (ipam.models.IpRoute, 'source_block_id', ip_block_ids),
+                (ipam.models.IpBlock, 'id', ip_block_ids)]:
+            _delete_in(db_session, model, field, values)
+
+
+def insert_all(model, values_list):
+    """Inserts many rows of a model with a single statement."""
+    if not values_list:
+        return
+    session.use_primary()
+    table = orm.class_mapper(model).mapped_table
+    session.get_session().execute(table.insert(), values_list)
+
+
+def delete_interfaces(interface_ids, deallocated_at):
+    """Tears interfaces down with one statement per table.
+
+    Deallocates the interfaces' ips, forgets the ips allowed on them and
+    deletes their mac addresses and the interfaces themselves. Freeing the
+    macs for reuse is left to the mac generator.
+
+    """
+    if not interface_ids:
+        return
+    IpAddress = ipam.models.IpAddress
+    db_session = session.get_session()
+    with db_session.begin(subtransactions=True):
+        _query_by(IpAddress, db_session=db_session).\
+            filter(IpAddress.interface_id.in_(interface_ids)).\
+            update(dict(marked_for_deallocation=True,
+                        deallocated_at=deallocated_at,
+                        updated_at=deallocated_at,
+                        interface_id=None),
+                   synchronize_session=False)
+        for model, field in [(mappers.AllowedIp, 'interface_id'),
+                             (ipam.models.MacAddress, 'interface_id'),
+                             (ipam.models.Interface, 'id')]:
+            _delete_in(db_session, model, field, interface_ids)
+
+
+def find_claimable_jobs(now, limit):
+    session.use_primary()
+    return _query_by(ipam.models.Job).\
+        filter(_claimable_job(now)).\
+        order_by(ipam.models.Job.created_at).limit(limit).all()
+
+
+def claim_job(job_id, worker, lease_expires_at, now):
+    """Marks a job as running on the worker unless another worker has it.
+
+    The status check and the update are one statement, so of several
+    workers claiming the same job exactly one sees a row updated.
+
+    """
+    Job = ipam.models.Job
+    session.use_primary()
+    updated = _query_by(Job).filter_by(id=job_id).\
+        filter(_claimable_job(now)).\
+        update(dict(status=Job.RUNNING,
+                    worker=worker,
+                    lease_expires_at=lease_expires_at,
+                    attempts=Job.attempts + 1,
+                    updated_at=now),
+               synchronize_session=False)
+    return updated == 1
+
+
+def _claimable_job(now):
+    Job = ipam.models.Job
+    return or_(Job.status == Job.QUEUED,
+               and_(Job.status == Job.RUNNING, Job.lease_expires_at < now))
+
+
 def save_allowed_ip(interface_id, ip_address_id):
     allowed_ip = mappers.AllowedIp()
     update(allowed_ip,
@@ -232,11 +402,91 @@ def find_allowed_ips(ip_address_model,
 
 
 def remove_allowed_ip(**conditions):
+    session.use_primary()
     _query_by(mappers.AllowedIp).\
         filter_by(**conditions).\
         delete()
 
 
+def transaction():
+    return session.transaction()
+
+
+def save_outbox_message(priority, message):
+    session.get_session().execute(
+        tables.notification_outbox.insert(),
+        dict(priority=priority, message=message, created_at=utils.utcnow()))
+
+
+def relay_outbox_messages(publish, limit):
+    """Hands the oldest outbox messages to publish, then deletes them.
+
+    The messages stay locked until publish returns, so relays in other
+    processes wait for them to be deleted instead of publishing them twice.
+    If publish raises, the messages are kept and published again later.
+
+    """
+    outbox = tables.notification_outbox
+    db_session = session.get_session()
+    with db_session.begin():
+        rows = db_session.execute(
+            outbox.select(for_update=True).order_by(outbox.c.id).
+            limit(limit)).fetchall()
+        if rows:
+            publish([(row.priority, row.message) for row in rows])
+            db_session.execute(outbox.delete().where(
+                outbox.c.id.in_([row.id for row in rows])))
+    return len(rows)
+
+
+def save_changes(changes):
+    session.get_session().execute(tables.changes.insert(), changes)
+
+
+def find_changes(since, limit, created_before, tenant_id=None,
+                 network_id=None):
+    # NOTE: the change log is always read from the primary. The settle
+    # window is measured against the primary's commits, and a lagging
+    # replica could show an entry before an older one committed first.
+    changes = tables.changes
+    query = changes.select().\
+        where(changes.c.id > since).\
+        where(changes.c.created_at <= created_before)
+    if tenant_id is not None:
+        query = query.where(changes.c.tenant_id == tenant_id)
+    if network_id is not None:
+        query = query.where(changes.c.network_id == network_id)
+    return session.get_session().execute(
+        query.order_by(changes.c.id).limit(limit)).fetchall()
+
+
+def oldest_change_id():
+    changes = tables.changes
+    return session.get_session().execute(
+        select([func.min(changes.c.id)])).scalar()
+
+
+def latest_change_id(created_before):
+    changes = tables.changes
+    return session.get_session().execute(
+        select([func.max(changes.c.id)]).
+        where(changes.c.created_at <= created_before)).scalar()
+
+
+def delete_changes(created_before):
+    changes = tables.changes
+    session.get_session().execute(
+        changes.delete().where(changes.c.created_at < created_before))
+
+
+def statement_stats():
+    return session.statement_stats()
+
+
+def replica_reads():
+    return session.replica_reads()
+
+
 def configure_db(options, *plugins):
     session.configure_db(options)
     configure_db_for_plugins(options, *plugins)
@@ -286,7 +536,7 @@ def db_reset_for_plugins(options, *plugins):
 
 
 def _base_query(cls):
-    return session.get_session().query(cls)
+    return session.get_session(read_only=True).query(cls)
 
 
 def _query_by(cls, db_session=None, **conditions):
@@ -299,6 +549,12 @@ def _query_by(cls, db_session=None, **conditions):
     return query
 
 
+def _delete_in(db_session, model, field, values):
+    _query_by(model, db_session=db_session).\
+        filter(getattr(model, field).in_(values)).\
+        delete(synchronize_session=False)
+
+
 def _limits(query_func, model, conditions, limit, marker, marker_column=None):
     query = query_func(model, **conditions)
     marker_column = marker_column or model.id
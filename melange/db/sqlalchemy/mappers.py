@@ -15,45 +15,32 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from sqlalchemy import MetaData
-from sqlalchemy import Table
 from sqlalchemy import orm
 from sqlalchemy.orm import exc as orm_exc
 
+from melange.db.sqlalchemy import tables
+
 
 def map(engine, models):
-    meta = MetaData()
-    meta.bind = engine
     if mapping_exists(models["IpBlock"]):
         return
-    ip_blocks_table = Table('ip_blocks', meta, autoload=True)
-    ip_nats_table = Table('ip_nats', meta, autoload=True)
-    ip_addresses_table = Table('ip_addresses', meta, autoload=True)
-    policies_table = Table('policies', meta, autoload=True)
-    ip_ranges_table = Table('ip_ranges', meta, autoload=True)
-    ip_octets_table = Table('ip_octets', meta, autoload=True)
-    ip_routes_table = Table('ip_routes', meta, autoload=True)
-    mac_address_ranges_table = Table('mac_address_ranges', meta, autoload=True)
-    mac_addresses_table = Table('mac_addresses', meta, autoload=True)
-    interfaces_table = Table('interfaces', meta, autoload=True)
-    allowed_ips_table = Table('allowed_ips', meta, autoload=True)
-
-    orm.mapper(models["IpBlock"], ip_blocks_table)
-    orm.mapper(models["IpAddress"], ip_addresses_table)
-    orm.mapper(models["Policy"], policies_table)
-    orm.mapper(models["Interface"], interfaces_table)
-    orm.mapper(models["IpRange"], ip_ranges_table)
-    orm.mapper(models["IpOctet"], ip_octets_table)
-    orm.mapper(models["IpRoute"], ip_routes_table)
-    orm.mapper(models["MacAddressRange"], mac_address_ranges_table)
-    orm.mapper(models["MacAddress"], mac_addresses_table)
-
-    inside_global_join = (ip_nats_table.c.inside_global_address_id
-                          == ip_addresses_table.c.id)
-    inside_local_join = (ip_nats_table.c.inside_local_address_id
-                         == ip_addresses_table.c.id)
-
-    orm.mapper(IpNat, ip_nats_table,
+    orm.mapper(models["IpBlock"], tables.ip_blocks)
+    orm.mapper(models["IpAddress"], tables.ip_addresses)
+    orm.mapper(models["Policy"], tables.policies)
+    orm.mapper(models["Interface"], tables.interfaces)
+    orm.mapper(models["IpRange"], tables.ip_ranges)
+    orm.mapper(models["IpOctet"], tables.ip_octets)
+    orm.mapper(models["IpRoute"], tables.ip_routes)
+    orm.mapper(models["MacAddressRange"], tables.mac_address_ranges)
+    orm.mapper(models["MacAddress"], tables.mac_addresses)
+    orm.mapper(models["Job"], tables.jobs)
+
+    inside_global_join = (tables.ip_nats.c.inside_global_address_id
+                          == tables.ip_addresses.c.id)
+    inside_local_join = (tables.ip_nats.c.inside_local_address_id
+                         == tables.ip_addresses.c.id)
+
+    orm.mapper(IpNat, tables.ip_nats,
                properties={'inside_global_address':
                            orm.relation(
                                models["IpAddress"],
@@ -65,7 +52,7 @@ def map(engine, models):
                            }
                )
 
-    orm.mapper(AllowedIp, allowed_ips_table,
+    orm.mapper(AllowedIp, tables.allowed_ips,
                properties={
                    'interface': orm.relation(models["Interface"]),
                    'ip_address': orm.relation(models["IpAddress"])
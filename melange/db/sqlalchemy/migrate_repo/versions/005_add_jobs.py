@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+
+from melange.db.sqlalchemy.migrate_repo.schema import create_tables
+from melange.db.sqlalchemy.migrate_repo.schema import DateTime
+from melange.db.sqlalchemy.migrate_repo.schema import drop_tables
+from melange.db.sqlalchemy.migrate_repo.schema import Integer
+from melange.db.sqlalchemy.migrate_repo.schema import String
+from melange.db.sqlalchemy.migrate_repo.schema import Table
+from melange.db.sqlalchemy.migrate_repo.schema import Text
+
+
+meta = MetaData()
+
+jobs = Table(
+    'jobs', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('action', String(255), nullable=False),
+    Column('params', Text()),
+    Column('tenant_id', String(255)),
+    Column('status', String(36), nullable=False),
+    Column('progress', Integer()),
+    Column('total', Integer()),
+    Column('message', Text()),
+    Column('worker', String(255)),
+    Column('attempts', Integer()),
+    Column('lease_expires_at', DateTime()),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+Index('jobs_status_lease_expires_at_idx',
+      jobs.c.status,
+      jobs.c.lease_expires_at)
+
+
+def upgrade(migrate_engine):
+    meta.bind = migrate_engine
+    create_tables([jobs])
+
+
+def downgrade(migrate_engine):
+    meta.bind = migrate_engine
+    drop_tables([jobs])
@@ -16,19 +16,30 @@
 #    under the License.
 
 import contextlib
+from eventlet import corolocal
+from eventlet import tpool
+import itertools
 import logging
 import sqlalchemy as sql
 from sqlalchemy import create_engine
+from sqlalchemy import exc
 from sqlalchemy import MetaData
+from sqlalchemy import pool
 from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.orm import sessionmaker
+import time
 
 from melange import ipam
 from melange.common import config
+from melange.common import metrics
 from melange.db.sqlalchemy import mappers
+from melange.db.sqlalchemy import tables
 
 _ENGINE = None
-_MAKER = None
+_MAKERS = {}
+_READ_ENGINES = []
+_READ_ENGINE_CYCLE = None
+_CONTEXT = corolocal.local()
 
 
 LOG = logging.getLogger('melange.db.sqlalchemy.session')
@@ -38,13 +49,73 @@ def configure_db(options, models_mapper=None):
     configure_sqlalchemy_log(options)
     global _ENGINE
     if not _ENGINE:
+        configure_tpool(options)
         _ENGINE = _create_engine(options)
+        check_schema_version(_ENGINE)
+        metrics.register_gauge("db_pool", pool_stats)
+        configure_read_engines(options)
     if models_mapper:
         models_mapper.map(_ENGINE)
     else:
         mappers.map(_ENGINE, ipam.models.persisted_models())
 
 
+def check_schema_version(engine):
+    """Warns if the database is not at the version the mappers expect.
+
+    Reads the single migrate_version row rather than reflecting the tables.
+
+    """
+    try:
+        version = engine.execute(
+            sql.text("SELECT version FROM migrate_version "
+                     "WHERE repository_id = :repository_id"),
+            repository_id="Melange Migrations").scalar()
+    except exc.DBAPIError as error:
+        LOG.warn("Could not read the database schema version: %s" % error)
+        return
+    if version != tables.SCHEMA_VERSION:
+        LOG.warn("Database schema is at version %s but melange expects "
+                 "version %s, run melange-manage db_sync"
+                 % (version, tables.SCHEMA_VERSION))
+    return version
+
+
+def configure_read_engines(options):
+    """Creates engines for the replicas listed in sql_read_connection."""
+    global _READ_ENGINES, _READ_ENGINE_CYCLE
+    read_connections = config.get_option(options,
+                                         'sql_read_connection',
+                                         default=None)
+    if not read_connections:
+        return
+    max_staleness = config.get_option(options,
+                                      'sql_read_max_staleness',
+                                      type='int',
+                                      default=5)
+    check_interval = config.get_option(options,
+                                       'sql_read_lag_check_interval',
+                                       type='int',
+                                       default=5)
+    _READ_ENGINES = []
+    for index, url in enumerate(read_connections.split(",")):
+        engine = _create_engine(options, url.strip())
+        _READ_ENGINES.append(ReadReplica(engine, max_staleness,
+                                         check_interval))
+        metrics.register_gauge("db_pool.replica%d" % index,
+                               lambda engine=engine: pool_stats(engine))
+    _READ_ENGINE_CYCLE = itertools.cycle(_READ_ENGINES)
+
+
+def configure_tpool(options):
+    """Sizes the eventlet thread pool that blocking DB calls run in."""
+    if _tpool_enabled(options):
+        tpool.set_num_threads(config.get_option(options,
+                                                'sql_tpool_size',
+                                                type='int',
+                                                default=20))
+
+
 def configure_sqlalchemy_log(options):
     debug = config.get_option(options, 'debug', type='bool', default=False)
     verbose = config.get_option(options, 'verbose', type='bool', default=False)
@@ -61,14 +132,32 @@ class MySQLPingListener(object):
     Ensures that MySQL connections checked out of the
     pool are alive.
 
+    Connections that were checked in less than ping_interval seconds ago
+    are assumed to be alive and are not pinged, which saves a round trip
+    on most checkouts.
+
     Borrowed from:
     http://groups.google.com/group/sqlalchemy/msg/a4ce563d802c929f
     """
 
+    def __init__(self, ping_interval=0):
+        self.ping_interval = ping_interval
+
+    def connect(self, dbapi_con, con_record):
+        con_record.info['last_used_at'] = time.time()
+
+    def checkin(self, dbapi_con, con_record):
+        if con_record is not None:
+            con_record.info['last_used_at'] = time.time()
+
     def checkout(self, dbapi_con, con_record, con_proxy):
+        last_used_at = con_record.info.get('last_used_at', 0)
+        if time.time() - last_used_at < self.ping_interval:
+            return
+        OperationalError = _unproxied(dbapi_con).OperationalError
         try:
             dbapi_con.cursor().execute('select 1')
-        except dbapi_con.OperationalError, ex:
+        except OperationalError, ex:
             if ex.args[0] in (2006, 2013, 2014, 2045, 2055):
                 LOG.warn('Got mysql server has gone away: %s', ex)
                 raise DisconnectionError("Database server went away")
@@ -76,8 +165,94 @@ class MySQLPingListener(object):
                 raise
 
 
-def _create_engine(options):
-    connection_dict = sql.engine.url.make_url(options['sql_connection'])
+class MeteredQueuePool(pool.QueuePool):
+    """QueuePool that keeps track of how long checkouts wait."""
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started_at = time.time()
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.timeouts += 1
+            LOG.warn("Timed out waiting for a database connection: %s"
+                     % self.status())
+            raise
+        finally:
+            waited = time.time() - started_at
+            self.wait_count += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+            'wait_count': self.wait_count,
+            'wait_time_total': self.wait_time_total,
+            'wait_time_max': self.wait_time_max,
+            'timeouts': self.timeouts,
+        }
+
+
+class ReadReplica(object):
+    """A read replica engine that is only used while its lag is bounded.
+
+    Replication lag is measured at most once every check_interval seconds.
+    A replica whose lag is unknown or above max_staleness seconds is skipped
+    until a later check finds it caught up.
+
+    """
+
+    def __init__(self, engine, max_staleness, check_interval):
+        self.engine = engine
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self._lag = None
+        self._checked_at = None
+
+    def is_fresh(self):
+        now = time.time()
+        if (self._checked_at is None
+                or now - self._checked_at >= self.check_interval):
+            self._lag = self._measure_lag()
+            self._checked_at = now
+        return self._lag is not None and self._lag <= self.max_staleness
+
+    def _measure_lag(self):
+        try:
+            return _replication_lag(self.engine)
+        except Exception as error:
+            LOG.warn("Could not measure lag of read replica %s: %s"
+                     % (self.engine.url, error))
+            return None
+
+
+def _replication_lag(engine):
+    drivername = engine.url.drivername
+    if 'mysql' in drivername:
+        status = engine.execute("SHOW SLAVE STATUS").fetchone()
+        if status is None:
+            return 0
+        return status['Seconds_Behind_Master']
+    if 'postgres' in drivername:
+        return engine.execute(
+            "SELECT COALESCE(EXTRACT(EPOCH FROM now() - "
+            "pg_last_xact_replay_timestamp()), 0)").scalar()
+    return 0
+
+
+def _create_engine(options, sql_connection=None):
+    sql_connection = sql_connection or options['sql_connection']
+    connection_dict = sql.engine.url.make_url(sql_connection)
     engine_args = {
         'pool_recycle': config.get_option(options,
                                           'sql_idle_timeout',
@@ -90,23 +265,219 @@ def _create_engine(options):
         'convert_unicode': True,
     }
 
-    if 'mysql' in connection_dict.drivername:
-        engine_args['listeners'] = [MySQLPingListener()]
+    if 'sqlite' not in connection_dict.drivername:
+        engine_args.update(_pool_args(options))
+        if _tpool_enabled(options):
+            engine_args['creator'] = _tpool_creator(connection_dict)
+
+    if 'mysql' in connection_dict.drivername and _pre_ping_enabled(options):
+        ping_interval = config.get_option(options,
+                                          'sql_pool_ping_interval',
+                                          type='int',
+                                          default=30)
+        engine_args['listeners'] = [MySQLPingListener(ping_interval)]
 
     LOG.info("Creating SQLAlchemy engine with args: %s" % engine_args)
-    return create_engine(options['sql_connection'], **engine_args)
+    engine = create_engine(sql_connection, **engine_args)
+    sql.event.listen(engine, "before_cursor_execute", _before_execute)
+    sql.event.listen(engine, "after_cursor_execute", _after_execute)
+    return engine
+
+
+class StatementStats(object):
+    """Statements run, seconds spent in them and rows they touched.
+
+    Rows are as reported by the driver's rowcount, which some drivers, such
+    as sqlite, only set for inserts, updates and deletes.
+
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.started_at = None
+
+
+@contextlib.contextmanager
+def statement_stats():
+    """Counts the statements the current green thread runs in the block.
+
+    Statements counted by a nested block are added to the enclosing one.
+
+    """
+    previous = getattr(_CONTEXT, 'statement_stats', None)
+    stats = StatementStats()
+    _CONTEXT.statement_stats = stats
+    try:
+        yield stats
+    finally:
+        _CONTEXT.statement_stats = previous
+        if previous is not None:
+            previous.statements += stats.statements
+            previous.seconds += stats.seconds
+            previous.rows += stats.rows
 
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session."""
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    stats = getattr(_CONTEXT, 'statement_stats', None)
+    if stats is not None:
+        stats.started_at = time.time()
 
-    global _MAKER, _ENGINE
-    if not _MAKER:
-        assert _ENGINE
-        _MAKER = sessionmaker(bind=_ENGINE,
-                              autocommit=autocommit,
-                              expire_on_commit=expire_on_commit)
-    return _MAKER()
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    stats = getattr(_CONTEXT, 'statement_stats', None)
+    if stats is None or stats.started_at is None:
+        return
+    stats.statements += 1
+    stats.seconds += time.time() - stats.started_at
+    stats.rows += max(cursor.rowcount, 0)
+    stats.started_at = None
+
+
+def _pool_args(options):
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config.get_option(options,
+                                       'sql_pool_size',
+                                       type='int',
+                                       default=5),
+        'max_overflow': config.get_option(options,
+                                          'sql_max_overflow',
+                                          type='int',
+                                          default=10),
+        'pool_timeout': config.get_option(options,
+                                          'sql_pool_timeout',
+                                          type='int',
+                                          default=30),
+    }
+
+
+def _pre_ping_enabled(options):
+    return config.get_option(options,
+                             'sql_pool_pre_ping',
+                             type='bool',
+                             default=True)
+
+
+def _tpool_enabled(options):
+    return config.get_option(options,
+                             'sql_use_tpool',
+                             type='bool',
+                             default=False)
+
+
+def _tpool_creator(url, dbapi=None):
+    """Returns a creator of connections whose calls run in eventlet.tpool.
+
+    Connecting and every cursor call happen in a native thread, so a
+    blocking C driver such as MySQLdb no longer stalls the eventlet hub.
+
+    """
+    dialect_cls = url.get_dialect()
+    dbapi = dbapi or dialect_cls.dbapi()
+    cargs, cparams = dialect_cls(dbapi=dbapi).create_connect_args(url)
+
+    def creator():
+        connection = tpool.execute(dbapi.connect, *cargs, **cparams)
+        return tpool.Proxy(connection, autowrap_names=('cursor',))
+
+    return creator
+
+
+def _unproxied(dbapi_con):
+    if isinstance(dbapi_con, tpool.Proxy):
+        return dbapi_con._obj
+    return dbapi_con
+
+
+def pool_stats(engine=None):
+    engine = engine or _ENGINE
+    if engine is None or not isinstance(engine.pool, MeteredQueuePool):
+        return {}
+    return engine.pool.stats()
+
+
+def get_session(autocommit=True, expire_on_commit=False, read_only=False):
+    """Helper method to grab session.
+
+    Sessions are bound to the primary database unless read_only is set and
+    the caller is inside replica_reads() without having used the primary.
+    Inside transaction() the session of the transaction is returned.
+
+    """
+    assert _ENGINE
+    transaction_session = getattr(_CONTEXT, 'transaction_session', None)
+    if transaction_session is not None:
+        return transaction_session
+    if read_only:
+        engine = _read_engine()
+    else:
+        use_primary()
+        engine = _ENGINE
+
+    maker = _MAKERS.get(engine)
+    if not maker:
+        maker = sessionmaker(bind=engine,
+                             autocommit=autocommit,
+                             expire_on_commit=expire_on_commit)
+        _MAKERS[engine] = maker
+    return maker()
+
+
+@contextlib.contextmanager
+def transaction():
+    """Runs every database call in the block in one transaction.
+
+    A transaction() inside another one joins it.
+
+    """
+    if getattr(_CONTEXT, 'transaction_session', None) is not None:
+        yield _CONTEXT.transaction_session
+        return
+    db_session = get_session()
+    _CONTEXT.transaction_session = db_session
+    try:
+        with db_session.begin():
+            yield db_session
+    finally:
+        _CONTEXT.transaction_session = None
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """Allows read only sessions in the block to use a read replica."""
+    previous = (getattr(_CONTEXT, 'replica_reads', False),
+                getattr(_CONTEXT, 'primary_used', False))
+    _CONTEXT.replica_reads = True
+    _CONTEXT.primary_used = False
+    try:
+        yield
+    finally:
+        _CONTEXT.replica_reads, _CONTEXT.primary_used = previous
+
+
+def use_primary():
+    """Sends the rest of the replica_reads() block to the primary.
+
+    Called before every write so that later reads see it.
+
+    """
+    _CONTEXT.primary_used = True
+
+
+def _read_engine():
+    if (not _READ_ENGINES
+            or not getattr(_CONTEXT, 'replica_reads', False)
+            or getattr(_CONTEXT, 'primary_used', False)):
+        return _ENGINE
+    for i in range(len(_READ_ENGINES)):
+        replica = _READ_ENGINE_CYCLE.next()
+        if replica.is_fresh():
+            return replica.engine
+    return _ENGINE
 
 
 def raw_query(model, autocommit=True, expire_on_commit=False):
@@ -115,13 +486,10 @@ def raw_query(model, autocommit=True, expire_on_commit=False):
 
 def clean_db():
     global _ENGINE
-    meta = MetaData()
-    meta.reflect(bind=_ENGINE)
     with contextlib.closing(_ENGINE.connect()) as con:
         trans = con.begin()
-        for table in reversed(meta.sorted_tables):
-            if table.name != "migrate_version":
-                con.execute(table.delete())
+        for table in reversed(tables.meta.sorted_tables):
+            con.execute(table.delete())
         trans.commit()
 
 
@@ -0,0 +1,220 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Table definitions as of the latest migration in migrate_repo.
+
+The mappers use these instead of reflecting the database, so any migration
+that changes the schema has to update this module and SCHEMA_VERSION too.
+
+"""
+
+from sqlalchemy import ForeignKey
+from sqlalchemy.schema import Column
+from sqlalchemy.schema import Index
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.types import BigInteger
+from sqlalchemy.types import Boolean
+from sqlalchemy.types import DateTime
+from sqlalchemy.types import Integer
+from sqlalchemy.types import String
+from sqlalchemy.types import Text
+
+
+SCHEMA_VERSION = 7
+
+meta = MetaData()
+
+policies = Table(
+    'policies', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('name', String(255), nullable=False),
+    Column('tenant_id', String(255)),
+    Column('description', String(255)),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+ip_ranges = Table(
+    'ip_ranges', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('offset', Integer(), nullable=False),
+    Column('length', Integer(), nullable=False),
+    Column('policy_id', String(36), ForeignKey('policies.id')),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+ip_octets = Table(
+    'ip_octets', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('octet', Integer(), nullable=False),
+    Column('policy_id', String(36), ForeignKey('policies.id')),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+ip_blocks = Table(
+    'ip_blocks', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('network_id', String(255)),
+    Column('cidr', String(255), nullable=False),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()),
+    Column('type', String(7)),
+    Column('tenant_id', String(255)),
+    Column('gateway', String(255)),
+    Column('dns1', String(255)),
+    Column('dns2', String(255)),
+    Column('allocatable_ip_counter', BigInteger()),
+    Column('is_full', Boolean()),
+    Column('policy_id', String(36), ForeignKey('policies.id')),
+    Column('parent_id', String(36), ForeignKey('ip_blocks.id',
+                                               ondelete="CASCADE")),
+    Column('network_name', String(255)),
+    Column('omg_do_not_use', Boolean()))
+
+ip_routes = Table(
+    'ip_routes', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('destination', String(255), nullable=False),
+    Column('netmask', String(255)),
+    Column('gateway', String(255), nullable=False),
+    Column('source_block_id', String(36), ForeignKey('ip_blocks.id')),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+mac_address_ranges = Table(
+    'mac_address_ranges', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('cidr', String(255), nullable=False),
+    Column('next_address', BigInteger()),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+interfaces = Table(
+    'interfaces', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('vif_id_on_device', String(36)),
+    Column('device_id', String(36)),
+    Column('tenant_id', String(36)),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+mac_addresses = Table(
+    'mac_addresses', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('address', BigInteger(), nullable=False),
+    Column('mac_address_range_id', String(36),
+           ForeignKey('mac_address_ranges.id')),
+    Column('interface_id', String(36), ForeignKey('interfaces.id')),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()),
+    UniqueConstraint('interface_id'),
+    UniqueConstraint('address'))
+
+ip_addresses = Table(
+    'ip_addresses', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('address', String(255), nullable=False),
+    Column('interface_id', String(255), ForeignKey('interfaces.id')),
+    Column('ip_block_id', String(36), ForeignKey('ip_blocks.id')),
+    Column('used_by_tenant_id', String(255)),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()),
+    Column('marked_for_deallocation', Boolean()),
+    Column('deallocated_at', DateTime()),
+    UniqueConstraint('address', 'ip_block_id'))
+
+ip_nats = Table(
+    'ip_nats', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('inside_local_address_id',
+           String(36),
+           ForeignKey('ip_addresses.id'),
+           nullable=False),
+    Column('inside_global_address_id',
+           String(36),
+           ForeignKey('ip_addresses.id'),
+           nullable=False),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+allocatable_ips = Table(
+    'allocatable_ips', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('ip_block_id', String(36), ForeignKey('ip_blocks.id')),
+    Column('address', String(255), nullable=False),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+allowed_ips = Table(
+    'allowed_ips', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('ip_address_id', String(36), ForeignKey('ip_addresses.id'),
+           nullable=False),
+    Column('interface_id', String(36), ForeignKey('interfaces.id'),
+           nullable=False),
+    UniqueConstraint('ip_address_id', 'interface_id'))
+
+allocatable_macs = Table(
+    'allocatable_macs', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('mac_address_range_id', String(36),
+           ForeignKey('mac_address_ranges.id')),
+    Column('address', BigInteger(), nullable=False),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+jobs = Table(
+    'jobs', meta,
+    Column('id', String(36), primary_key=True, nullable=False),
+    Column('action', String(255), nullable=False),
+    Column('params', Text()),
+    Column('tenant_id', String(255)),
+    Column('status', String(36), nullable=False),
+    Column('progress', Integer()),
+    Column('total', Integer()),
+    Column('message', Text()),
+    Column('worker', String(255)),
+    Column('attempts', Integer()),
+    Column('lease_expires_at', DateTime()),
+    Column('created_at', DateTime()),
+    Column('updated_at', DateTime()))
+
+Index('jobs_status_lease_expires_at_idx',
+      jobs.c.status,
+      jobs.c.lease_expires_at)
+
+notification_outbox = Table(
+    'notification_outbox', meta,
+    Column('id', Integer(), primary_key=True, autoincrement=True),
+    Column('priority', String(36), nullable=False),
+    Column('message', Text(), nullable=False),
+    Column('created_at', DateTime()))
+
+changes = Table(
+    'changes', meta,
+    Column('id', Integer(), primary_key=True, autoincrement=True),
+    Column('entity', String(36), nullable=False),
+    Column('entity_id', String(36), nullable=False),
+    Column('action', String(36), nullable=False),
+    Column('tenant_id', String(255)),
+    Column('network_id', String(255)),
+    Column('device_id', String(36)),
+    Column('created_at', DateTime()))
+
+Index('changes_tenant_id_id_idx', changes.c.tenant_id, changes.c.id)
+Index('changes_network_id_id_idx', changes.c.network_id, changes.c.id)
@@ -0,0 +1,166 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Background execution of long running ipam operations.
+
+Operations are queued as rows in the jobs table and run by a Worker, a pool
+of green threads in each api server process. A worker holds a lease on the
+jobs it runs and extends it as they report progress; jobs whose lease runs
+out, because their worker died, are picked up again by any worker. Actions
+must therefore be safe to run more than once.
+
+"""
+
+import eventlet
+import eventlet.queue
+import logging
+import os
+import socket
+
+from melange.common import config
+from melange.common import exception
+from melange.ipam import models
+
+
+LOG = logging.getLogger('melange.ipam.jobs')
+
+_ACTIONS = {}
+_WORKERS = []
+
+
+def action(name):
+    """Registers the decorated function as the job action called name.
+
+    The function is called with the job and the keyword parameters the job
+    was submitted with.
+
+    """
+    def register(func):
+        _ACTIONS[name] = func
+        return func
+    return register
+
+
+def enabled():
+    """Whether this server runs job workers, see job_workers."""
+    return int(config.Config.get('job_workers', 0)) > 0
+
+
+def submit(action_name, tenant_id=None, **params):
+    if action_name not in _ACTIONS:
+        raise UnknownJobActionError(_("Unknown job action %s") % action_name)
+    job = models.Job.create(action=action_name,
+                            tenant_id=tenant_id,
+                            params=params)
+    for worker in _WORKERS:
+        worker.wake()
+    return job
+
+
+class Worker(object):
+
+    def __init__(self, size=None, poll_interval=None, max_attempts=None):
+        self.name = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.size = size or int(config.Config.get('job_workers', 4))
+        self.poll_interval = poll_interval or int(
+            config.Config.get('job_poll_interval', 5))
+        self.max_attempts = max_attempts or int(
+            config.Config.get('job_max_attempts', 3))
+        self.pool = eventlet.GreenPool(self.size)
+        self._wakeups = eventlet.queue.LightQueue()
+        self._thread = None
+
+    def start(self):
+        _WORKERS.append(self)
+        self._thread = eventlet.spawn(self._poll)
+
+    def stop(self):
+        if self in _WORKERS:
+            _WORKERS.remove(self)
+        if self._thread is not None:
+            self._thread.kill()
+            self._thread = None
+        self.pool.waitall()
+
+    def wake(self):
+        self._wakeups.put(None)
+
+    def run_pending(self):
+        """Claims queued and abandoned jobs while the pool has room."""
+        free = self.pool.free()
+        if free <= 0:
+            return
+        for job in models.Job.claimable(limit=free):
+            if job.attempts >= self.max_attempts:
+                job.fail(_("Gave up after %d attempts") % job.attempts)
+                continue
+            if job.claim(self.name):
+                self.pool.spawn_n(self.run, job)
+
+    def run(self, job):
+        LOG.info("Running job %s: %s" % (job.id, job.action))
+        try:
+            _ACTIONS[job.action](job, **job.parameters())
+        except Exception as error:
+            LOG.exception("Job %s failed" % job.id)
+            job.fail(str(error))
+        else:
+            job.complete()
+
+    def _poll(self):
+        while True:
+            try:
+                self.run_pending()
+            except Exception:
+                LOG.exception("Could not claim jobs")
+            try:
+                self._wakeups.get(timeout=self.poll_interval)
+            except eventlet.queue.Empty:
+                pass
+
+
+@action("delete_ip_block")
+def delete_ip_block(job, ip_block_id):
+    ip_block = models.IpBlock.get(ip_block_id)
+    if ip_block is not None:
+        ip_block.delete(progress=job.report_progress)
+
+
+@action("delete_policy")
+def delete_policy(job, policy_id):
+    policy = models.Policy.get(policy_id)
+    if policy is not None:
+        policy.delete()
+
+
+@action("deallocate_ips")
+def deallocate_ips(job, network_id, interface_id):
+    try:
+        network = models.Network.find_by(network_id, tenant_id=job.tenant_id)
+    except models.ModelNotFoundError:
+        return
+    network.deallocate_ips(interface_id=interface_id)
+
+
+class UnknownJobActionError(exception.MelangeError):
+
+    message = _("Unknown job action")
+
+
+class JobsDisabledError(exception.MelangeError):
+
+    message = _("Jobs are disabled, no job_workers are configured")
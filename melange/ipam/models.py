@@ -17,7 +17,9 @@
 
 """Model classes that form the core of ipam functionality."""
 
+import contextlib
 import datetime
+import json
 import logging
 import netaddr
 import operator
@@ -28,6 +30,7 @@ from melange import ipv4
 from melange import mac
 from melange.common import config
 from melange.common import exception
+from melange.common import metrics
 from melange.common import notifier
 from melange.common import utils
 
@@ -43,13 +46,15 @@ class ModelBase(object):
     on_create_notification_fields = []
     on_update_notification_fields = []
     on_delete_notification_fields = []
+    change_entity = None
 
     @classmethod
     def create(cls, **values):
         values['id'] = utils.generate_uuid()
         values['created_at'] = utils.utcnow()
-        instance = cls(**values).save()
-        instance._notify_fields("create")
+        with notifier.transaction():
+            instance = cls(**values).save()
+            instance._notify_fields("create")
         return instance
 
     def _notify_fields(self, event):
@@ -66,8 +71,9 @@ class ModelBase(object):
     def update(self, **values):
         attrs = utils.exclude(values, *self._auto_generated_attrs)
         self.merge_attributes(attrs)
-        result = self.save()
-        self._notify_fields("update")
+        with notifier.transaction():
+            result = self.save()
+            self._notify_fields("update")
         return result
 
     def save(self):
@@ -77,11 +83,18 @@ class ModelBase(object):
         self._before_save()
         self['updated_at'] = utils.utcnow()
         LOG.debug("Saving %s: %s" % (self.__class__.__name__, self.__dict__))
-        return db.db_api.save(self)
+        with Change.logged([self], Change.SAVE):
+            return db.db_api.save(self)
 
     def delete(self):
-        db.db_api.delete(self)
-        self._notify_fields("delete")
+        with notifier.transaction():
+            with Change.logged([self], Change.DELETE):
+                db.db_api.delete(self)
+            self._notify_fields("delete")
+
+    def change_scope(self):
+        """The tenant, network and device a logged change is filed under."""
+        return dict(tenant_id=None, network_id=None, device_id=None)
 
     def __init__(self, **kwargs):
         self.merge_attributes(kwargs)
@@ -191,9 +204,17 @@ class ModelBase(object):
     def __hash__(self):
         return self.id.__hash__()
 
-    def data(self, **options):
+    def data(self, fields=None, **options):
+        """Returns the data fields, or only those named in fields and id."""
+        return dict([(field, self[field])
+                     for field in self._data_field_names(fields)])
+
+    def _data_field_names(self, fields=None):
         data_fields = self._data_fields + self._auto_generated_attrs
-        return dict([(field, self[field]) for field in data_fields])
+        if fields is None:
+            return data_fields
+        return [field for field in data_fields
+                if field == 'id' or field in fields]
 
     def _validate_positive_integer(self, attribute_name):
         if utils.parse_int(self[attribute_name]) < 0:
@@ -255,6 +276,7 @@ class IpBlock(ModelBase):
                     'netmask', 'percent_used', 'ips_used', 'network_name']
     on_create_notification_fields = ['tenant_id', 'id', 'type', 'created_at']
     on_delete_notification_fields = ['tenant_id', 'id', 'type', 'created_at']
+    change_entity = "ip_block"
 
     @classmethod
     def find_allocated_ip(cls, ip_block_id, tenant_id, **conditions):
@@ -294,7 +316,28 @@ class IpBlock(ModelBase):
 
     @property
     def percent_used(self):
-        return (float(self.ips_used) / self.size()) * 100.0
+        return self._percent_of_size(self.ips_used)
+
+    def _percent_of_size(self, ips_used):
+        return (float(ips_used) / self.size()) * 100.0
+
+    def data(self, fields=None, **options):
+        usage_fields = ['ips_used', 'percent_used']
+        names = self._data_field_names(fields)
+        data = dict([(field, self[field]) for field in names
+                     if field not in usage_fields])
+        if 'ips_used' in names or 'percent_used' in names:
+            ips_used = self.ips_used
+            if 'ips_used' in names:
+                data['ips_used'] = ips_used
+            if 'percent_used' in names:
+                data['percent_used'] = self._percent_of_size(ips_used)
+        return data
+
+    def change_scope(self):
+        return dict(tenant_id=self.tenant_id,
+                    network_id=self.network_id,
+                    device_id=None)
 
     def is_ipv6(self):
         return netaddr.IPNetwork(self.cidr).version == 6
@@ -310,12 +353,52 @@ class IpBlock(ModelBase):
             return []
         return filter(lambda block: block != self, self.parent.subnets())
 
-    def delete(self):
-        for block in self.subnets():
-            block.delete()
-        IpAddress.find_all(ip_block_id=self.id).delete()
-        ipv4.plugin().get_generator(self).delete()
-        super(IpBlock, self).delete()
+    def delete(self, progress=None):
+        """Deletes the block with its whole subtree of subnets.
+
+        Subnets are collected one tree level per query and deleted deepest
+        level first, in chunks of ip_block_delete_chunk_size blocks with a
+        fixed number of statements per chunk, so no transaction holds locks
+        on the whole subtree. progress, if given, is called with the number
+        of blocks deleted so far and the size of the subtree after each
+        chunk.
+
+        """
+        chunk_size = int(config.Config.get('ip_block_delete_chunk_size',
+                                           500))
+        levels = self._subtree_levels()
+        total = sum(len(level) for level in levels)
+        deleted = 0
+        for level in reversed(levels):
+            for blocks in utils.chunks(level, chunk_size):
+                with notifier.transaction():
+                    self._delete_generators(blocks)
+                    with Change.logged(blocks, Change.DELETE):
+                        db.db_api.delete_ip_blocks([block.id
+                                                    for block in blocks])
+                    with notifier.batch():
+                        for block in blocks:
+                            block._notify_fields("delete")
+                deleted += len(blocks)
+                if progress:
+                    progress(deleted, total)
+
+    def _subtree_levels(self):
+        levels = [[self]]
+        while levels[-1]:
+            parent_ids = [block.id for block in levels[-1]]
+            levels.append(db.db_api.find_all_in(IpBlock,
+                                                'parent_id',
+                                                parent_ids))
+        return levels[:-1]
+
+    def _delete_generators(self, blocks):
+        plugin = ipv4.plugin()
+        if hasattr(plugin, "delete_generators"):
+            plugin.delete_generators(blocks)
+        else:
+            for block in blocks:
+                plugin.get_generator(block).delete()
 
     def policy(self):
         return Policy.get(self.policy_id)
@@ -372,6 +455,7 @@ class IpBlock(ModelBase):
                                         interface_id=interface.id)
             except exception.DBConstraintError as error:
                 LOG.debug("IP allocation retry count :{0}".format(retries + 1))
+                metrics.increment("ipam.ip_allocation_retries")
                 LOG.exception(error)
 
         raise ConcurrentAllocationError(
@@ -442,13 +526,18 @@ class IpBlock(ModelBase):
             ip_address.deallocate()
 
     def delete_deallocated_ips(self, deallocated_by_func):
-        for ip in db.db_api.find_deallocated_ips(
-                deallocated_by=deallocated_by_func(), ip_block_id=self.id):
-            LOG.debug("Deleting deallocated IP: %s" % ip)
-            generator = ipv4.plugin().get_generator(self)
-            generator.ip_removed(ip.address)
-            ip.delete()
-        self.update(is_full=False)
+        generator = ipv4.plugin().get_generator(self)
+        # NOTE: the batch is sent inside the transaction, so that with the
+        # outbox notifier it is written along with the deletes.
+        with notifier.transaction():
+            with notifier.batch():
+                for ip in db.db_api.find_deallocated_ips(
+                        deallocated_by=deallocated_by_func(),
+                        ip_block_id=self.id):
+                    LOG.debug("Deleting deallocated IP: %s" % ip)
+                    generator.ip_removed(ip.address)
+                    ip.delete()
+            self.update(is_full=False)
 
     def subnet(self, cidr, network_id=None, tenant_id=None,
                network_name=None):
@@ -586,6 +675,7 @@ class IpAddress(ModelBase):
     on_delete_notification_fields = ['used_by_tenant_id', 'id', 'ip_block_id',
                                      'used_by_device_id', 'created_at',
                                      'address']
+    change_entity = "ip_address"
 
     def _validate(self):
         self._validate_presence_of("used_by_tenant_id")
@@ -677,6 +767,12 @@ class IpAddress(ModelBase):
     def remove_inside_locals(self, inside_local_address=None):
         return db.db_api.remove_inside_locals(self.id, inside_local_address)
 
+    def change_scope(self):
+        return dict(tenant_id=self.used_by_tenant_id,
+                    network_id=(self.ip_block.network_id
+                                if self.ip_block else None),
+                    device_id=self.used_by_device_id)
+
     def locked(self):
         return self.marked_for_deallocation
 
@@ -688,6 +784,17 @@ class IpAddress(ModelBase):
     def interface(self):
         return Interface.get(self.interface_id)
 
+    @classmethod
+    def load_interfaces(cls, ips):
+        """Fetches the interfaces of ips in one query instead of one each."""
+        interface_ids = list(set(ip.interface_id for ip in ips))
+        interfaces = dict((interface.id, interface) for interface
+                          in db.db_api.find_all_in(Interface, 'id',
+                                                   interface_ids))
+        for ip in ips:
+            ip.interface = interfaces.get(ip.interface_id)
+        return ips
+
     @property
     def virtual_interface_id(self):
         return self.interface.virtual_interface_id if self.interface else None
@@ -701,12 +808,19 @@ class IpAddress(ModelBase):
         if self.interface:
             return self.interface.device_id
 
-    def data(self, **options):
-        data = super(IpAddress, self).data(**options)
-        iface = self.interface
-        data['used_by_tenant'] = iface.tenant_id
-        data['used_by_device'] = iface.device_id
-        data['interface_id'] = iface.virtual_interface_id
+    def data(self, fields=None, **options):
+        data = super(IpAddress, self).data(fields=fields, **options)
+        interface_fields = dict(used_by_tenant='tenant_id',
+                                used_by_device='device_id',
+                                interface_id='virtual_interface_id')
+        if fields is not None:
+            interface_fields = dict((field, attribute) for field, attribute
+                                    in interface_fields.items()
+                                    if field in fields)
+        if interface_fields:
+            iface = self.interface
+            for field, attribute in interface_fields.items():
+                data[field] = iface[attribute]
         return data
 
     def __str__(self):
@@ -716,11 +830,18 @@ class IpAddress(ModelBase):
 class IpRoute(ModelBase):
 
     _data_fields = ['destination', 'netmask', 'gateway']
+    change_entity = "ip_route"
 
     def _validate(self):
         self._validate_presence_of("destination", "gateway")
         self._validate_existence_of("source_block_id", IpBlock)
 
+    def change_scope(self):
+        source_block = IpBlock.get(self.source_block_id)
+        if source_block is None:
+            return super(IpRoute, self).change_scope()
+        return source_block.change_scope()
+
 
 class MacAddressRange(ModelBase):
 
@@ -755,6 +876,7 @@ class MacAddressRange(ModelBase):
                                          **kwargs)
             except exception.DBConstraintError as error:
                 LOG.debug("MAC allocation retry count:{0}".format(retries + 1))
+                metrics.increment("ipam.mac_allocation_retries")
                 LOG.exception(error)
                 if generator.is_full():
                     raise NoMoreMacAddressesError()
@@ -818,10 +940,35 @@ class MacAddress(ModelBase):
         if self.mac_address_range_id:
             return MacAddressRange.find(self.mac_address_range_id)
 
+    @classmethod
+    def free_all_of_interfaces(cls, interface_ids):
+        """Hands the macs of the interfaces back to their ranges' generators.
+
+        The mac rows themselves are left for the caller to delete.
+
+        """
+        addresses_by_range = {}
+        for mac_address in db.db_api.find_all_in(cls, 'interface_id',
+                                                 interface_ids):
+            if mac_address.mac_address_range_id:
+                addresses_by_range.setdefault(
+                    mac_address.mac_address_range_id,
+                    []).append(mac_address.address)
+
+        for range_id, addresses in addresses_by_range.iteritems():
+            generator = mac.plugin().get_generator(
+                MacAddressRange.find(range_id))
+            if hasattr(generator, "macs_removed"):
+                generator.macs_removed(addresses)
+            else:
+                for address in addresses:
+                    generator.mac_removed(address)
+
 
 class Interface(ModelBase):
 
     _data_fields = ["device_id", "tenant_id"]
+    change_entity = "interface"
 
     @classmethod
     def find_or_configure(cls, virtual_interface_id=None, device_id=None,
@@ -840,17 +987,125 @@ class Interface(ModelBase):
     def create_and_allocate_ips(cls,
                                 device_id=None,
                                 network_params=None,
+                                networks=None,
                                 **kwargs):
+        """Creates an interface and allocates ips on its network.
+
+        networks is an optional dict used to look each network up only once
+        across many calls, keyed by (network id, network tenant id).
+
+        """
         interface = Interface.create_and_configure(device_id=device_id,
                                                    **kwargs)
 
         if network_params:
-            network = Network.find_or_create_by(
-                network_params.pop('id'),
-                network_params.pop('tenant_id'))
-            network.allocate_ips(interface=interface, **network_params)
+            interface._allocate_ips(network_params, networks)
         return interface
 
+    @classmethod
+    def reconcile(cls, device_id, tenant_id, requested, networks=None):
+        """Makes the interfaces of a device match the requested ones.
+
+        Existing interfaces that already match a request are left alone, so
+        repeating a request only reads. Interfaces that match on virtual
+        interface id and mac but not on network get their ips reallocated.
+        The remaining interfaces are deleted and the remaining requests
+        created. Returns the interfaces in the requested order.
+
+        """
+        requested = [utils.stringify_keys(params) for params in requested]
+        existing = cls.find_all(device_id=device_id).all()
+        interfaces = [None] * len(requested)
+
+        for match, reallocate in [(cls._matches, False),
+                                  (cls._matches_except_network, True)]:
+            for index, params in enumerate(requested):
+                if interfaces[index] is not None:
+                    continue
+                interface = utils.find(
+                    lambda iface: match(iface, tenant_id, **params),
+                    existing)
+                if interface is None:
+                    continue
+                existing.remove(interface)
+                if reallocate:
+                    interface._reallocate_ips(params.get('network'), networks)
+                interfaces[index] = interface
+
+        cls.delete_all(existing)
+
+        for index, params in enumerate(requested):
+            if interfaces[index] is None:
+                params = params.copy()
+                network_params = utils.stringify_keys(params.pop('network',
+                                                                 None))
+                interfaces[index] = cls.create_and_allocate_ips(
+                    device_id=device_id,
+                    network_params=network_params,
+                    networks=networks,
+                    tenant_id=tenant_id,
+                    **params)
+        return interfaces
+
+    def _allocate_ips(self, network_params, networks=None):
+        network_params = network_params.copy()
+        network_key = (network_params.pop('id'),
+                       network_params.pop('tenant_id'))
+        if networks is None:
+            network = Network.find_or_create_by(*network_key)
+        else:
+            if network_key not in networks:
+                networks[network_key] = Network.find_or_create_by(
+                    *network_key)
+            network = networks[network_key]
+        network.allocate_ips(interface=self, **network_params)
+
+    def _reallocate_ips(self, network_params, networks=None):
+        self._deallocate_ips()
+        if network_params:
+            self._allocate_ips(utils.stringify_keys(network_params), networks)
+
+    def _deallocate_ips(self):
+        for ip in IpAddress.find_all_allocated_ips(interface_id=self.id):
+            ip.deallocate()
+
+    def _matches(self, tenant_id, network=None, **params):
+        return (self._matches_except_network(tenant_id, **params)
+                and self._matches_network(network))
+
+    def _matches_except_network(self, tenant_id, virtual_interface_id=None,
+                                mac_address=None, **params):
+        if (self.tenant_id != tenant_id
+                or self.vif_id_on_device != virtual_interface_id):
+            return False
+        if mac_address is None:
+            return True
+        try:
+            return (self.mac_address is not None
+                    and netaddr.EUI(self.mac_address.address)
+                    == netaddr.EUI(mac_address))
+        except netaddr.AddrFormatError:
+            return False
+
+    def _matches_network(self, network_params):
+        ips = IpAddress.find_all_allocated_ips(interface_id=self.id).all()
+        if not network_params:
+            return not ips
+        network_params = utils.stringify_keys(network_params)
+        if not ips or any(ip.ip_block.network_id != network_params.get('id')
+                          or ip.ip_block.tenant_id !=
+                          network_params.get('tenant_id')
+                          for ip in ips):
+            return False
+        if not network_params.get('addresses'):
+            return True
+        try:
+            return (set(netaddr.IPAddress(ip.address) for ip in ips)
+                    == set(netaddr.IPAddress(address)
+                           for address in network_params['addresses']))
+        except (netaddr.AddrFormatError, ValueError):
+            return False
+
     @classmethod
     def create_and_configure(cls, virtual_interface_id=None, device_id=None,
                              tenant_id=None, mac_address=None):
@@ -872,13 +1127,12 @@ class Interface(ModelBase):
         if mac:
             mac.delete()
 
-        for ip in IpAddress.find_all_allocated_ips(interface_id=self.id):
-            ip.deallocate()
+        self._deallocate_ips()
 
         super(Interface, self).delete()
 
     def data(self, **options):
-        data = super(Interface, self).data()
+        data = super(Interface, self).data(**options)
         data['id'] = self.virtual_interface_id
         return data
 
@@ -957,10 +1211,35 @@ class Interface(ModelBase):
         return self.vif_id_on_device or self.id
 
     @classmethod
-    def delete_by(self, **kwargs):
-        ifaces = Interface.find_all(**kwargs)
-        for iface in ifaces:
-            iface.delete()
+    def delete_by(cls, **kwargs):
+        cls.delete_all(cls.find_all(**kwargs).all())
+
+    @classmethod
+    def delete_all(cls, interfaces):
+        """Deletes interfaces in a fixed number of statements.
+
+        Does what delete does for each interface, but with set based
+        statements rather than row by row.
+
+        """
+        interface_ids = [interface.id for interface in interfaces]
+        if not interface_ids:
+            return
+        MacAddress.free_all_of_interfaces(interface_ids)
+        ips = (db.db_api.find_all_in(IpAddress, 'interface_id', interface_ids)
+               if Change.enabled() else [])
+        with Change.logged(interfaces, Change.DELETE):
+            with Change.logged(ips, Change.SAVE):
+                db.db_api.delete_interfaces(interface_ids, utils.utcnow())
+                # NOTE: logged as deallocate() would leave them.
+                for ip in ips:
+                    ip.interface_id = None
+                    ip.interface = None
+
+    def change_scope(self):
+        return dict(tenant_id=self.tenant_id,
+                    network_id=None,
+                    device_id=self.device_id)
 
 
 class Policy(ModelBase):
@@ -973,7 +1252,9 @@ class Policy(ModelBase):
     def delete(self):
         IpRange.find_all(policy_id=self.id).delete()
         IpOctet.find_all(policy_id=self.id).delete()
-        IpBlock.find_all(policy_id=self.id).update(policy_id=None)
+        blocks = IpBlock.find_all(policy_id=self.id).all()
+        with Change.logged(blocks, Change.SAVE):
+            IpBlock.find_all(policy_id=self.id).update(policy_id=None)
         super(Policy, self).delete()
 
     def create_unusable_range(self, **attributes):
@@ -1162,6 +1443,193 @@ class Network(ModelBase):
                 pass
 
 
+class Job(ModelBase):
+    """A long running operation carried out by a jobs.Worker."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+    _data_fields = ['action', 'tenant_id', 'status', 'progress', 'total',
+                    'message']
+
+    @classmethod
+    def create(cls, **values):
+        values['params'] = json.dumps(values.get('params') or {})
+        values['status'] = cls.QUEUED
+        values['progress'] = 0
+        values['attempts'] = 0
+        return super(Job, cls).create(**values)
+
+    @classmethod
+    def claimable(cls, limit):
+        return db.db_api.find_claimable_jobs(utils.utcnow(), limit)
+
+    def _validate(self):
+        self._validate_presence_of('action')
+
+    def parameters(self):
+        return utils.stringify_keys(json.loads(self.params))
+
+    def claim(self, worker):
+        lease_expires_at = self._lease_expiry()
+        if not db.db_api.claim_job(self.id, worker, lease_expires_at,
+                                   utils.utcnow()):
+            return False
+        self.merge_attributes(dict(status=self.RUNNING,
+                                   worker=worker,
+                                   lease_expires_at=lease_expires_at,
+                                   attempts=self.attempts + 1))
+        return True
+
+    def report_progress(self, progress, total):
+        """Records progress and extends the lease on the job."""
+        self.update(progress=progress,
+                    total=total,
+                    lease_expires_at=self._lease_expiry())
+
+    def complete(self):
+        self.update(status=self.COMPLETED,
+                    progress=self.total or self.progress,
+                    lease_expires_at=None)
+
+    def fail(self, message):
+        self.update(status=self.FAILED, message=message, lease_expires_at=None)
+
+    def _lease_expiry(self):
+        lease_seconds = int(config.Config.get('job_lease_seconds', 300))
+        return utils.utcnow() + datetime.timedelta(seconds=lease_seconds)
+
+
+class Change(object):
+    """The log of saved and deleted entities, numbered in commit order.
+
+    With record_changes set, saving or deleting an ip block, ip route,
+    interface or ip address adds an entry to the log in the same
+    transaction. Clients poll the entries after the last one they have
+    seen and fetch the entities named in them.
+
+    """
+
+    SAVE = "save"
+    DELETE = "delete"
+
+    @classmethod
+    def enabled(cls):
+        return utils.bool_from_string(config.Config.get('record_changes',
+                                                        'false'))
+
+    @classmethod
+    @contextlib.contextmanager
+    def logged(cls, models, action):
+        """Logs action on models along with the writes made in the block."""
+        models = [model for model in models if model.change_entity]
+        if not models or not cls.enabled():
+            yield
+            return
+        with db.db_api.transaction():
+            yield
+            now = utils.utcnow()
+            db.db_api.save_changes([cls._entry(model, action, now)
+                                    for model in models])
+
+    @classmethod
+    def _entry(cls, model, action, now):
+        # NOTE: the id is taken from data() as the api shows it, which for
+        # interfaces is the virtual interface id.
+        entry = dict(entity=model.change_entity,
+                     entity_id=model.data(fields=[])['id'],
+                     action=action,
+                     created_at=now)
+        entry.update(model.change_scope())
+        return entry
+
+    @classmethod
+    def find_since(cls, since, limit=200, tenant_id=None, network_id=None):
+        """Returns the latest change of each entity changed after since.
+
+        Entries younger than changes_settle_seconds are left for the next
+        poll, as their numbers may have been taken before those of entries
+        still being committed. Raises ChangesExpiredError if entries after
+        since have already been deleted.
+
+        """
+        oldest = db.db_api.oldest_change_id()
+        if oldest is not None and since < oldest - 1:
+            raise ChangesExpiredError(since=since)
+        latest = {}
+        for row in db.db_api.find_changes(since, limit, cls._settled_before(),
+                                          tenant_id=tenant_id,
+                                          network_id=network_id):
+            latest[(row.entity, row.entity_id)] = dict(
+                sequence=row.id,
+                entity=row.entity,
+                id=row.entity_id,
+                action=row.action,
+                tenant_id=row.tenant_id,
+                network_id=row.network_id,
+                device_id=row.device_id,
+                created_at=row.created_at)
+        return sorted(latest.values(), key=operator.itemgetter('sequence'))
+
+    @classmethod
+    def head(cls):
+        """The sequence to poll from to see every change made from now on."""
+        latest = db.db_api.latest_change_id(cls._settled_before())
+        if latest is not None:
+            return latest
+        oldest = db.db_api.oldest_change_id()
+        return oldest - 1 if oldest is not None else 0
+
+    @classmethod
+    def _settled_before(cls):
+        settle_seconds = float(config.Config.get('changes_settle_seconds',
+                                                 2))
+        return utils.utcnow() - datetime.timedelta(seconds=settle_seconds)
+
+    @classmethod
+    def delete_expired(cls):
+        keep_seconds = int(config.Config.get('keep_changes_for_seconds',
+                                             604800))
+        db.db_api.delete_changes(
+            utils.utcnow() - datetime.timedelta(seconds=keep_seconds))
+
+
+def export(tenant_id=None, batch_size=1000):
+    """Yields the data of a tenant's, or every tenant's, ipam entities.
+
+    Yields {'ip_block': ...}, {'ip_route': ...}, {'interface': ...} and
+    {'ip_address': ...} dicts, with the same fields as the api returns
+    except for block usage. Each kind is read by a single query, joined
+    with the interface or mac address its data includes, and fetched in
+    batches of batch_size rows as the caller iterates.
+
+    """
+    block_fields = [field for field in (IpBlock._data_fields
+                                        + IpBlock._auto_generated_attrs)
+                    if field not in ['ips_used', 'percent_used']]
+    for block in db.db_api.export_ip_blocks(tenant_id, batch_size):
+        yield {'ip_block': block.data(fields=block_fields)}
+
+    for route in db.db_api.export_ip_routes(tenant_id, batch_size):
+        data = route.data()
+        data['source_block_id'] = route.source_block_id
+        yield {'ip_route': data}
+
+    for interface, mac_address in db.db_api.export_interfaces(tenant_id,
+                                                              batch_size):
+        interface.mac_address = mac_address
+        data = interface.data()
+        data['mac_address'] = interface.mac_address_unix_format
+        yield {'interface': data}
+
+    for ip, interface in db.db_api.export_ip_addresses(tenant_id,
+                                                       batch_size):
+        ip.interface = interface
+        yield {'ip_address': ip.data()}
+
+
 def persisted_models():
     return {'IpBlock': IpBlock,
             'IpAddress': IpAddress,
@@ -1172,9 +1640,16 @@ def persisted_models():
             'MacAddressRange': MacAddressRange,
             'MacAddress': MacAddress,
             'Interface': Interface,
+            'Job': Job,
             }
 
 
+class ChangesExpiredError(exception.MelangeError):
+
+    message = _("Changes after %(since)s are no longer kept, request "
+                "changes without since and export the entities again")
+
+
 class DuplicateAddressError(exception.MelangeError):
 
     message = _("Address is already allocated")
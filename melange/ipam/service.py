@@ -15,14 +15,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import eventlet
 import logging
 import routes
+import time
+import webob.dec
 import webob.exc
 
+from melange import db
+from melange.common import config
 from melange.common import exception
+from melange.common import notifier
 from melange.common import pagination
+from melange.common import recording
 from melange.common import utils
 from melange.common import wsgi
+from melange.ipam import jobs
 from melange.ipam import models
 from melange.ipam import views
 
@@ -30,9 +38,21 @@ from melange.ipam import views
 LOG = logging.getLogger('melange.ipam.service')
 
 
+class ReplicaReadResource(wsgi.Resource):
+    """Serves GET requests from a read replica, when one is configured."""
+
+    @webob.dec.wsgify(RequestClass=wsgi.Request)
+    def __call__(self, request):
+        if request.method != "GET":
+            return super(ReplicaReadResource, self).__call__(request)
+        with db.db_api.replica_reads():
+            return super(ReplicaReadResource, self).__call__(request)
+
+
 class BaseController(wsgi.Controller):
 
     exclude_attr = []
+    resource_class = ReplicaReadResource
     exception_map = {
         webob.exc.HTTPUnprocessableEntity: [
             exception.NoMoreAddressesError,
@@ -46,6 +66,7 @@ class BaseController(wsgi.Controller):
         webob.exc.HTTPBadRequest: [
             models.InvalidModelError,
             exception.ParamsMissingError,
+            exception.InvalidParamsError,
         ],
         webob.exc.HTTPNotFound: [
             models.ModelNotFoundError,
@@ -54,6 +75,9 @@ class BaseController(wsgi.Controller):
             models.DuplicateAddressError,
             models.ConcurrentAllocationError,
         ],
+        webob.exc.HTTPGone: [
+            models.ChangesExpiredError,
+        ],
     }
 
     def _extract_required_params(self, params, model_name):
@@ -62,19 +86,52 @@ class BaseController(wsgi.Controller):
         return utils.stringify_keys(utils.exclude(model_params,
                                                   *self.exclude_attr))
 
+    def _error_data(self, error):
+        http_error = webob.exc.HTTPBadRequest
+        for http_error_class, errors in self.exception_map.iteritems():
+            if type(error) in errors:
+                http_error = http_error_class
+        return {'code': http_error.code,
+                'title': http_error.title,
+                'message': str(error)}
+
+    def _is_async(self, request):
+        return utils.bool_from_string(request.params.get('async', 'false'))
+
+    def _submit_job(self, action, tenant_id=None, **params):
+        if not jobs.enabled():
+            raise jobs.JobsDisabledError()
+        job = jobs.submit(action, tenant_id=tenant_id, **params)
+        return wsgi.Result(dict(job=job.data()), 202)
+
     def _extract_limits(self, params):
         return dict([(key, params[key]) for key in params.keys()
                      if key in ["limit", "marker"]])
 
-    def _paginated_response(self, collection_type, collection_query, request):
+    def _extract_fields(self, params):
+        """Returns data() options restricting it to ?fields=a,b if given."""
+        if not params.get('fields'):
+            return {}
+        return dict(fields=[field.strip()
+                            for field in params['fields'].split(",")])
+
+    def _paginated_response(self, collection_type, collection_query, request,
+                            preload=None):
         elements, next_marker = collection_query.paginated_collection(
             **self._extract_limits(request.params))
-        collection = [element.data() for element in elements]
+        if preload is not None:
+            preload(elements)
+        options = self._extract_fields(request.params)
+        # NOTE: the page's data is computed here, within the request's
+        # replica reads and statement count, so that a database error gets
+        # an error status; only writing the response is streamed.
+        collection = [element.data(**options) for element in elements]
 
         return wsgi.Result(pagination.PaginatedDataView(collection_type,
                                                         collection,
                                                         request.url,
-                                                        next_marker))
+                                                        next_marker,
+                                                        streaming=True))
 
 
 class DeleteAction:
@@ -84,11 +141,12 @@ class DeleteAction:
 
 class ShowAction:
     def show(self, request, **kwargs):
-        data = self._model.find_by(**kwargs).data()
+        data = self._model.find_by(**kwargs).data(
+            **self._extract_fields(request.params))
         return {utils.underscore(self._model.__name__): data}
 
 
-class IpBlockController(BaseController, DeleteAction, ShowAction):
+class IpBlockController(BaseController, ShowAction):
 
     exclude_attr = ['tenant_id', 'parent_id']
     _model = models.IpBlock
@@ -117,6 +175,14 @@ class IpBlockController(BaseController, DeleteAction, ShowAction):
         LOG.debug("Updated IP block %(id)s parameters: %(params)s" % locals())
         return wsgi.Result(dict(ip_block=ip_block.data()), 200)
 
+    def delete(self, request, id, tenant_id):
+        ip_block = self._find_block(id=id, tenant_id=tenant_id)
+        if self._is_async(request):
+            return self._submit_job("delete_ip_block",
+                                    tenant_id,
+                                    ip_block_id=ip_block.id)
+        ip_block.delete()
+
 
 class SubnetController(BaseController):
 
@@ -146,11 +212,15 @@ class IpAddressController(BaseController):
     def index(self, request, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
         addresses = models.IpAddress.find_all(ip_block_id=ip_block.id)
-        return self._paginated_response('ip_addresses', addresses, request)
+        return self._paginated_response(
+            'ip_addresses', addresses, request,
+            preload=models.IpAddress.load_interfaces)
 
     def show(self, request, address, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
-        return dict(ip_address=ip_block.find_ip(address=address).data())
+        ip_address = ip_block.find_ip(address=address)
+        return dict(ip_address=ip_address.data(
+            **self._extract_fields(request.params)))
 
     def delete(self, request, address, ip_block_id, tenant_id):
         ip_block = self._find_block(id=ip_block_id, tenant_id=tenant_id)
@@ -183,7 +253,67 @@ class AllocatedIpAddressesController(BaseController):
         if tenant_id:
             filter_conditions['used_by_tenant'] = tenant_id
         ips = models.IpAddress.find_all_allocated_ips(**filter_conditions)
-        return self._paginated_response('ip_addresses', ips, request)
+        return self._paginated_response(
+            'ip_addresses', ips, request,
+            preload=models.IpAddress.load_interfaces)
+
+
+class ChangesController(BaseController):
+
+    def index(self, request, tenant_id=None):
+        """Lists the entities changed after ?since, the last sequence seen.
+
+        With ?wait, waits up to that many seconds for a change before
+        responding with none. ?network_id lists only changes in a network.
+        Without ?since, responds with no changes and the current sequence.
+
+        """
+        if 'since' not in request.params:
+            return dict(changes=[], sequence=models.Change.head())
+        since = self._number_param(request.params, 'since', 0, convert=int)
+        limit = self._number_param(request.params, 'limit', 200,
+                                   convert=int, positive=True)
+        wait = self._number_param(request.params, 'wait', 0)
+        max_wait = float(config.Config.get('changes_max_wait_seconds', 60))
+        poll_interval = float(config.Config.get('changes_poll_interval', 1))
+        deadline = time.time() + min(wait, max_wait)
+        while True:
+            changes = models.Change.find_since(
+                since, limit, tenant_id=tenant_id,
+                network_id=request.params.get('network_id'))
+            if changes or time.time() >= deadline:
+                break
+            eventlet.sleep(min(poll_interval, deadline - time.time()))
+        sequence = changes[-1]['sequence'] if changes else since
+        return dict(changes=changes, sequence=sequence)
+
+
+class ExportController(BaseController):
+
+    def index(self, request, tenant_id=None):
+        """Streams the tenant's, or all tenants', entities as ndjson.
+
+        Each line is one ip block, ip route, interface or ip address, such
+        as {"ip_block": {...}}. The response is gzip compressed when the
+        request accepts it.
+
+        """
+        response = webob.Response(content_type="application/x-ndjson")
+        response.app_iter = self._ndjson_lines(tenant_id)
+        response.vary = ["Accept-Encoding"]
+        if "gzip" in request.accept_encoding:
+            response.app_iter = wsgi.gzip_chunks(response.app_iter)
+            response.content_encoding = "gzip"
+        return response
+
+    def _ndjson_lines(self, tenant_id):
+        # NOTE: the lines are produced after the resource has returned, so
+        # the export enters replica_reads itself.
+        serializer = wsgi.MelangeJSONDictSerializer()
+        batch_size = int(config.Config.get('export_batch_size', 1000))
+        with db.db_api.replica_reads():
+            for record in models.export(tenant_id, batch_size):
+                yield serializer.default(record) + "\n"
 
 
 class IpRoutesController(BaseController):
@@ -209,7 +339,8 @@ class IpRoutesController(BaseController):
                                               tenant_id=tenant_id)
         ip_route = models.IpRoute.find_by(id=id,
                                           source_block_id=source_block.id)
-        return dict(ip_route=ip_route.data())
+        return dict(ip_route=ip_route.data(
+            **self._extract_fields(request.params)))
 
     def delete(self, request, id, tenant_id, source_block_id):
         source_block = models.IpBlock.find_by(id=source_block_id,
@@ -298,7 +429,8 @@ class UnusableIpRangesController(BaseController):
     def show(self, request, policy_id, id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
         ip_range = policy.find_ip_range(id)
-        return dict(ip_range=ip_range.data())
+        return dict(ip_range=ip_range.data(
+            **self._extract_fields(request.params)))
 
     def index(self, request, policy_id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
@@ -334,7 +466,8 @@ class UnusableIpOctetsController(BaseController):
     def show(self, request, policy_id, id, tenant_id):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
         ip_octet = policy.find_ip_octet(id)
-        return dict(ip_octet=ip_octet.data())
+        return dict(ip_octet=ip_octet.data(
+            **self._extract_fields(request.params)))
 
     def update(self, request, policy_id, id, tenant_id, body=None):
         policy = models.Policy.find_by(id=policy_id, tenant_id=tenant_id)
@@ -349,7 +482,7 @@ class UnusableIpOctetsController(BaseController):
         ip_octet.delete()
 
 
-class PoliciesController(BaseController, ShowAction, DeleteAction):
+class PoliciesController(BaseController, ShowAction):
 
     exclude_attr = ['tenant_id']
     _model = models.Policy
@@ -368,6 +501,14 @@ class PoliciesController(BaseController, ShowAction, DeleteAction):
         policy.update(**self._extract_required_params(body, 'policy'))
         return dict(policy=policy.data())
 
+    def delete(self, request, id, tenant_id):
+        policy = models.Policy.find_by(id=id, tenant_id=tenant_id)
+        if self._is_async(request):
+            return self._submit_job("delete_policy",
+                                    tenant_id,
+                                    policy_id=policy.id)
+        policy.delete()
+
 
 class NetworksController(BaseController):
 
@@ -397,6 +538,11 @@ class InterfaceIpAllocationsController(BaseController):
     def bulk_delete(self, request, network_id, interface_id, tenant_id):
         network = models.Network.find_by(id=network_id, tenant_id=tenant_id)
         interface = models.Interface.find_by(vif_id_on_device=interface_id)
+        if self._is_async(request):
+            return self._submit_job("deallocate_ips",
+                                    tenant_id,
+                                    network_id=network.id,
+                                    interface_id=interface.id)
         network.deallocate_ips(interface_id=interface.id)
 
     def index(self, request, network_id, interface_id, tenant_id):
@@ -443,24 +589,70 @@ class InterfacesController(BaseController, ShowAction, DeleteAction):
 class InstanceInterfacesController(BaseController):
 
     def update_all(self, request, device_id, body=None):
-        models.Interface.delete_by(device_id=device_id)
-
         params = self._extract_required_params(body, 'instance')
-        tenant_id = params['tenant_id']
-        created_interfaces = []
-        for iface in params['interfaces']:
-
-            network_params = utils.stringify_keys(iface.pop('network', None))
-            interface = models.Interface.create_and_allocate_ips(
-                device_id=device_id,
-                network_params=network_params,
-                tenant_id=tenant_id,
-                **iface)
-
-            view_data = views.InterfaceConfigurationView(interface).data()
-            created_interfaces.append(view_data)
-
-        return {'instance': {'interfaces': created_interfaces}}
+        interfaces = self._replace_interfaces(device_id,
+                                              params['tenant_id'],
+                                              params['interfaces'])
+        return {'instance': {'interfaces': interfaces}}
+
+    def bulk_update(self, request, body=None):
+        """Replaces the interfaces of many instances in one request.
+
+        Networks are looked up once for the whole batch. Each instance is
+        updated in its own transaction, so a failure only affects its own
+        instance, which keeps its interfaces and is reported with an error
+        instead of its interface configurations.
+
+        """
+        body = body or {}
+        if 'instances' not in body:
+            raise exception.ParamsMissingError(_("instances are missing"))
+
+        with notifier.batch():
+            results = self._bulk_replace_interfaces(body['instances'])
+        return {'instances': results}
+
+    def _bulk_replace_interfaces(self, instances):
+        networks = {}
+        results = []
+        for instance in instances:
+            instance = utils.stringify_keys(instance)
+            device_id = instance.get('device_id')
+            if not device_id or 'tenant_id' not in instance:
+                error = exception.ParamsMissingError(
+                    _("device_id and tenant_id are required"))
+                results.append({'device_id': device_id,
+                                'error': self._error_data(error)})
+                continue
+            # NOTE: networks created for a failed instance are rolled back
+            # with it, so they only join the shared lookups on success.
+            device_networks = networks.copy()
+            try:
+                with db.db_api.transaction():
+                    interfaces = self._replace_interfaces(
+                        device_id,
+                        instance['tenant_id'],
+                        instance.get('interfaces', []),
+                        device_networks)
+            except exception.MelangeError as error:
+                LOG.debug("Failed to update interfaces of %s: %s"
+                          % (device_id, error))
+                results.append({'device_id': device_id,
+                                'error': self._error_data(error)})
+                continue
+            networks.update(device_networks)
+            results.append({'device_id': device_id,
+                            'interfaces': interfaces})
+        return results
+
+    def _replace_interfaces(self, device_id, tenant_id, interfaces,
+                            networks=None):
+        interfaces = models.Interface.reconcile(device_id,
+                                                tenant_id,
+                                                interfaces,
+                                                networks)
+        return [views.InterfaceConfigurationView(interface).data()
+                for interface in interfaces]
 
     def index(self, request, device_id):
         interfaces = models.Interface.find_all(device_id=device_id)
@@ -545,7 +737,8 @@ class InterfaceAllowedIpsController(BaseController):
         interface = models.Interface.find_by(
             vif_id_on_device=interface_id,
             tenant_id=tenant_id)
-        return dict(ip_addresses=[ip.data() for ip in interface.ips_allowed()])
+        ips = models.IpAddress.load_interfaces(interface.ips_allowed())
+        return dict(ip_addresses=[ip.data() for ip in ips])
 
     def create(self, request, interface_id, tenant_id, body=None):
         params = self._extract_required_params(body, 'allowed_ip')
@@ -563,7 +756,8 @@ class InterfaceAllowedIpsController(BaseController):
             vif_id_on_device=interface_id,
             tenant_id=tenant_id)
         ip = interface.find_allowed_ip(address)
-        return dict(ip_address=ip.data())
+        return dict(ip_address=ip.data(
+            **self._extract_fields(request.params)))
 
     def delete(self, request, interface_id, tenant_id, address):
         interface = models.Interface.find_by(
@@ -572,6 +766,14 @@ class InterfaceAllowedIpsController(BaseController):
         interface.disallow_ip(ip)
 
 
+class JobsController(BaseController, ShowAction):
+
+    _model = models.Job
+    # Jobs are polled right after being submitted, before a replica has
+    # necessarily caught up, so they are always read from the primary.
+    resource_class = wsgi.Resource
+
+
 class APICommon(wsgi.Router):
 
     def __init__(self):
@@ -589,6 +791,9 @@ class APICommon(wsgi.Router):
         self._ip_routes_mapper(mapper)
         self._instance_interface_mapper(mapper)
         self._mac_address_range_mapper(mapper)
+        self._jobs_mapper(mapper)
+        self._export_mapper(mapper)
+        self._changes_mapper(mapper)
 
     def _allocated_ips_mapper(self, mapper):
         allocated_ips_res = AllocatedIpAddressesController().create_resource()
@@ -603,6 +808,30 @@ class APICommon(wsgi.Router):
                  action="index",
                  conditions=dict(method=['GET']))
 
+    def _changes_mapper(self, mapper):
+        changes_res = ChangesController().create_resource()
+        _connect(mapper,
+                 "/ipam/changes",
+                 controller=changes_res,
+                 action="index",
+                 conditions=dict(method=['GET']))
+        _connect(mapper,
+                 "/ipam/tenants/{tenant_id}/changes",
+                 controller=changes_res,
+                 action="index",
+                 conditions=dict(method=['GET']))
+
+    def _export_mapper(self, mapper):
+        export_res = ExportController().create_resource()
+        mapper.connect("/ipam/export",
+                       controller=export_res,
+                       action="index",
+                       conditions=dict(method=['GET']))
+        mapper.connect("/ipam/tenants/{tenant_id}/export",
+                       controller=export_res,
+                       action="index",
+                       conditions=dict(method=['GET']))
+
     def _ip_routes_mapper(self, mapper):
         ip_routes_res = IpRoutesController().create_resource()
         path = ("/ipam/tenants/{tenant_id}/ip_blocks/{source_block_id}"
@@ -611,6 +840,11 @@ class APICommon(wsgi.Router):
 
     def _instance_interface_mapper(self, mapper):
         res = InstanceInterfacesController().create_resource()
+        _connect(mapper,
+                 "/ipam/instances",
+                 controller=res,
+                 action="bulk_update",
+                 conditions=dict(method=['PUT']))
         _connect(mapper,
                  "/ipam/instances/{device_id}/interfaces",
                  controller=res,
@@ -641,6 +875,19 @@ class APICommon(wsgi.Router):
         path = ("/ipam/mac_address_ranges")
         mapper.resource("mac_address_ranges", path, controller=range_res)
 
+    def _jobs_mapper(self, mapper):
+        jobs_res = JobsController().create_resource()
+        _connect(mapper,
+                 "/ipam/jobs/{id}",
+                 controller=jobs_res,
+                 action="show",
+                 conditions=dict(method=['GET']))
+        _connect(mapper,
+                 "/ipam/tenants/{tenant_id}/jobs/{id}",
+                 controller=jobs_res,
+                 action="show",
+                 conditions=dict(method=['GET']))
+
     def _policy_and_rules_mapper(self, mapper):
         policy_path = "/ipam/tenants/{tenant_id}/policies"
         ip_ranges_resource = UnusableIpRangesController().create_resource()
@@ -790,7 +1037,7 @@ class APIV01(APICommon):
 
     @classmethod
     def app_factory(cls, global_conf, **local_conf):
-        return APIV01()
+        return _api_app(APIV01(), global_conf, local_conf)
 
 
 class APIV10(APICommon):
@@ -816,7 +1063,14 @@ class APIV10(APICommon):
 
     @classmethod
     def app_factory(cls, global_conf, **local_conf):
-        return APIV10()
+        return _api_app(APIV10(), global_conf, local_conf)
+
+
+def _api_app(api, global_conf, local_conf):
+    # NOTE: the versioned composite routes to the api apps directly, so
+    # their middleware is applied here rather than in a paste pipeline.
+    recording_filter = recording.factory(global_conf, **local_conf)
+    return recording_filter(wsgi.QueryStatsMiddleware(api))
 
 
 def _connect(mapper, path, *args, **kwargs):
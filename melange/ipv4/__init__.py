@@ -15,27 +15,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import imp
-import os
-
 from melange.common import config
-
-_PLUGIN = None
+from melange.common import plugins
 
 
+@plugins.loader
 def plugin():
-    global _PLUGIN
-    if not _PLUGIN:
-        pluggable_generator_file = config.Config.get(
-            "ipv4_generator",
-            os.path.join(os.path.dirname(__file__),
-            "db_based_ip_generator/__init__.py"))
-
-        _PLUGIN = imp.load_source("pluggable_ip_generator",
-                                  pluggable_generator_file)
-    return _PLUGIN
+    generator = config.Config.get("ipv4_generator",
+                                  "melange.ipv4.db_based_ip_generator")
+    return plugins.load("melange.ipv4_generators", generator)
 
 
 def reset_plugin():
-    global _PLUGIN
-    _PLUGIN = None
+    plugins.reset("melange.ipv4_generators")
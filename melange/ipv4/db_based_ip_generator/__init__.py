@@ -34,3 +34,7 @@ def migrate_repo_path():
 
 def get_generator(ip_block):
     return generator.DbBasedIpGenerator(ip_block)
+
+
+def delete_generators(ip_blocks):
+    generator.DbBasedIpGenerator.delete_all(ip_blocks)
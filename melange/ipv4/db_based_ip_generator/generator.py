@@ -52,3 +52,9 @@ class DbBasedIpGenerator(object):
 
     def delete(self):
         models.AllocatableIp.find_all(ip_block_id=self.ip_block.id).delete()
+
+    @classmethod
+    def delete_all(cls, ip_blocks):
+        db_api.delete_all_in(models.AllocatableIp,
+                             'ip_block_id',
+                             [ip_block.id for ip_block in ip_blocks])
@@ -15,18 +15,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from sqlalchemy import MetaData
 from sqlalchemy import orm
-from sqlalchemy import Table
 
 from melange.db.sqlalchemy import mappers
+from melange.db.sqlalchemy import tables
 from melange.ipv4.db_based_ip_generator import models
 
 
 def map(engine):
     if mappers.mapping_exists(models.AllocatableIp):
         return
-    meta_data = MetaData()
-    meta_data.bind = engine
-    allocatable_ips_table = Table('allocatable_ips', meta_data, autoload=True)
-    orm.mapper(models.AllocatableIp, allocatable_ips_table)
+    orm.mapper(models.AllocatableIp, tables.allocatable_ips)
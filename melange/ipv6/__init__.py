@@ -17,15 +17,20 @@
 
 from melange.common import config
 from melange.common import exception
+from melange.common import plugins
 from melange.common import utils
 
 
-def address_generator_factory(cidr, **kwargs):
+@plugins.loader
+def generator_class():
     default_generator = "melange.ipv6.tenant_based_generator."\
                         "TenantBasedIpV6Generator"
-    ip_generator_class_name = config.Config.get("ipv6_generator",
-                                                default_generator)
-    ip_generator = utils.import_class(ip_generator_class_name)
+    return plugins.load("melange.ipv6_generators",
+                        config.Config.get("ipv6_generator", default_generator))
+
+
+def address_generator_factory(cidr, **kwargs):
+    ip_generator = generator_class()
     required_params = ip_generator.required_params\
         if hasattr(ip_generator, "required_params") else []
 
@@ -15,27 +15,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import imp
-import os
-
 from melange.common import config
-
-_PLUGIN = None
+from melange.common import plugins
 
 
+@plugins.loader
 def plugin():
-    global _PLUGIN
-    if not _PLUGIN:
-        pluggable_generator_file = config.Config.get(
-            "mac_generator",
-            os.path.join(os.path.dirname(__file__),
-            "db_based_mac_generator/__init__.py"))
-
-        _PLUGIN = imp.load_source("pluggable_mac_generator",
-                                  pluggable_generator_file)
-    return _PLUGIN
+    generator = config.Config.get("mac_generator",
+                                  "melange.mac.db_based_mac_generator")
+    return plugins.load("melange.mac_generators", generator)
 
 
 def reset_plugin():
-    global _PLUGIN
-    _PLUGIN = None
+    plugins.reset("melange.mac_generators")
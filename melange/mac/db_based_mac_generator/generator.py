@@ -15,6 +15,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from melange.common import utils
 from melange.db import db_api
 from melange.mac.db_based_mac_generator import models
 
@@ -44,3 +45,13 @@ class DbBasedMacGenerator(object):
         models.AllocatableMac.create(
             mac_address_range_id=self.mac_range.id,
             address=address)
+
+    def macs_removed(self, addresses):
+        now = utils.utcnow()
+        db_api.insert_all(models.AllocatableMac,
+                          [dict(id=utils.generate_uuid(),
+                                mac_address_range_id=self.mac_range.id,
+                                address=address,
+                                created_at=now,
+                                updated_at=now)
+                           for address in addresses])
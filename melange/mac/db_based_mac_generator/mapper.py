@@ -15,18 +15,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from sqlalchemy import MetaData
 from sqlalchemy import orm
-from sqlalchemy import Table
 
 from melange.db.sqlalchemy import mappers
+from melange.db.sqlalchemy import tables
 from melange.mac.db_based_mac_generator import models
 
 
 def map(engine):
     if mappers.mapping_exists(models.AllocatableMac):
         return
-    meta_data = MetaData()
-    meta_data.bind = engine
-    allocatable_mac_table = Table('allocatable_macs', meta_data, autoload=True)
-    orm.mapper(models.AllocatableMac, allocatable_mac_table)
+    orm.mapper(models.AllocatableMac, tables.allocatable_macs)
@@ -0,0 +1,92 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import re
+import routes
+import webob
+import webob.dec
+import webob.exc
+
+from melange.common import config
+from melange.common import exception
+from melange.common import metrics
+from melange.common import profiler
+from melange.common import wsgi
+
+
+class MetricsController(wsgi.Controller):
+
+    exception_map = {webob.exc.HTTPConflict: [profiler.ProfilerBusyError]}
+
+    def index(self, request):
+        """Respond with a snapshot of the server metrics.
+
+        ?format=text responds in the prometheus text exposition format.
+
+        """
+        snapshot = metrics.collect()
+        if request.params.get('format') == "text":
+            return webob.Response(body=metrics.exposition(snapshot),
+                                  content_type="text/plain",
+                                  charset="utf-8")
+        return {'metrics': snapshot}
+
+    def profile(self, request):
+        """Sample this process for ?seconds and respond with its stacks.
+
+        ?route restricts sampling to requests whose path matches the given
+        regular expression and ?interval sets the seconds of cpu time
+        between samples.
+
+        """
+        max_seconds = float(config.Config.get('profiler_max_seconds', 60))
+        seconds = min(self._number_param(request.params, 'seconds', 10,
+                                         positive=True),
+                      max_seconds)
+        interval = self._number_param(request.params, 'interval', 0.005,
+                                      positive=True)
+        route = request.params.get('route')
+        try:
+            sampler = profiler.SamplingProfiler(interval=interval, route=route)
+        except re.error:
+            raise exception.InvalidParamsError(param='route', value=route)
+        return webob.Response(body=sampler.profile(seconds),
+                              content_type="text/plain",
+                              charset="utf-8")
+
+
+class MetricsAPI(wsgi.Router):
+
+    def __init__(self):
+        mapper = routes.Mapper()
+        controller = MetricsController().create_resource()
+        mapper.connect("/", controller=controller,
+                       action="index", conditions=dict(method=['GET']))
+        mapper.connect("/profile", controller=controller,
+                       action="profile", conditions=dict(method=['POST']))
+        super(MetricsAPI, self).__init__(mapper)
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        # NOTE: urlmap strips the mount point, leaving an empty path for
+        # requests to the bare /metrics url which routes refuses to match.
+        req.path_info = req.path_info or "/"
+        return self._router
+
+
+def app_factory(global_conf, **local_conf):
+    return MetricsAPI()
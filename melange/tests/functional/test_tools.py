@@ -0,0 +1,74 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from melange import tests
+from melange.tests import functional
+
+
+def run_tool(name, arguments):
+    tool = os.path.join(tests.melange_root_path(), "tools", name)
+    return functional.execute("%s %s %s --config-file=%s"
+                              % (sys.executable, tool, arguments,
+                                 tests.test_config_file()))
+
+
+class TestBenchmarkAllocation(tests.BaseTest):
+
+    def setUp(self):
+        super(TestBenchmarkAllocation, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_compares_a_run_against_a_baseline(self):
+        arguments = ("sqlite:///%s --blocks 4 --policies 2 --addresses 10 "
+                     "--operations 5 --concurrency 2 --tolerance 1000"
+                     % os.path.join(self.tmp_dir, "benchmark.sqlite"))
+        baseline_file = os.path.join(self.tmp_dir, "baseline.json")
+
+        exitcode, out, err = run_tool("benchmark_allocation.py", arguments)
+        with open(baseline_file, "w") as baseline:
+            baseline.write(out)
+        exitcode, out, err = run_tool("benchmark_allocation.py",
+                                      "%s --baseline %s"
+                                      % (arguments, baseline_file))
+
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(json.loads(out)['dataset'],
+                         dict(blocks=4, policies=2, addresses=10))
+
+
+class TestLoadHarness(tests.BaseTest):
+
+    def setUp(self):
+        super(TestLoadHarness, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def test_prints_only_the_report(self):
+        exitcode, out, err = run_tool(
+            "load_harness.py",
+            "sqlite:///%s --instances 2 --networks 1 --concurrency 2"
+            % os.path.join(self.tmp_dir, "load.sqlite"))
+
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(json.loads(out)['concurrency'], 2)
@@ -54,3 +54,14 @@ class TestDbBasedMacGenerator(tests.BaseTest):
         allocatable_mac = mac_models.AllocatableMac.get_by(
             mac_address_range_id=rng.id)
         self.assertEqual(mac.address, allocatable_mac.address)
+
+    def test_macs_removed_pushes_all_addresses_on_allocatable_mac_list(self):
+        rng = factory_models.MacAddressRangeFactory(cidr="BC:76:4E:20:0:0/40")
+        addresses = [rng.allocate_mac().address, rng.allocate_mac().address]
+
+        generator.DbBasedMacGenerator(rng).macs_removed(addresses)
+
+        allocatable_macs = mac_models.AllocatableMac.find_all(
+            mac_address_range_id=rng.id).all()
+        self.assertEqual(sorted(mac.address for mac in allocatable_macs),
+                         sorted(addresses))
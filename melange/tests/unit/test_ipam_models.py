@@ -16,15 +16,19 @@
 #    under the License.
 
 import datetime
+import itertools
 import mox
 import netaddr
 
+from melange import db
 from melange import tests
 from melange.common import exception
 from melange.common import notifier
 from melange.common import utils
 from melange.db import db_query
+from melange.db.sqlalchemy import session
 from melange.ipam import models
+from melange.ipv4.db_based_ip_generator import models as ipv4_models
 from melange.tests import unit
 from melange.tests.factories import models as factory_models
 from melange.tests.unit import mock_generator
@@ -902,6 +906,26 @@ class TestIpBlock(tests.BaseTest):
         self.assertEqual(data['dns1'], ip_block.dns1)
         self.assertEqual(data['dns2'], ip_block.dns2)
 
+    def test_data_with_fields_computes_only_those_fields(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+
+        with db.db_api.statement_stats() as stats:
+            data = ip_block.data(fields=["cidr"])
+
+        self.assertEqual(data, dict(id=ip_block.id, cidr="10.0.0.0/29"))
+        self.assertEqual(stats.statements, 0)
+
+    def test_data_counts_used_ips_once(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        _allocate_ip(ip_block)
+
+        with db.db_api.statement_stats() as stats:
+            data = ip_block.data(fields=["ips_used", "percent_used"])
+
+        self.assertEqual(data['ips_used'], 1)
+        self.assertEqual(data['percent_used'], 12.5)
+        self.assertEqual(stats.statements, 1)
+
     def test_find_all_ip_blocks(self):
         factory_models.PrivateIpBlockFactory(cidr="10.2.0.0/28")
         factory_models.PrivateIpBlockFactory(cidr="10.3.0.0/28")
@@ -947,6 +971,45 @@ class TestIpBlock(tests.BaseTest):
         self.assertIsNone(models.IpAddress.get(ip1.id))
         self.assertIsNone(models.IpAddress.get(ip2.id))
 
+    def test_delete_subnet_tree_in_chunks(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/28")
+        subnets = [ip_block.subnet("10.0.0.%d/30" % offset)
+                   for offset in range(0, 16, 4)]
+        subnet_of_subnet = subnets[0].subnet("10.0.0.0/31")
+
+        with unit.StubConfig(ip_block_delete_chunk_size=3):
+            ip_block.delete()
+
+        for block in [ip_block, subnet_of_subnet] + subnets:
+            self.assertIsNone(models.IpBlock.get(block.id))
+
+    def test_delete_removes_routes_nats_and_allowed_ips_of_addresses(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        subnet = ip_block.subnet("10.0.0.0/30")
+        other_block = factory_models.PublicIpBlockFactory(cidr="20.0.0.0/29")
+        interface = factory_models.InterfaceFactory()
+        local_ip = _allocate_ip(subnet)
+        global_ip = _allocate_ip(other_block)
+        global_ip.add_inside_locals([local_ip])
+        db.db_api.save_allowed_ip(interface.id, local_ip.id)
+        route = factory_models.IpRouteFactory(source_block_id=subnet.id)
+        freed_ip = _allocate_ip(subnet)
+        freed_ip.deallocate()
+        subnet.delete_deallocated_ips(utils.utcnow)
+        self.assertEqual(len(ipv4_models.AllocatableIp.find_all(
+            ip_block_id=subnet.id).all()), 1)
+
+        ip_block.delete()
+
+        self.assertIsNone(models.IpAddress.get(local_ip.id))
+        self.assertIsNone(models.IpRoute.get(route.id))
+        self.assertEqual(global_ip.inside_locals().all(), [])
+        self.assertEqual(db_query.find_allowed_ips(
+            models.IpAddress, allowed_on_interface_id=interface.id).all(), [])
+        self.assertEqual(ipv4_models.AllocatableIp.find_all(
+            ip_block_id=subnet.id).all(), [])
+        self.assertIsNotNone(models.IpAddress.get(global_ip.id))
+
     def test_contains_address(self):
         ip_block = models.IpBlock(cidr="10.0.0.0/20")
 
@@ -1281,6 +1344,24 @@ class TestIpAddress(tests.BaseTest):
         self.assertItemsEqual(globals_left,
                               [ip.address for ip in global_ips[1:5]])
 
+    def test_remove_inside_globals_reads_primary_inside_replica_reads(self):
+        global_block = factory_models.PrivateIpBlockFactory(cidr="192.0.0.1/8")
+        local_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
+        global_ips = [_allocate_ip(global_block) for i in range(2)]
+        local_ip = _allocate_ip(local_block)
+        local_ip.add_inside_globals(global_ips)
+        replica = session.ReadReplica(session.create_engine("sqlite://"),
+                                      max_staleness=5, check_interval=60)
+        self.mock.stubs.Set(session, "_READ_ENGINES", [replica])
+        self.mock.stubs.Set(session, "_READ_ENGINE_CYCLE",
+                            itertools.cycle([replica]))
+
+        with db.db_api.replica_reads():
+            local_ip.remove_inside_globals(global_ips[0].address)
+
+        globals_left = [ip.address for ip in local_ip.inside_globals()]
+        self.assertEqual(globals_left, [global_ips[1].address])
+
     def test_remove_inside_locals_for_specific_address(self):
         global_block = factory_models.PrivateIpBlockFactory(cidr="192.0.0.1/8")
         local_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
@@ -1324,6 +1405,22 @@ class TestIpAddress(tests.BaseTest):
         self.assertEqual(data['created_at'], ip.created_at)
         self.assertEqual(data['updated_at'], ip.updated_at)
 
+    def test_data_with_fields_loads_interface_only_if_needed(self):
+        ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
+        interface = factory_models.InterfaceFactory()
+        ip = factory_models.IpAddressFactory(ip_block_id=ip_block.id,
+                                             interface_id=interface.id)
+
+        with db.db_api.statement_stats() as stats:
+            address_data = ip.data(fields=["address"])
+        device_data = ip.data(fields=["address", "used_by_device"])
+
+        self.assertEqual(address_data, dict(id=ip.id, address=ip.address))
+        self.assertEqual(stats.statements, 0)
+        self.assertEqual(device_data, dict(id=ip.id,
+                                           address=ip.address,
+                                           used_by_device=interface.device_id))
+
     def test_deallocate(self):
         ip_block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.1/8")
         ip_address = _allocate_ip(ip_block)
@@ -2429,6 +2526,48 @@ class TestInterface(tests.BaseTest):
         self.assertTrue(models.IpAddress.get(
                         iface1_ip.id).marked_for_deallocation)
 
+    def test_delete_by_frees_mac_addresses_of_all_interfaces(self):
+        mac_range = factory_models.MacAddressRangeFactory()
+        interface1 = factory_models.InterfaceFactory(device_id="instance1")
+        interface2 = factory_models.InterfaceFactory(device_id="instance1")
+        mac1 = mac_range.allocate_mac(interface_id=interface1.id)
+        mac2 = mac_range.allocate_mac(interface_id=interface2.id)
+
+        models.Interface.delete_by(device_id="instance1")
+
+        self.assertIsNone(models.MacAddress.get(mac1.id))
+        self.assertIsNone(models.MacAddress.get(mac2.id))
+        self.assertEqual(sorted([mac_range.allocate_mac().address,
+                                 mac_range.allocate_mac().address]),
+                         sorted([mac1.address, mac2.address]))
+
+    def test_delete_by_forgets_ips_allowed_on_interfaces(self):
+        interface = factory_models.InterfaceFactory(device_id="instance1")
+        block = factory_models.IpBlockFactory(network_id="net1")
+        block.allocate_ip(interface)
+        other_ip = block.allocate_ip(factory_models.InterfaceFactory())
+        interface.allow_ip(other_ip)
+
+        models.Interface.delete_by(device_id="instance1")
+
+        self.assertEqual(db_query.find_allowed_ips(
+            models.IpAddress, allowed_on_interface_id=interface.id).all(), [])
+
+    def test_delete_by_leaves_other_devices_untouched(self):
+        block = factory_models.IpBlockFactory(network_id="net1")
+        mac_range = factory_models.MacAddressRangeFactory()
+        noise_interface = factory_models.InterfaceFactory(device_id="ins")
+        noise_ip = block.allocate_ip(noise_interface)
+        noise_mac = mac_range.allocate_mac(interface_id=noise_interface.id)
+        factory_models.InterfaceFactory(device_id="instance1")
+
+        models.Interface.delete_by(device_id="instance1")
+
+        self.assertIsNotNone(models.Interface.get(noise_interface.id))
+        self.assertFalse(models.IpAddress.get(
+            noise_ip.id).marked_for_deallocation)
+        self.assertIsNotNone(models.MacAddress.get(noise_mac.id))
+
 
 class TestAllowedIp(tests.BaseTest):
 
@@ -2604,6 +2743,168 @@ class TestAllowedIp(tests.BaseTest):
                                     ip)
 
 
+class TestChange(tests.BaseTest):
+
+    def setUp(self):
+        super(TestChange, self).setUp()
+        self.config = unit.StubConfig(record_changes="true",
+                                      changes_settle_seconds=0)
+        self.config.__enter__()
+
+    def tearDown(self):
+        self.config.__exit__(None, None, None)
+        super(TestChange, self).tearDown()
+
+    def test_saving_and_deleting_entities_logs_changes(self):
+        block = factory_models.IpBlockFactory(tenant_id="tnt1",
+                                              network_id="net1")
+        interface = factory_models.InterfaceFactory(tenant_id="tnt1",
+                                                    device_id="device1")
+        ip = _allocate_ip(block, interface=interface)
+        route = factory_models.IpRouteFactory(source_block_id=block.id)
+        route.delete()
+
+        changes = dict((change['entity'], change)
+                       for change in models.Change.find_since(0))
+
+        self.assertEqual(sorted((change['entity'], change['id'],
+                                 change['action'])
+                                for change in changes.values()),
+                         sorted([("ip_block", block.id, "save"),
+                                 ("interface", interface.virtual_interface_id,
+                                  "save"),
+                                 ("ip_address", ip.id, "save"),
+                                 ("ip_route", route.id, "delete")]))
+        self.assertEqual(changes['ip_address']['tenant_id'], "tnt1")
+        self.assertEqual(changes['ip_address']['network_id'], "net1")
+        self.assertEqual(changes['ip_address']['device_id'], "device1")
+        self.assertEqual(changes['ip_route']['network_id'], "net1")
+
+    def test_logs_nothing_unless_enabled(self):
+        with unit.StubConfig(record_changes="false"):
+            factory_models.IpBlockFactory()
+
+        self.assertEqual(models.Change.find_since(0), [])
+
+    def test_find_since_returns_changes_after_since(self):
+        factory_models.IpBlockFactory()
+        sequence = models.Change.find_since(0)[-1]['sequence']
+        block = factory_models.IpBlockFactory()
+
+        changes = models.Change.find_since(sequence)
+
+        self.assertEqual([change['id'] for change in changes], [block.id])
+        self.assertEqual(changes[0]['sequence'], sequence + 1)
+
+    def test_find_since_returns_latest_change_of_each_entity(self):
+        block = factory_models.IpBlockFactory()
+        other_block = factory_models.IpBlockFactory()
+        block.update(network_id="net2")
+        block.delete()
+
+        changes = models.Change.find_since(0)
+
+        self.assertEqual([(change['id'], change['action'])
+                          for change in changes],
+                         [(other_block.id, "save"), (block.id, "delete")])
+
+    def test_find_since_filters_by_tenant_and_network(self):
+        block = factory_models.IpBlockFactory(tenant_id="tnt1",
+                                              network_id="net1")
+        factory_models.IpBlockFactory(tenant_id="tnt1", network_id="net2")
+        factory_models.IpBlockFactory(tenant_id="tnt2", network_id="net1")
+
+        changes = models.Change.find_since(0, tenant_id="tnt1",
+                                           network_id="net1")
+
+        self.assertEqual([change['id'] for change in changes], [block.id])
+
+    def test_find_since_leaves_changes_younger_than_settle_time(self):
+        factory_models.IpBlockFactory()
+
+        with unit.StubConfig(changes_settle_seconds=60):
+            self.assertEqual(models.Change.find_since(0), [])
+
+    def test_head_is_the_latest_settled_change(self):
+        with unit.StubTime(time=utils.utcnow()
+                           - datetime.timedelta(seconds=120)):
+            factory_models.IpBlockFactory()
+        sequence = models.Change.find_since(0)[-1]['sequence']
+        block = factory_models.IpBlockFactory()
+
+        with unit.StubConfig(changes_settle_seconds=60):
+            self.assertEqual(models.Change.head(), sequence)
+        self.assertEqual([change['id'] for change in
+                          models.Change.find_since(sequence)], [block.id])
+
+    def test_head_of_an_empty_log(self):
+        self.assertEqual(models.Change.head(), 0)
+
+        factory_models.IpBlockFactory()
+
+        with unit.StubConfig(changes_settle_seconds=60):
+            self.assertEqual(models.Change.head(), 0)
+
+    def test_find_since_reads_primary_inside_replica_reads(self):
+        block = factory_models.IpBlockFactory()
+        replica = session.ReadReplica(session.create_engine("sqlite://"),
+                                      max_staleness=5, check_interval=60)
+        self.mock.stubs.Set(session, "_READ_ENGINES", [replica])
+        self.mock.stubs.Set(session, "_READ_ENGINE_CYCLE",
+                            itertools.cycle([replica]))
+
+        with db.db_api.replica_reads():
+            changes = models.Change.find_since(0)
+
+        self.assertEqual([change['id'] for change in changes], [block.id])
+
+    def test_bulk_interface_delete_logs_changes(self):
+        block = factory_models.IpBlockFactory(network_id="net1")
+        interface = factory_models.InterfaceFactory(device_id="device1")
+        ip = _allocate_ip(block, interface=interface)
+        sequence = models.Change.find_since(0)[-1]['sequence']
+
+        models.Interface.delete_by(device_id="device1")
+
+        changes = models.Change.find_since(sequence)
+        self.assertEqual([(change['id'], change['action'])
+                          for change in changes],
+                         [(ip.id, "save"),
+                          (interface.virtual_interface_id, "delete")])
+        self.assertEqual([change['id'] for change in
+                          models.Change.find_since(sequence,
+                                                   network_id="net1")],
+                         [ip.id])
+
+    def test_policy_delete_logs_changes_of_its_blocks(self):
+        policy = factory_models.PolicyFactory()
+        block = factory_models.IpBlockFactory(policy_id=policy.id)
+        factory_models.IpBlockFactory()
+        sequence = models.Change.find_since(0)[-1]['sequence']
+
+        policy.delete()
+
+        self.assertEqual([(change['id'], change['action'])
+                          for change in models.Change.find_since(sequence)],
+                         [(block.id, "save")])
+
+    def test_find_since_raises_if_changes_were_deleted(self):
+        with unit.StubTime(time=utils.utcnow()
+                           - datetime.timedelta(seconds=120)):
+            factory_models.IpBlockFactory()
+            factory_models.IpBlockFactory()
+        block = factory_models.IpBlockFactory()
+        sequence = models.Change.find_since(0)[-1]['sequence']
+
+        with unit.StubConfig(keep_changes_for_seconds=60):
+            models.Change.delete_expired()
+
+        self.assertRaises(models.ChangesExpiredError,
+                          models.Change.find_since, 0)
+        self.assertEqual([change['id'] for change in
+                          models.Change.find_since(sequence - 1)], [block.id])
+
+
 def _allocate_ip(block, interface=None, **kwargs):
     interface = interface or factory_models.InterfaceFactory()
     return block.allocate_ip(interface=interface, **kwargs)
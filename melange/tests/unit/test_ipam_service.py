@@ -14,13 +14,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import json
 import string
 import unittest
+import zlib
 
 import netaddr
 import routes
 import webob.exc
 
+from melange import db
 from melange import ipv6
 from melange import tests
 from melange.common import config
@@ -39,6 +43,12 @@ class ControllerTestBase(tests.BaseTest):
 
     def setUp(self):
         super(ControllerTestBase, self).setUp()
+        # NOTE: a backstop failing requests that run wildly many
+        # statements; TestListingStatementCounts checks listings per row.
+        query_budget = unit.StubConfig(sql_query_budget=100,
+                                       sql_query_budget_action="fail")
+        query_budget.__enter__()
+        self.addCleanup(query_budget.__exit__, None, None, None)
         conf, melange_v0_1 = config.Config.load_paste_app(
             'melangeapp_v0_1',
             {"config_file": tests.test_config_file()}, None)
@@ -234,6 +244,31 @@ class TestIpBlockController(ControllerTestBase):
                           models.IpBlock.find,
                           block.id)
 
+    def test_delete_async_queues_a_job(self):
+        block = factory_models.IpBlockFactory()
+        with unit.StubConfig(job_workers=1):
+            response = self.app.delete("%s/%s?async=true"
+                                       % (self.ip_block_path, block.id))
+
+        job = models.Job.find_by(action="delete_ip_block")
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(response.json, dict(job=_data(job)))
+        self.assertEqual(job.parameters(), dict(ip_block_id=block.id))
+        self.assertIsNotNone(models.IpBlock.get(block.id))
+
+    def test_delete_async_fails_without_job_workers(self):
+        block = factory_models.IpBlockFactory()
+        with unit.StubConfig(job_workers=0):
+            response = self.app.delete("%s/%s?async=true"
+                                       % (self.ip_block_path, block.id),
+                                       status="*")
+
+        self.assertErrorResponse(response, webob.exc.HTTPBadRequest,
+                                 "Jobs are disabled, no job_workers are "
+                                 "configured")
+        self.assertIsNone(models.Job.get_by(action="delete_ip_block"))
+        self.assertIsNotNone(models.IpBlock.get(block.id))
+
     def test_index(self):
         blocks = [factory_models.PublicIpBlockFactory(cidr="192.1.1.1/30",
                                                       network_id="1"),
@@ -248,6 +283,45 @@ class TestIpBlockController(ControllerTestBase):
         self.assertEqual(len(response_blocks), 3)
         self.assertItemsEqual(response_blocks, _data(blocks))
 
+    def test_index_returns_only_requested_fields(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="192.2.2.2/30")
+
+        response = self.app.get(self.ip_block_path, {'fields': "cidr,type"})
+
+        self.assertEqual(response.json['ip_blocks'],
+                         [dict(id=block.id, cidr=block.cidr, type="private")])
+
+    def test_show_returns_only_requested_fields(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="192.2.2.2/30")
+
+        response = self.app.get("%s/%s" % (self.ip_block_path, block.id),
+                                {'fields': "cidr"})
+
+        self.assertEqual(response.json['ip_block'],
+                         dict(id=block.id, cidr=block.cidr))
+
+    def test_index_counts_statements_computing_the_page(self):
+        factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        factory_models.PrivateIpBlockFactory(cidr="10.0.1.0/29")
+
+        with unit.StubConfig(sql_stats_headers="true"):
+            with db.db_api.statement_stats() as stats:
+                response = self.app.get(self.ip_block_path)
+
+        self.assertEqual(response.headers['X-Melange-SQL-Statements'],
+                         str(stats.statements))
+
+    def test_index_responds_with_error_if_page_data_fails(self):
+        factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+
+        def fail_data(block, **options):
+            raise IOError("connection lost")
+
+        self.mock.stubs.Set(models.IpBlock, "data", fail_data)
+        response = self.app.get(self.ip_block_path, status="*")
+
+        self.assertEqual(response.status_int, 500)
+
     def test_index_is_able_to_filter_by_type(self):
         factory_models.PublicIpBlockFactory(cidr="72.1.1.1/30", network_id="1")
         private_factory = factory_models.PrivateIpBlockFactory
@@ -606,6 +680,17 @@ class TestIpAddressController(ControllerTestBase):
         self.assertEqual(response.status, "200 OK")
         self.assertEqual(response.json, dict(ip_address=_data(ip)))
 
+    def test_show_returns_only_requested_fields(self):
+        block = factory_models.IpBlockFactory(cidr='10.1.1.1/30')
+        ip = _allocate_ip(block)
+
+        response = self.app.get("{0}/{1}".format(self._address_path(block),
+                                                 ip.address),
+                                {'fields': "address"})
+
+        self.assertEqual(response.json['ip_address'],
+                         dict(id=ip.id, address=ip.address))
+
     def test_show_fails_for_nonexistent_address(self):
         block = factory_models.IpBlockFactory(cidr="10.1.1.0/28")
 
@@ -828,6 +913,18 @@ class TestIpRoutesController(ControllerTestBase):
         self.assertEqual(response.status_int, 200)
         self.assertItemsEqual(response.json['ip_route'], _data(ip_route))
 
+    def test_show_returns_only_requested_fields(self):
+        block = factory_models.IpBlockFactory(tenant_id="tenant_id")
+        ip_route = factory_models.IpRouteFactory(source_block_id=block.id)
+
+        path = "/ipam/tenants/tenant_id/ip_blocks/%s/ip_routes/%s"
+        response = self.app.get(path % (block.id, ip_route.id),
+                                {'fields': "destination"})
+
+        self.assertEqual(response.json['ip_route'],
+                         dict(id=ip_route.id,
+                              destination=ip_route.destination))
+
     def test_show_fails_for_non_existent_block_for_given_tenant(self):
         block = factory_models.IpBlockFactory(tenant_id="tenant_id")
         ip_route = factory_models.IpRouteFactory(source_block_id=block.id)
@@ -1031,6 +1128,164 @@ class TestAllocatedIpAddressController(ControllerTestBase):
         self.assertItemsEqual(response.json['ip_addresses'], _data([ip1, ip3]))
 
 
+class TestChangesController(ControllerTestBase):
+
+    def setUp(self):
+        super(TestChangesController, self).setUp()
+        self.config = unit.StubConfig(record_changes="true",
+                                      changes_settle_seconds=0,
+                                      changes_poll_interval=0.01)
+        self.config.__enter__()
+
+    def tearDown(self):
+        self.config.__exit__(None, None, None)
+        super(TestChangesController, self).tearDown()
+
+    def test_index_lists_changes_since_sequence(self):
+        factory_models.IpBlockFactory(tenant_id="tnt1")
+        sequence = models.Change.find_since(0)[-1]['sequence']
+        block = factory_models.IpBlockFactory(tenant_id="tnt1",
+                                              network_id="net1")
+
+        response = self.app.get("/ipam/changes?since=%s" % sequence)
+
+        self.assertEqual(response.status_int, 200)
+        changes = response.json['changes']
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['entity'], "ip_block")
+        self.assertEqual(changes[0]['id'], block.id)
+        self.assertEqual(changes[0]['action'], "save")
+        self.assertEqual(changes[0]['network_id'], "net1")
+        self.assertEqual(response.json['sequence'], sequence + 1)
+
+    def test_index_lists_changes_of_tenant_and_network(self):
+        block = factory_models.IpBlockFactory(tenant_id="tnt1",
+                                              network_id="net1")
+        factory_models.IpBlockFactory(tenant_id="tnt1", network_id="net2")
+        factory_models.IpBlockFactory(tenant_id="tnt2", network_id="net1")
+
+        response = self.app.get("/ipam/tenants/tnt1/changes",
+                                {'since': 0, 'network_id': "net1"})
+
+        self.assertEqual([change['id'] for change in
+                          response.json['changes']], [block.id])
+
+    def test_index_waits_for_changes_before_responding_with_none(self):
+        factory_models.IpBlockFactory()
+        sequence = models.Change.find_since(0)[-1]['sequence']
+
+        response = self.app.get("/ipam/changes",
+                                {'since': sequence, 'wait': 0.05})
+
+        self.assertEqual(response.json, dict(changes=[], sequence=sequence))
+
+    def test_index_without_since_responds_with_current_sequence(self):
+        with unit.StubTime(time=utils.utcnow()
+                           - datetime.timedelta(seconds=120)):
+            factory_models.IpBlockFactory()
+            factory_models.IpBlockFactory()
+        with unit.StubConfig(keep_changes_for_seconds=60):
+            models.Change.delete_expired()
+
+        response = self.app.get("/ipam/changes")
+
+        self.assertEqual(response.json['changes'], [])
+        block = factory_models.IpBlockFactory()
+        response = self.app.get("/ipam/changes",
+                                {'since': response.json['sequence']})
+        self.assertEqual([change['id'] for change in
+                          response.json['changes']], [block.id])
+
+    def test_index_rejects_invalid_params(self):
+        for params in [dict(since="latest"), dict(since=-1),
+                       dict(since=0, limit="all"), dict(since=0, limit=0),
+                       dict(since=0, wait="forever")]:
+            response = self.app.get("/ipam/changes", params, status="*")
+
+            self.assertErrorResponse(response, webob.exc.HTTPBadRequest,
+                                     "has an invalid value")
+
+    def test_index_returns_gone_when_changes_since_were_deleted(self):
+        with unit.StubTime(time=utils.utcnow()
+                           - datetime.timedelta(seconds=120)):
+            factory_models.IpBlockFactory()
+            factory_models.IpBlockFactory()
+        factory_models.IpBlockFactory()
+        with unit.StubConfig(keep_changes_for_seconds=60):
+            models.Change.delete_expired()
+
+        response = self.app.get("/ipam/changes?since=0", status="*")
+
+        self.assertErrorResponse(response, webob.exc.HTTPGone,
+                                 "are no longer kept")
+
+
+class TestExportController(ControllerTestBase):
+
+    def _records(self, response):
+        return [json.loads(line) for line in response.body.splitlines()]
+
+    def test_index_streams_tenant_entities_as_ndjson(self):
+        block = factory_models.IpBlockFactory(cidr="10.0.0.0/24",
+                                              tenant_id="tnt1")
+        other_block = factory_models.IpBlockFactory(cidr="20.0.0.0/24",
+                                                    tenant_id="tnt2")
+        route = factory_models.IpRouteFactory(source_block_id=block.id)
+        factory_models.IpRouteFactory(source_block_id=other_block.id)
+        interface = factory_models.InterfaceFactory(tenant_id="tnt1")
+        other_interface = factory_models.InterfaceFactory(tenant_id="tnt2")
+        models.MacAddress.create(address="10-23-56-78-90-01",
+                                 interface_id=interface.id)
+        ip = _allocate_ip(block, interface=interface)
+        _allocate_ip(other_block, interface=other_interface)
+
+        response = self.app.get("/ipam/tenants/tnt1/export")
+
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        records = self._records(response)
+        self.assertEqual([record.keys()[0] for record in records],
+                         ["ip_block", "ip_route", "interface", "ip_address"])
+        self.assertEqual(records[0]['ip_block']['cidr'], "10.0.0.0/24")
+        self.assertEqual(records[1]['ip_route']['id'], route.id)
+        self.assertEqual(records[1]['ip_route']['source_block_id'], block.id)
+        self.assertEqual(records[2]['interface']['id'],
+                         interface.virtual_interface_id)
+        self.assertEqual(records[2]['interface']['mac_address'],
+                         "10:23:56:78:90:01")
+        self.assertEqual(records[3]['ip_address'],
+                         _data([ip])[0])
+
+    def test_index_exports_all_tenants(self):
+        block1 = factory_models.IpBlockFactory(cidr="10.0.0.0/24",
+                                               tenant_id="tnt1")
+        block2 = factory_models.IpBlockFactory(cidr="20.0.0.0/24",
+                                               tenant_id="tnt2")
+        ip1 = _allocate_ip(block1)
+        ip2 = _allocate_ip(block2)
+        ip2.deallocate()
+
+        response = self.app.get("/ipam/export")
+
+        records = self._records(response)
+        self.assertItemsEqual([record['ip_block']['id'] for record in records
+                               if 'ip_block' in record],
+                              [block1.id, block2.id])
+        self.assertEqual([record['ip_address']['id'] for record in records
+                          if 'ip_address' in record],
+                         [ip1.id])
+
+    def test_index_compresses_when_gzip_is_accepted(self):
+        factory_models.IpBlockFactory(cidr="10.0.0.0/24", tenant_id="tnt1")
+        plain_response = self.app.get("/ipam/tenants/tnt1/export")
+
+        response = self.app.get("/ipam/tenants/tnt1/export",
+                                headers={'Accept-Encoding': "gzip"})
+
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+        self.assertEqual(zlib.decompress(response.body, 16 + zlib.MAX_WBITS),
+                         plain_response.body)
+
+
 class TestInsideGlobalsController(ControllerTestBase):
 
     def _nat_path(self, block, address):
@@ -1473,6 +1728,18 @@ class TestUnusableIpRangesController(ControllerTestBase):
         self.assertEqual(response.status_int, 200)
         self.assertEqual(response.json, dict(ip_range=_data(ip_range)))
 
+    def test_show_returns_only_requested_fields(self):
+        policy = factory_models.PolicyFactory(tenant_id="tnt_id")
+        ip_range = factory_models.IpRangeFactory.create(policy_id=policy.id,
+                                                        offset=1, length=2)
+
+        response = self.app.get("%s/%s/unusable_ip_ranges/%s"
+                                % (self.policy_path, policy.id, ip_range.id),
+                                {'fields': "offset,length"})
+
+        self.assertEqual(response.json['ip_range'],
+                         dict(id=ip_range.id, offset=1, length=2))
+
     def test_show_when_ip_range_does_not_exists(self):
         policy = factory_models.PolicyFactory(tenant_id="tnt_id")
 
@@ -1726,6 +1993,18 @@ class TestUnusableIpOctetsController(ControllerTestBase):
         self.assertEqual(response.status_int, 200)
         self.assertEqual(response.json['ip_octet'], _data(ip_octet))
 
+    def test_show_returns_only_requested_fields(self):
+        policy = factory_models.PolicyFactory(tenant_id="tnt_id")
+        ip_octet = factory_models.IpOctetFactory(policy_id=policy.id,
+                                                 octet=5)
+
+        response = self.app.get("%s/%s/unusable_ip_octets/%s"
+                                % (self.policy_path, policy.id, ip_octet.id),
+                                {'fields': "octet"})
+
+        self.assertEqual(response.json['ip_octet'],
+                         dict(id=ip_octet.id, octet=5))
+
     def test_show_when_ip_octet_does_not_exists(self):
         policy = factory_models.PolicyFactory(tenant_id="tnt_id")
 
@@ -1922,6 +2201,17 @@ class TestPoliciesController(ControllerTestBase):
         self.assertEqual(response.status_int, 200)
         self.assertTrue(models.Policy.get(policy.id) is None)
 
+    def test_delete_async_queues_a_job(self):
+        policy = factory_models.PolicyFactory(tenant_id="123")
+        with unit.StubConfig(job_workers=1):
+            response = self.app.delete("/ipam/tenants/123/policies/%s"
+                                       "?async=true" % policy.id)
+
+        job = models.Job.find_by(action="delete_policy", tenant_id="123")
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(job.parameters(), dict(policy_id=policy.id))
+        self.assertIsNotNone(models.Policy.get(policy.id))
+
     def test_delete_fails_for_incorrect_tenant_id(self):
         policy = factory_models.PolicyFactory(tenant_id="123")
         response = self.app.delete("/ipam/tenants/111/policies/%s" % policy.id,
@@ -1931,6 +2221,33 @@ class TestPoliciesController(ControllerTestBase):
                                  "Policy Not Found")
 
 
+class TestJobsController(ControllerTestBase):
+
+    def test_show(self):
+        job = models.Job.create(action="delete_policy", tenant_id="123")
+
+        response = self.app.get("/ipam/tenants/123/jobs/%s" % job.id)
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.json, dict(job=_data(job)))
+
+    def test_show_without_tenant(self):
+        job = models.Job.create(action="delete_policy", tenant_id="123")
+
+        response = self.app.get("/ipam/jobs/%s" % job.id)
+
+        self.assertEqual(response.json['job']['status'], "queued")
+
+    def test_show_fails_for_job_of_another_tenant(self):
+        job = models.Job.create(action="delete_policy", tenant_id="123")
+
+        response = self.app.get("/ipam/tenants/111/jobs/%s" % job.id,
+                                status="*")
+
+        self.assertErrorResponse(response, webob.exc.HTTPNotFound,
+                                 "Job Not Found")
+
+
 class TestNetworksController(ControllerTestBase):
 
     def test_index_returns_all_ip_blocks_in_network(self):
@@ -2087,6 +2404,21 @@ class TestInterfaceIpAllocationsController(ControllerTestBase):
         self.assertEqual(response.status_int, 200)
         self.assertTrue(ip_address.marked_for_deallocation)
 
+    def test_bulk_delete_async_queues_a_job(self):
+        factory_models.PrivateIpBlockFactory(tenant_id="tnt_id",
+                                             network_id="1")
+        interface = factory_models.InterfaceFactory(vif_id_on_device="123")
+
+        with unit.StubConfig(job_workers=1):
+            response = self.app.delete("/ipam/tenants/tnt_id/networks/1/"
+                                       "interfaces/123/ip_allocations"
+                                       "?async=true")
+
+        job = models.Job.find_by(action="deallocate_ips")
+        self.assertEqual(response.status_int, 202)
+        self.assertEqual(job.parameters(), dict(network_id="1",
+                                                interface_id=interface.id))
+
     def test_bulk_delete_when_network_does_not_exist(self):
         response = self.app.delete("/ipam/tenants/tnt_id/networks/1/"
                                    "interfaces/123/ip_allocations", status="*")
@@ -2368,6 +2700,181 @@ class TestInstanceInterfacesController(ControllerTestBase):
         self.assertTrue(models.IpAddress.get(
                         previous_ip.id).marked_for_deallocation)
 
+    def test_update_all_keeps_interfaces_that_are_unchanged(self):
+        block = factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                                     network_id="net_id")
+        put_data = {'instance': {
+            'tenant_id': "tnt",
+            'interfaces': [{'virtual_interface_id': "vif_1",
+                            'network': {'id': "net_id", 'tenant_id': "RAX"}}],
+        }}
+        self.app.put_json("/ipam/instances/instance_id/interfaces", put_data)
+        iface = models.Interface.find_by(device_id="instance_id")
+        ip = models.IpAddress.find_by(interface_id=iface.id)
+
+        response = self.app.put_json("/ipam/instances/instance_id/interfaces",
+                                     put_data)
+
+        self.assertEqual(models.Interface.find_by(device_id="instance_id"),
+                         iface)
+        self.assertEqual(models.IpAddress.find_all(
+            ip_block_id=block.id).all(), [ip])
+        self.assertFalse(models.IpAddress.get(ip.id).marked_for_deallocation)
+        self.assertEqual(response.json['instance']['interfaces'],
+                         [self._get_iface_data(iface)])
+
+    def test_update_all_reallocates_interfaces_moved_to_another_network(self):
+        old_block = factory_models.PrivateIpBlockFactory(
+            tenant_id="RAX", network_id="old_net", cidr="10.0.0.0/24")
+        new_block = factory_models.PrivateIpBlockFactory(
+            tenant_id="RAX", network_id="new_net", cidr="20.0.0.0/24")
+        iface = factory_models.InterfaceFactory(device_id="instance_id",
+                                                tenant_id="tnt",
+                                                vif_id_on_device="vif_1")
+        old_ip = _allocate_ip(old_block, interface=iface)
+        put_data = {'instance': {
+            'tenant_id': "tnt",
+            'interfaces': [{'virtual_interface_id': "vif_1",
+                            'network': {'id': "new_net", 'tenant_id': "RAX"}}],
+        }}
+
+        self.app.put_json("/ipam/instances/instance_id/interfaces", put_data)
+
+        self.assertEqual(models.Interface.find_by(device_id="instance_id"),
+                         iface)
+        self.assertTrue(models.IpAddress.get(
+            old_ip.id).marked_for_deallocation)
+        self.assertEqual(iface.plugged_in_network_id(), "new_net")
+        self.assertIsNotNone(models.IpAddress.get_by(ip_block_id=new_block.id,
+                                                     interface_id=iface.id))
+
+    def test_update_all_deletes_only_interfaces_no_longer_requested(self):
+        block = factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                                     network_id="net_id")
+        kept_iface = factory_models.InterfaceFactory(device_id="instance_id",
+                                                     tenant_id="tnt",
+                                                     vif_id_on_device="vif_1")
+        kept_ip = _allocate_ip(block, interface=kept_iface)
+        removed_iface = factory_models.InterfaceFactory(
+            device_id="instance_id", tenant_id="tnt", vif_id_on_device="vif_2")
+        _allocate_ip(block, interface=removed_iface)
+        put_data = {'instance': {
+            'tenant_id': "tnt",
+            'interfaces': [{'virtual_interface_id': "vif_1",
+                            'network': {'id': "net_id", 'tenant_id': "RAX"}}],
+        }}
+
+        self.app.put_json("/ipam/instances/instance_id/interfaces", put_data)
+
+        self.assertEqual(models.Interface.find_all(
+            device_id="instance_id").all(), [kept_iface])
+        self.assertFalse(models.IpAddress.get(
+            kept_ip.id).marked_for_deallocation)
+
+    def test_bulk_update_creates_interfaces_of_many_instances(self):
+        block = factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                                     network_id="net_id")
+        put_data = {'instances': [
+            {'device_id': "instance_1",
+             'tenant_id': "tnt",
+             'interfaces': [{'network': {'id': "net_id", 'tenant_id': "RAX"}}],
+             },
+            {'device_id': "instance_2",
+             'tenant_id': "tnt",
+             'interfaces': [{'network': {'id': "net_id", 'tenant_id': "RAX"}}],
+             },
+        ]}
+
+        response = self.app.put_json("/ipam/instances", put_data)
+
+        self.assertEqual(response.status_int, 200)
+        results = response.json['instances']
+        self.assertEqual([result['device_id'] for result in results],
+                         ["instance_1", "instance_2"])
+        for result in results:
+            iface = models.Interface.find_by(device_id=result['device_id'])
+            self.assertEqual(result['interfaces'],
+                             [self._get_iface_data(iface)])
+            self.assertEqual(iface.plugged_in_network_id(), "net_id")
+        self.assertEqual(len(models.IpAddress.find_all(
+            ip_block_id=block.id).all()), 2)
+
+    def test_bulk_update_looks_up_each_network_once(self):
+        factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                             network_id="net_id")
+        self.mock.StubOutWithMock(models.Network, "find_or_create_by")
+        models.Network.find_or_create_by("net_id", "RAX").AndReturn(
+            models.Network.find_by("net_id", tenant_id="RAX"))
+        self.mock.ReplayAll()
+        interfaces = [{'network': {'id': "net_id", 'tenant_id': "RAX"}}]
+        put_data = {'instances': [
+            {'device_id': "instance_1", 'tenant_id': "tnt",
+             'interfaces': interfaces},
+            {'device_id': "instance_2", 'tenant_id': "tnt",
+             'interfaces': interfaces},
+        ]}
+
+        self.app.put_json("/ipam/instances", put_data)
+
+        self.assertEqual(len(models.Interface.find_all().all()), 2)
+
+    def test_bulk_update_reports_failures_per_instance(self):
+        factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                             network_id="net_id")
+        put_data = {'instances': [
+            {'device_id': "instance_1",
+             'tenant_id': "tnt",
+             'interfaces': [{'network': {'id': "net_id", 'tenant_id': "RAX"}}],
+             },
+            {'device_id': "instance_2",
+             'tenant_id': "tnt",
+             'interfaces': [
+                 {'network': {'id': "net_id", 'tenant_id': "RAX"}},
+                 {'network': {'id': "bad_net", 'tenant_id': "RAX"}},
+             ]},
+            {'device_id': "instance_3"},
+        ]}
+
+        response = self.app.put_json("/ipam/instances", put_data)
+
+        self.assertEqual(response.status_int, 200)
+        ok_result, failed_result, invalid_result = response.json['instances']
+        self.assertEqual(len(ok_result['interfaces']), 1)
+        self.assertEqual(failed_result['error']['code'], 404)
+        self.assertEqual(failed_result['error']['message'],
+                         "Network bad_net not found")
+        self.assertEqual(invalid_result['error']['code'], 400)
+        self.assertIsNone(models.Interface.get_by(device_id="instance_2"))
+        self.assertIsNone(models.Interface.get_by(device_id="instance_3"))
+
+    def test_bulk_update_keeps_interfaces_of_failed_instance(self):
+        block = factory_models.PrivateIpBlockFactory(tenant_id="RAX",
+                                                     network_id="net_id")
+        iface = factory_models.InterfaceFactory(device_id="instance_1",
+                                                tenant_id="tnt")
+        ip = _allocate_ip(block, interface=iface)
+        put_data = {'instances': [
+            {'device_id': "instance_1",
+             'tenant_id': "tnt",
+             'interfaces': [{'network': {'id': "bad_net",
+                                         'tenant_id': "RAX"}}],
+             },
+        ]}
+
+        response = self.app.put_json("/ipam/instances", put_data)
+
+        self.assertEqual(response.json['instances'][0]['error']['code'], 404)
+        self.assertEqual(models.Interface.find_all(
+            device_id="instance_1").all(), [iface])
+        self.assertFalse(models.IpAddress.get(
+            ip.id).marked_for_deallocation)
+
+    def test_bulk_update_requires_instances(self):
+        response = self.app.put_json("/ipam/instances", {}, status="*")
+
+        self.assertErrorResponse(response, webob.exc.HTTPBadRequest,
+                                 "instances are missing")
+
     def test_get_all_interfaces(self):
         provider_block = factory_models.IpBlockFactory(tenant_id="RAX",
                                                        network_id="net_id")
@@ -2856,6 +3363,97 @@ class TestInterfaceAllowedIpsController(ControllerTestBase):
                                  "Interface Not Found")
 
 
+class TestListingStatementCounts(ControllerTestBase):
+    """Listing twice the rows must not run more statements per row."""
+
+    def setUp(self):
+        super(TestListingStatementCounts, self).setUp()
+        self.block = factory_models.IpBlockFactory(tenant_id="tnt1",
+                                                   cidr="10.0.0.0/24")
+
+    def _statements(self, app, path):
+        with db.db_api.statement_stats() as stats:
+            app.get(path)
+        return stats.statements
+
+    def assertStatementsPerRow(self, path, add_row, per_row=0, app=None):
+        app = app or self.app
+        for i in range(2):
+            add_row()
+        statements = self._statements(app, path)
+        for i in range(2):
+            add_row()
+        self.assertEqual(self._statements(app, path),
+                         statements + 2 * per_row)
+
+    def test_ip_blocks(self):
+        add_block = lambda: factory_models.IpBlockFactory(tenant_id="tnt1")
+
+        # NOTE: each block's ips_used is counted separately.
+        self.assertStatementsPerRow("/ipam/tenants/tnt1/ip_blocks",
+                                    add_block, per_row=1)
+        self.assertStatementsPerRow("/ipam/tenants/tnt1/ip_blocks"
+                                    "?fields=cidr", add_block)
+
+    def test_ip_addresses_of_block(self):
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/ip_blocks/%s/ip_addresses" % self.block.id,
+            lambda: _allocate_ip(self.block))
+
+    def test_allocated_ip_addresses(self):
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/allocated_ip_addresses",
+            lambda: _allocate_ip(self.block,
+                                 interface=factory_models.InterfaceFactory(
+                                     tenant_id="tnt1")))
+
+    def test_ip_routes(self):
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/ip_blocks/%s/ip_routes" % self.block.id,
+            lambda: factory_models.IpRouteFactory(
+                source_block_id=self.block.id))
+
+    def test_policies_and_their_unusable_ips(self):
+        policy = factory_models.PolicyFactory(tenant_id="tnt1")
+
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/policies",
+            lambda: factory_models.PolicyFactory(tenant_id="tnt1"))
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/policies/%s/unusable_ip_ranges" % policy.id,
+            lambda: factory_models.IpRangeFactory(policy_id=policy.id))
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/policies/%s/unusable_ip_octets" % policy.id,
+            lambda: factory_models.IpOctetFactory(policy_id=policy.id))
+
+    def test_mac_address_ranges(self):
+        self.assertStatementsPerRow("/ipam/mac_address_ranges",
+                                    factory_models.MacAddressRangeFactory)
+
+    def test_allowed_ips(self):
+        interface = factory_models.InterfaceFactory(tenant_id="tnt1",
+                                                    vif_id_on_device="vif1")
+        _allocate_ip(self.block, interface=interface)
+
+        def allow_ip():
+            interface.allow_ip(_allocate_ip(self.block))
+
+        self.assertStatementsPerRow(
+            "/ipam/tenants/tnt1/interfaces/vif1/allowed_ips", allow_ip)
+
+    def test_instance_interfaces(self):
+        def add_interface():
+            interface = factory_models.InterfaceFactory(device_id="device1",
+                                                        tenant_id="tnt1")
+            _allocate_ip(self.block, interface=interface)
+
+        # NOTE: each interface's mac, ips, their block and its routes are
+        # looked up separately.
+        self.assertStatementsPerRow("/ipam/instances/device1/interfaces",
+                                    add_interface, per_row=5,
+                                    app=self.appv1_0)
+
+
 def _allocate_ips(*args):
     interface = factory_models.InterfaceFactory()
     return [models.sort([_allocate_ip(ip_block, interface=interface)
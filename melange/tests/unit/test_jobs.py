@@ -0,0 +1,124 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from melange import tests
+from melange.common import utils
+from melange.ipam import jobs
+from melange.ipam import models
+from melange.tests import unit
+from melange.tests.factories import models as factory_models
+
+
+class TestJobs(tests.BaseTest):
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.worker = jobs.Worker(size=2, poll_interval=1, max_attempts=2)
+
+    def _run_pending(self, worker=None):
+        worker = worker or self.worker
+        worker.run_pending()
+        worker.pool.waitall()
+
+    def test_submit_queues_job(self):
+        job = jobs.submit("delete_policy", tenant_id="123", policy_id="1")
+
+        self.assertEqual(job.status, models.Job.QUEUED)
+        self.assertEqual(job.attempts, 0)
+        self.assertEqual(models.Job.find(job.id).parameters(),
+                         dict(policy_id="1"))
+
+    def test_submit_fails_for_unknown_action(self):
+        self.assertRaises(jobs.UnknownJobActionError,
+                          jobs.submit,
+                          "no_such_action")
+
+    def test_worker_runs_queued_job(self):
+        ip_block = factory_models.IpBlockFactory(cidr="10.0.0.0/28")
+        ip_block.subnet("10.0.0.0/29")
+        job = jobs.submit("delete_ip_block", ip_block_id=ip_block.id)
+
+        self._run_pending()
+
+        job = models.Job.find(job.id)
+        self.assertEqual(job.status, models.Job.COMPLETED)
+        self.assertEqual((job.progress, job.total), (2, 2))
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNone(models.IpBlock.get(ip_block.id))
+
+    def test_worker_records_failure(self):
+        job = jobs.submit("delete_ip_block", ip_block_id="1")
+        self.mock.StubOutWithMock(models.IpBlock, "get")
+        models.IpBlock.get("1").AndRaise(models.ModelNotFoundError("boom"))
+        self.mock.ReplayAll()
+
+        self._run_pending()
+
+        job = models.Job.find(job.id)
+        self.assertEqual(job.status, models.Job.FAILED)
+        self.assertEqual(job.message, "boom")
+
+    def test_running_job_is_not_claimed_by_another_worker(self):
+        job = jobs.submit("delete_policy", policy_id="1")
+        job.claim("other_worker")
+
+        self._run_pending()
+
+        self.assertEqual(models.Job.find(job.id).worker, "other_worker")
+
+    def test_job_with_expired_lease_is_resumed(self):
+        policy = factory_models.PolicyFactory()
+        job = jobs.submit("delete_policy", policy_id=policy.id)
+        with unit.StubTime(time=utils.utcnow() - datetime.timedelta(hours=1)):
+            job.claim("crashed_worker")
+
+        self._run_pending()
+
+        job = models.Job.find(job.id)
+        self.assertEqual(job.status, models.Job.COMPLETED)
+        self.assertEqual(job.worker, self.worker.name)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNone(models.Policy.get(policy.id))
+
+    def test_job_is_given_up_after_max_attempts(self):
+        job = jobs.submit("delete_policy", policy_id="1")
+        for hours_ago in [2, 1]:
+            claimed_at = utils.utcnow() - datetime.timedelta(hours=hours_ago)
+            with unit.StubTime(time=claimed_at):
+                job.claim("crashed_worker")
+
+        self._run_pending()
+
+        job = models.Job.find(job.id)
+        self.assertEqual(job.status, models.Job.FAILED)
+        self.assertEqual(job.message, "Gave up after 2 attempts")
+
+    def test_deallocate_ips(self):
+        ip_block = factory_models.PrivateIpBlockFactory(tenant_id="tnt",
+                                                        network_id="1")
+        interface = factory_models.InterfaceFactory()
+        ip = ip_block.allocate_ip(interface=interface)
+        jobs.submit("deallocate_ips",
+                    tenant_id="tnt",
+                    network_id="1",
+                    interface_id=interface.id)
+
+        self._run_pending()
+
+        self.assertTrue(models.IpAddress.get(ip.id).marked_for_deallocation)
@@ -0,0 +1,230 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import webtest
+
+from melange import tests
+from melange.common import config
+from melange.common import metrics
+from melange.tests import unit
+
+
+class TestMetrics(tests.BaseTest):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.unregister_gauge("test_gauge")
+        super(TestMetrics, self).tearDown()
+
+    def test_increment_counter(self):
+        metrics.increment("test_counter")
+        metrics.increment("test_counter", 2)
+
+        self.assertEqual(metrics.counters()['test_counter'], 3)
+
+    def test_gauge_is_sampled_on_read(self):
+        values = [1]
+        metrics.register_gauge("test_gauge", lambda: values[0])
+        values[0] = 5
+
+        self.assertEqual(metrics.gauges()['test_gauge'], 5)
+
+    def test_dict_gauge_is_flattened(self):
+        metrics.register_gauge("test_gauge", lambda: dict(a=1, b=2))
+
+        gauges = metrics.gauges()
+
+        self.assertEqual(gauges['test_gauge.a'], 1)
+        self.assertEqual(gauges['test_gauge.b'], 2)
+
+    def test_failing_gauge_is_skipped(self):
+        metrics.register_gauge("test_gauge", lambda: 1 / 0)
+
+        self.assertNotIn("test_gauge", metrics.gauges())
+
+    def test_reset_forgets_gauges(self):
+        metrics.register_gauge("test_gauge", lambda: 1)
+
+        metrics.reset()
+
+        self.assertEqual(metrics.gauges(), {})
+
+    def test_observe_counts_values_per_bucket(self):
+        for value in [0.001, 0.02, 0.024, 20]:
+            metrics.observe("test_seconds", value)
+
+        histogram, = metrics.histograms()
+        self.assertEqual(histogram['counts'][:4], [1, 0, 2, 0])
+        self.assertEqual(histogram['counts'][-1], 1)
+        self.assertAlmostEqual(histogram['sum'], 20.045)
+
+    def test_observations_with_different_labels_are_kept_apart(self):
+        metrics.observe("test_seconds", 0.1, action="index", status=200)
+        metrics.observe("test_seconds", 0.1, action="index", status=200)
+        metrics.observe("test_seconds", 0.1, action="show", status=404)
+
+        counts = dict((data['labels']['action'], sum(data['counts']))
+                      for data in metrics.histograms())
+        self.assertEqual(counts, dict(index=2, show=1))
+
+    def test_exposition_in_prometheus_text_format(self):
+        text = metrics.exposition({
+            'counters': {'api.errors.NoMoreAddressesError': 2},
+            'gauges': {'db_pool.checked_out': 3},
+            'histograms': [dict(name="api.request_seconds",
+                                labels=dict(action="index"),
+                                buckets=[0.1, 1.0],
+                                counts=[1, 2, 1],
+                                sum=4.5)],
+            })
+
+        self.assertEqual(text.splitlines(), [
+            '# TYPE melange_api_errors_NoMoreAddressesError_total counter',
+            'melange_api_errors_NoMoreAddressesError_total 2',
+            '# TYPE melange_db_pool_checked_out gauge',
+            'melange_db_pool_checked_out 3',
+            '# TYPE melange_api_request_seconds histogram',
+            'melange_api_request_seconds_bucket{action="index",le="0.1"} 1',
+            'melange_api_request_seconds_bucket{action="index",le="1.0"} 3',
+            'melange_api_request_seconds_bucket{action="index",le="+Inf"} 4',
+            'melange_api_request_seconds_sum{action="index"} 4.5',
+            'melange_api_request_seconds_count{action="index"} 4',
+            ])
+
+
+class TestMetricsAggregation(tests.BaseTest):
+
+    def setUp(self):
+        super(TestMetricsAggregation, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        metrics.reset()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        metrics.unregister_gauge("test_gauge")
+        super(TestMetricsAggregation, self).tearDown()
+
+    def _write_exited_process_snapshot(self, snapshot):
+        pid = self._exited_pid()
+        with open(os.path.join(self.directory, "%d.json" % pid), "w") as f:
+            json.dump(snapshot, f)
+
+    def _exited_pid(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        return pid
+
+    def test_adds_up_snapshots_of_all_processes(self):
+        self._write_exited_process_snapshot({
+            'counters': {'test_counter': 2},
+            'gauges': {'test_gauge': 7},
+            'histograms': [dict(name="test_seconds",
+                                labels={},
+                                buckets=list(metrics.DEFAULT_BUCKETS),
+                                counts=[1] + [0] * 11,
+                                sum=0.001)],
+            })
+        metrics.increment("test_counter")
+        metrics.register_gauge("test_gauge", lambda: 1)
+        metrics.observe("test_seconds", 0.002)
+
+        snapshot = metrics.aggregate(self.directory)
+
+        self.assertEqual(snapshot['counters']['test_counter'], 3)
+        self.assertEqual(snapshot['gauges']['test_gauge'], 1)
+        histogram, = snapshot['histograms']
+        self.assertEqual(histogram['counts'][0], 2)
+        self.assertAlmostEqual(histogram['sum'], 0.003)
+
+    def test_clear_snapshots(self):
+        metrics.write_snapshot(self.directory)
+
+        metrics.clear_snapshots(self.directory)
+
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_collect_aggregates_when_metrics_dir_is_set(self):
+        self._write_exited_process_snapshot(
+            {'counters': {'test_counter': 2}, 'gauges': {}, 'histograms': []})
+        metrics.increment("test_counter")
+
+        with unit.StubConfig(metrics_dir=self.directory):
+            self.assertEqual(metrics.collect()['counters']['test_counter'], 3)
+        self.assertEqual(metrics.collect()['counters']['test_counter'], 1)
+
+
+class TestMetricsController(tests.BaseTest):
+
+    def setUp(self):
+        super(TestMetricsController, self).setUp()
+        conf, melange_app = config.Config.load_paste_app(
+            'melange',
+            {"config_file": tests.test_config_file()}, None)
+        self.test_app = webtest.TestApp(melange_app)
+        metrics.reset()
+
+    def test_index_returns_metrics_snapshot_for_admin(self):
+        metrics.increment("test_counter")
+
+        response = self.test_app.get("/metrics",
+                                     headers={'X_ROLE': "admin"})
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            response.json['metrics']['counters']['test_counter'], 1)
+
+    def test_index_is_forbidden_for_non_admin(self):
+        response = self.test_app.get("/metrics",
+                                     headers={'X_ROLE': "Member",
+                                              'X_TENANT': "tenant"},
+                                     status="*")
+
+        self.assertEqual(response.status_int, 403)
+
+    def test_index_in_text_format(self):
+        metrics.increment("test_counter")
+
+        response = self.test_app.get("/metrics?format=text",
+                                     headers={'X_ROLE': "admin"})
+
+        self.assertEqual(response.content_type, "text/plain")
+        self.assertIn("melange_test_counter_total 1", response.body)
+
+    def test_profile_responds_with_collapsed_stacks(self):
+        response = self.test_app.post("/metrics/profile?seconds=0.01",
+                                      headers={'X_ROLE': "admin"})
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, "text/plain")
+
+    def test_profile_rejects_invalid_params(self):
+        for params in ["seconds=ten", "seconds=0", "interval=0",
+                       "interval=-1", "route=("]:
+            response = self.test_app.post("/metrics/profile?%s" % params,
+                                          headers={'X_ROLE': "admin"},
+                                          status="*")
+
+            self.assertEqual(response.status_int, 400, params)
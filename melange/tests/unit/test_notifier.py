@@ -16,18 +16,22 @@
 #    under the License.
 
 import datetime
+import json
 import logging
 import socket
 
+import eventlet
 import mox
 
 from melange import tests
+from melange.common import exception
 from melange.common import messaging
 from melange.common import notifier
 from melange.common import utils
 from melange import db
 from melange.ipam import models
 from melange.tests import unit
+from melange.tests.factories import models as factory_models
 
 
 class NotifierTestBase():
@@ -131,6 +135,327 @@ class TestQueueNotifier(tests.BaseTest, NotifierTestBase):
             self.notifier.error("test_event", "test_message")
 
 
+class TestQueueNotifierBatches(tests.BaseTest):
+
+    def test_notify_batch_reuses_queues_between_batches(self):
+        mock_queue = self.mock.CreateMockAnything()
+        self.mock.StubOutWithMock(messaging, "Queue")
+        messaging.Queue("melange.notifier.INFO",
+                        "notifier").AndReturn(mock_queue)
+        mock_queue.open().AndReturn(mock_queue)
+        mock_queue.put("msg1")
+        mock_queue.put("msg2")
+        mock_queue.put("msg3")
+        mock_queue.close()
+        self.mock.ReplayAll()
+
+        queue_notifier = notifier.QueueNotifier()
+        queue_notifier.notify_batch([("info", "msg1"), ("info", "msg2")])
+        queue_notifier.notify_batch([("info", "msg3")])
+        queue_notifier.close()
+
+    def test_notify_batch_reconnects_after_failure(self):
+        broken_queue = self.mock.CreateMockAnything()
+        new_queue = self.mock.CreateMockAnything()
+        self.mock.StubOutWithMock(messaging, "Queue")
+        messaging.Queue("melange.notifier.INFO",
+                        "notifier").AndReturn(broken_queue)
+        broken_queue.open().AndReturn(broken_queue)
+        broken_queue.put("msg1").AndRaise(IOError("connection reset"))
+        broken_queue.close()
+        messaging.Queue("melange.notifier.INFO",
+                        "notifier").AndReturn(new_queue)
+        new_queue.open().AndReturn(new_queue)
+        new_queue.put("msg1")
+        self.mock.ReplayAll()
+
+        queue_notifier = notifier.QueueNotifier()
+        self.assertRaises(IOError,
+                          queue_notifier.notify_batch, [("info", "msg1")])
+        queue_notifier.notify_batch([("info", "msg1")])
+
+
+class RecordingNotifier(notifier.Notifier):
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.closed = False
+
+    def notify_batch(self, messages):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("broker unreachable")
+        self.batches.append([msg['payload'] for level, msg in messages])
+
+    def close(self):
+        self.closed = True
+
+
+class TestAsyncNotifier(tests.BaseTest):
+
+    def test_notify_only_buffers_message(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate)
+
+        async_notifier.info("event", "payload")
+
+        self.assertEqual(delegate.batches, [])
+        async_notifier.drain()
+        self.assertEqual(delegate.batches, [["payload"]])
+
+    def test_publisher_thread_publishes_in_batches(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate, batch_size=2,
+                                                flush_interval=0)
+
+        for payload in ["1", "2", "3"]:
+            async_notifier.info("event", payload)
+        eventlet.sleep(0)
+        eventlet.sleep(0)
+
+        self.assertEqual(delegate.batches, [["1", "2"], ["3"]])
+        async_notifier.drain()
+
+    def test_drain_publishes_buffer_and_closes_delegate(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate, batch_size=2)
+
+        for payload in ["1", "2", "3"]:
+            async_notifier.info("event", payload)
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["1", "2"], ["3"]])
+        self.assertTrue(delegate.closed)
+
+    def test_drain_publishes_batch_the_publisher_is_waiting_to_fill(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate, batch_size=10,
+                                                flush_interval=5)
+
+        for payload in ["1", "2", "3"]:
+            async_notifier.info("event", payload)
+        eventlet.sleep(0.1)
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["1", "2", "3"]])
+        self.assertTrue(delegate.closed)
+
+    def test_full_buffer_drops_oldest_message(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate, buffer_size=2,
+                                                overflow="drop_oldest")
+
+        for payload in ["1", "2", "3"]:
+            async_notifier.info("event", payload)
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["2", "3"]])
+        self.assertEqual(async_notifier.dropped, 1)
+
+    def test_full_buffer_drops_newest_message(self):
+        delegate = RecordingNotifier()
+        async_notifier = notifier.AsyncNotifier(delegate, buffer_size=2,
+                                                overflow="drop_newest")
+
+        for payload in ["1", "2", "3"]:
+            async_notifier.info("event", payload)
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["1", "2"]])
+        self.assertEqual(async_notifier.dropped, 1)
+
+    def test_failed_batch_is_retried_once_before_being_dropped(self):
+        delegate = RecordingNotifier(failures=1)
+        async_notifier = notifier.AsyncNotifier(delegate)
+        async_notifier.info("event", "1")
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["1"]])
+
+        delegate.failures = 2
+        async_notifier.info("event", "2")
+        async_notifier.drain()
+
+        self.assertEqual(delegate.batches, [["1"]])
+        self.assertEqual(async_notifier.dropped, 1)
+
+    def test_rejects_unknown_overflow_policy(self):
+        self.assertRaises(exception.InvalidNotifier,
+                          notifier.AsyncNotifier,
+                          RecordingNotifier(),
+                          overflow="explode")
+
+    def test_notifier_is_shared_when_async(self):
+        with unit.StubConfig(notifier="logging", notifier_async="true"):
+            async_notifier = notifier.notifier()
+            self.assertTrue(async_notifier is notifier.notifier())
+
+        self.assertTrue(isinstance(async_notifier.delegate,
+                                   notifier.LoggingNotifier))
+        notifier.drain()
+
+
+class TestOutboxNotifier(tests.BaseTest):
+
+    def setUp(self):
+        super(TestOutboxNotifier, self).setUp()
+        self.published = []
+
+    def _relay(self):
+        db.db_api.relay_outbox_messages(self.published.extend, 100)
+
+    def test_model_change_writes_notification_to_outbox(self):
+        with unit.StubConfig(notifier="outbox"):
+            block = factory_models.IpBlockFactory(cidr="10.0.0.0/29")
+
+        self._relay()
+
+        self.assertEqual(len(self.published), 1)
+        level, message = self.published[0]
+        self.assertEqual(level, "info")
+        self.assertEqual(json.loads(message)['event_type'], "create IpBlock")
+        self.assertEqual(json.loads(message)['payload']['id'], block.id)
+
+    def test_notification_is_rolled_back_with_model_change(self):
+        def create_block_and_fail():
+            with notifier.transaction():
+                factory_models.IpBlockFactory(cidr="10.0.0.0/29")
+                raise IOError("connection lost")
+
+        with unit.StubConfig(notifier="outbox"):
+            self.assertRaises(IOError, create_block_and_fail)
+
+        self._relay()
+
+        self.assertEqual(self.published, [])
+        self.assertEqual(models.IpBlock.count(), 0)
+
+    def test_batched_deletes_are_rolled_back_with_their_notifications(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        ip = block.allocate_ip(factory_models.InterfaceFactory())
+        ip.deallocate()
+        self._relay()
+        del self.published[:]
+
+        def fail_update(**values):
+            raise IOError("connection lost")
+
+        self.mock.stubs.Set(block, "update", fail_update)
+        with unit.StubConfig(notifier="outbox", notifier_batch_events="true"):
+            self.assertRaises(IOError, block.delete_deallocated_ips,
+                              utils.utcnow)
+
+        self._relay()
+        self.assertEqual(self.published, [])
+        self.assertIsNotNone(models.IpAddress.get(ip.id))
+
+    def test_relay_publishes_through_delegate_and_empties_outbox(self):
+        with unit.StubConfig(notifier="outbox"):
+            block1 = factory_models.IpBlockFactory(cidr="10.0.0.0/29")
+            block2 = factory_models.IpBlockFactory(cidr="10.0.1.0/29")
+        delegate = RecordingNotifier()
+
+        relayed = notifier.OutboxRelay(delegate, batch_size=1).relay()
+
+        self.assertEqual(relayed, 2)
+        self.assertEqual([[payload['id'] for payload in batch]
+                          for batch in delegate.batches],
+                         [[block1.id], [block2.id]])
+        self._relay()
+        self.assertEqual(self.published, [])
+
+    def test_relay_keeps_messages_it_could_not_publish(self):
+        with unit.StubConfig(notifier="outbox"):
+            factory_models.IpBlockFactory(cidr="10.0.0.0/29")
+
+        self.assertRaises(IOError,
+                          notifier.OutboxRelay(RecordingNotifier(1)).relay)
+
+        self._relay()
+        self.assertEqual(len(self.published), 1)
+
+
+class TestBatchedNotifications(tests.BaseTest):
+
+    def setUp(self):
+        super(TestBatchedNotifications, self).setUp()
+        self.sent = []
+        sent = self.sent
+
+        class MessageRecorder(notifier.Notifier):
+            def notify(self, level, msg):
+                sent.append((level, msg['event_type'], msg['payload']))
+
+        self.mock.stubs.Set(notifier, "notifier", MessageRecorder)
+
+    def _send_in_batch(self):
+        with notifier.batch():
+            notifier.notifier().info("delete IpAddress", {'id': 1})
+            notifier.notifier().warn("delete IpAddress", {'id': 2})
+            notifier.notifier().info("create IpAddress", {'id': 3})
+            notifier.notifier().info("delete IpAddress", {'id': 4})
+
+    def test_batch_sends_messages_one_by_one_by_default(self):
+        self._send_in_batch()
+
+        self.assertEqual(self.sent,
+                         [("info", "delete IpAddress", {'id': 1}),
+                          ("warn", "delete IpAddress", {'id': 2}),
+                          ("info", "create IpAddress", {'id': 3}),
+                          ("info", "delete IpAddress", {'id': 4})])
+
+    def test_batch_coalesces_messages_by_priority_and_event_type(self):
+        with unit.StubConfig(notifier_batch_events="true"):
+            self._send_in_batch()
+
+        self.assertEqual(self.sent,
+                         [("info", "delete IpAddress batch",
+                           [{'id': 1}, {'id': 4}]),
+                          ("warn", "delete IpAddress batch", [{'id': 2}]),
+                          ("info", "create IpAddress batch", [{'id': 3}])])
+
+    def test_batches_are_limited_to_configured_size(self):
+        with unit.StubConfig(notifier_batch_events="true",
+                             notifier_batch_event_size="2"):
+            with notifier.batch():
+                for i in range(5):
+                    notifier.notifier().info("delete IpAddress", {'id': i})
+
+        self.assertEqual([payload for level, event, payload in self.sent],
+                         [[{'id': 0}, {'id': 1}],
+                          [{'id': 2}, {'id': 3}],
+                          [{'id': 4}]])
+
+    def test_nested_batch_is_sent_with_outer_one(self):
+        with unit.StubConfig(notifier_batch_events="true"):
+            with notifier.batch():
+                with notifier.batch():
+                    notifier.notifier().info("delete IpAddress", {'id': 1})
+                self.assertEqual(self.sent, [])
+                notifier.notifier().info("delete IpAddress", {'id': 2})
+
+        self.assertEqual(self.sent, [("info", "delete IpAddress batch",
+                                      [{'id': 1}, {'id': 2}])])
+
+    def test_deleting_deallocated_ips_sends_one_batch(self):
+        block = factory_models.PrivateIpBlockFactory(cidr="10.0.0.0/29")
+        ips = [block.allocate_ip(factory_models.InterfaceFactory())
+               for i in range(3)]
+        for ip in ips:
+            ip.deallocate()
+        del self.sent[:]
+
+        with unit.StubConfig(notifier_batch_events="true"):
+            models.IpBlock.delete_all_deallocated_ips(utils.utcnow)
+
+        self.assertEqual(len(self.sent), 1)
+        level, event_type, payload = self.sent[0]
+        self.assertEqual(event_type, "delete IpAddress batch")
+        self.assertItemsEqual([row['id'] for row in payload],
+                              [ip.id for ip in ips])
+
+
 class TestModelNotification(tests.BaseTest):
 
     class TestModel(models.ModelBase):
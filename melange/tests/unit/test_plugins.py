@@ -0,0 +1,109 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+from melange import ipv4
+from melange import ipv6
+from melange import mac
+from melange import tests
+from melange.common import plugins
+from melange.ipv4 import db_based_ip_generator
+from melange.ipv6 import rfc2462_generator
+from melange.ipv6 import tenant_based_generator
+from melange.tests.unit import mock_generator
+from melange.tests import unit
+
+
+class StubEntryPoint(object):
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def load(self):
+        return self.obj
+
+
+class TestPlugins(tests.BaseTest):
+
+    def setUp(self):
+        super(TestPlugins, self).setUp()
+        plugins.reset("test_group")
+
+    def test_loads_dotted_module_path(self):
+        self.assertEqual(plugins.load("test_group",
+                                      "melange.ipv4.db_based_ip_generator"),
+                         db_based_ip_generator)
+
+    def test_loads_dotted_class_path(self):
+        self.assertEqual(
+            plugins.load("test_group",
+                         "melange.ipv6.rfc2462_generator."
+                         "RFC2462IpV6Generator"),
+            rfc2462_generator.RFC2462IpV6Generator)
+
+    def test_loads_file_path_once(self):
+        path = mock_generator.__file__.replace(".pyc", ".py")
+
+        plugin = plugins.load("test_group", path)
+        plugins.reset("test_group")
+
+        self.assertTrue(plugins.load("test_group", path) is plugin)
+        self.assertEqual(os.path.abspath(plugin.__file__.replace(".pyc",
+                                                                  ".py")),
+                         os.path.abspath(path))
+
+    def test_loads_entry_point(self):
+        self.mock.StubOutWithMock(plugins.pkg_resources, 'iter_entry_points')
+        plugins.pkg_resources.iter_entry_points("test_group", "rfc").\
+            AndReturn([StubEntryPoint(rfc2462_generator.RFC2462IpV6Generator)])
+        self.mock.ReplayAll()
+
+        self.assertEqual(plugins.load("test_group", "rfc"),
+                         rfc2462_generator.RFC2462IpV6Generator)
+
+    def test_caches_by_group_and_spec(self):
+        self.mock.StubOutWithMock(plugins, '_load')
+        plugins._load("test_group", "x").AndReturn("plugin x")
+        plugins._load("test_group", "y").AndReturn("plugin y")
+        self.mock.ReplayAll()
+
+        self.assertEqual(plugins.load("test_group", "x"), "plugin x")
+        self.assertEqual(plugins.load("test_group", "x"), "plugin x")
+        self.assertEqual(plugins.load("test_group", "y"), "plugin y")
+
+    def test_warm_loads_configured_generators(self):
+        ipv4.reset_plugin()
+        mac.reset_plugin()
+        plugins.reset("melange.ipv6_generators")
+
+        plugins.warm()
+
+        self.assertTrue(("melange.ipv4_generators",
+                         "melange.ipv4.db_based_ip_generator")
+                        in plugins._REGISTRY)
+        self.assertTrue(("melange.mac_generators",
+                         "melange.mac.db_based_mac_generator")
+                        in plugins._REGISTRY)
+
+    def test_ipv6_generator_class_follows_config(self):
+        self.assertEqual(ipv6.generator_class(),
+                         tenant_based_generator.TenantBasedIpV6Generator)
+        with unit.StubConfig(ipv6_generator="melange.ipv6.rfc2462_generator."
+                             "RFC2462IpV6Generator"):
+            self.assertEqual(ipv6.generator_class(),
+                             rfc2462_generator.RFC2462IpV6Generator)
@@ -0,0 +1,77 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import signal
+import sys
+import time
+
+from melange import tests
+from melange.common import profiler
+
+
+def busy_loop(seconds):
+    ends_at = time.time() + seconds
+    while time.time() < ends_at:
+        pass
+
+
+class TestSamplingProfiler(tests.BaseTest):
+
+    def test_samples_running_code(self):
+        sampler = profiler.SamplingProfiler(interval=0.001)
+
+        sampler.start()
+        try:
+            busy_loop(0.2)
+        finally:
+            sampler.stop()
+
+        self.assertIn(":busy_loop ", sampler.collapsed())
+        self.assertEqual(signal.getsignal(signal.SIGPROF), signal.SIG_DFL)
+
+    def test_only_one_profile_runs_at_a_time(self):
+        sampler = profiler.SamplingProfiler()
+        sampler.start()
+        try:
+            self.assertRaises(profiler.ProfilerBusyError,
+                              profiler.SamplingProfiler().start)
+        finally:
+            sampler.stop()
+
+    def test_samples_only_requests_matching_route(self):
+        sampler = profiler.SamplingProfiler(route="/ip_blocks/.*/ip_addresses")
+        sampler.start()
+        try:
+            with profiler.request("/ipam/ip_blocks"):
+                sampler._sample(signal.SIGPROF, sys._getframe())
+            with profiler.request("/ipam/ip_blocks/1/ip_addresses"):
+                sampler._sample(signal.SIGPROF, sys._getframe())
+            sampler._sample(signal.SIGPROF, sys._getframe())
+        finally:
+            sampler.stop()
+
+        self.assertEqual(sum(sampler.samples.values()), 1)
+
+    def test_collapsed_stacks_are_ordered_from_root(self):
+        sampler = profiler.SamplingProfiler()
+
+        sampler._sample(signal.SIGPROF, sys._getframe())
+
+        stack, count = sampler.collapsed().strip().rsplit(" ", 1)
+        self.assertTrue(stack.endswith(
+            ":test_collapsed_stacks_are_ordered_from_root"))
+        self.assertEqual(count, "1")
@@ -0,0 +1,128 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import webob
+import webob.dec
+import webtest
+
+from melange import tests
+from melange.common import config
+from melange.common import recording
+
+
+@webob.dec.wsgify
+def echo_app(request):
+    return webob.Response(body=request.body, status=201)
+
+
+class TestRecordingMiddleware(tests.BaseTest):
+
+    def setUp(self):
+        super(TestRecordingMiddleware, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "traffic-{pid}.ndjson")
+
+    def tearDown(self):
+        recording._HANDLERS.clear()
+        shutil.rmtree(self.directory)
+        super(TestRecordingMiddleware, self).tearDown()
+
+    def _app(self, **kwargs):
+        return webtest.TestApp(recording.RecordingMiddleware(echo_app,
+                                                             self.path,
+                                                             **kwargs))
+
+    def _records(self):
+        path = self.path.format(pid=os.getpid())
+        if not os.path.exists(path):
+            return []
+        with open(path) as record_file:
+            return [json.loads(line) for line in record_file]
+
+    def test_records_request_and_response(self):
+        body = {'interface': {'id': "vif", 'password': "secret"}}
+
+        response = self._app().post("/v1.0/ipam/tenants/tnt/interfaces",
+                                    json.dumps(body),
+                                    content_type="application/json",
+                                    headers={'X_ROLE': "admin"})
+
+        record, = self._records()
+        self.assertEqual(record['method'], "POST")
+        self.assertEqual(record['path'], "/v1.0/ipam/tenants/tnt/interfaces")
+        self.assertEqual(record['tenant'], "tnt")
+        self.assertEqual(record['status'], 201)
+        self.assertEqual(record['headers']['X-Role'], "admin")
+        self.assertEqual(record['body'],
+                         {'interface': {'id': "vif", 'password': "***"}})
+        self.assertTrue(record['duration_ms'] >= 0)
+        self.assertEqual(json.loads(response.body), body)
+
+    def test_records_tenant_from_header(self):
+        self._app().get("/v1.0/ipam/ip_blocks", headers={'X_TENANT': "tnt"})
+
+        self.assertEqual(self._records()[0]['tenant'], "tnt")
+
+    def test_records_only_sampled_requests(self):
+        app = self._app(sample_rate=0)
+
+        app.get("/v1.0/ipam/ip_blocks")
+
+        self.assertEqual(self._records(), [])
+
+    def test_rotates_file(self):
+        app = self._app(max_bytes=100, backup_count=1)
+
+        for i in range(3):
+            app.get("/v1.0/ipam/ip_blocks")
+
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_factory_leaves_app_as_is_when_disabled(self):
+        self.assertIs(recording.factory({})(echo_app), echo_app)
+
+    def test_factory_wraps_app_when_enabled(self):
+        app = recording.factory({}, record_traffic="true",
+                                record_file=self.path,
+                                record_sample_rate="0.5")(echo_app)
+
+        self.assertEqual(app.sample_rate, 0.5)
+        self.assertEqual(app.path, self.path)
+
+    def test_served_api_records_requests_when_enabled(self):
+        config_file = os.path.join(self.directory, "melange.conf")
+        with open(tests.test_config_file()) as sample_file:
+            sample = sample_file.read()
+        with open(config_file, "w") as enabled_file:
+            enabled_file.write(sample.replace(
+                "[DEFAULT]\n",
+                "[DEFAULT]\nrecord_traffic = True\nrecord_file = %s\n"
+                % self.path, 1))
+        self.addCleanup(setattr, config.Config, "instance",
+                        config.Config.instance)
+
+        conf, app = config.Config.load_paste_app(
+            'melange', {'config_file': config_file}, None)
+        webtest.TestApp(app).get("/v0.1/ipam/tenants/tnt/ip_blocks")
+
+        record, = self._records()
+        self.assertEqual(record['path'], "/v0.1/ipam/tenants/tnt/ip_blocks")
+        self.assertEqual(record['status'], 200)
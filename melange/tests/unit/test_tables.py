@@ -0,0 +1,54 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from migrate.versioning import api as versioning_api
+from sqlalchemy import MetaData
+
+from melange import tests
+from melange.db.sqlalchemy import migration
+from melange.db.sqlalchemy import session
+from melange.db.sqlalchemy import tables
+
+
+class TestTables(tests.BaseTest):
+
+    def test_schema_version_is_latest_migration(self):
+        repo_path = migration.get_migrate_repo_path()
+
+        self.assertEqual(tables.SCHEMA_VERSION,
+                         int(versioning_api.version(repo_path)))
+
+    def test_declared_tables_match_migrated_database(self):
+        reflected = MetaData()
+        reflected.reflect(bind=session._ENGINE)
+
+        for table in tables.meta.sorted_tables:
+            self.assertEqual(
+                sorted(reflected.tables[table.name].columns.keys()),
+                sorted(table.columns.keys()))
+
+    def test_migrated_database_has_no_undeclared_tables(self):
+        reflected = MetaData()
+        reflected.reflect(bind=session._ENGINE)
+
+        self.assertEqual(sorted(reflected.tables.keys()),
+                         sorted(tables.meta.tables.keys()
+                                + ["migrate_version"]))
+
+    def test_schema_version_check_reads_migrate_version(self):
+        self.assertEqual(session.check_schema_version(session._ENGINE),
+                         tables.SCHEMA_VERSION)
@@ -15,8 +15,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import uuid
+
 from melange import tests
 from melange.common import utils
+from melange.tests import unit
 
 
 class TestUtils(tests.BaseTest):
@@ -190,3 +194,33 @@ class TestMethodInspector(tests.BaseTest):
         method = utils.MethodInspector(Foo().bar)
 
         self.assertEqual(str(method), "bar baz=<baz> [qux=<qux>]")
+
+
+class TestGenerateUuid(tests.BaseTest):
+
+    def test_generates_random_uuids_by_default(self):
+        generated_uuid = uuid.UUID(utils.generate_uuid())
+
+        self.assertEqual(generated_uuid.version, 4)
+
+    def test_generates_time_ordered_uuids_when_configured(self):
+        with unit.StubConfig(uuid_generator="time_ordered"):
+            generated_uuid = utils.generate_uuid()
+
+        self.assertEqual(len(generated_uuid), 36)
+        self.assertEqual(uuid.UUID(generated_uuid).version, 7)
+
+    def test_time_ordered_uuids_sort_by_creation_time(self):
+        now = datetime.datetime(2012, 1, 1, 10, 30, 0)
+        ids = []
+        for seconds in [0, 0.001, 1, 60]:
+            with unit.StubTime(time=now + datetime.timedelta(seconds=seconds)):
+                ids.append(str(utils.time_ordered_uuid()))
+
+        self.assertEqual(sorted(ids), ids)
+
+    def test_time_ordered_uuids_are_unique_within_a_millisecond(self):
+        with unit.StubTime(time=datetime.datetime(2012, 1, 1)):
+            ids = set(str(utils.time_ordered_uuid()) for i in range(100))
+
+        self.assertEqual(len(ids), 100)
@@ -15,13 +15,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import routes
+import signal
+import time
 import webob
 import webob.exc
 import webtest
 
+from melange.common import exception
+from melange.common import metrics
+from melange.common import pagination
 from melange.common import wsgi
+from melange.ipam import models
 from melange import tests
+from melange.tests import unit
 
 
 class StubApp(object):
@@ -242,6 +250,9 @@ class StubController(wsgi.Controller):
     def index(self, request, format=None):
         return  {'fort': 'knox'}
 
+    def show(self, request, id, format=None):
+        raise exception.NoMoreAddressesError()
+
 
 class TestController(tests.BaseTest):
 
@@ -270,6 +281,95 @@ class TestController(tests.BaseTest):
 
         self.assertEqual(response.status_int, 404)
 
+    def test_records_latency_per_action_and_status(self):
+        metrics.reset()
+        app = webtest.TestApp(DummyApp())
+
+        app.get("/resources")
+        app.get("/resources")
+        app.get("/resources/1", status="*")
+
+        latencies = dict((tuple(sorted(data['labels'].values())),
+                          data['counts'])
+                         for data in metrics.histograms()
+                         if data['name'] == "api.request_seconds")
+        self.assertEqual(sum(latencies[("200", "StubController", "index")]),
+                         2)
+        self.assertEqual(sum(latencies[("400", "StubController", "show")]), 1)
+        self.assertEqual(
+            metrics.counters()['api.errors.NoMoreAddressesError'], 1)
+
+
+class QueryingController(wsgi.Controller):
+
+    def index(self, request, format=None):
+        for i in range(int(request.params.get('queries', 1))):
+            models.IpBlock.count()
+        return {'queried': True}
+
+
+class QueryingApp(wsgi.Router):
+
+    def __init__(self):
+        mapper = routes.Mapper()
+        mapper.resource("resource", "/resources",
+                        controller=QueryingController().create_resource())
+        super(QueryingApp, self).__init__(mapper)
+
+
+class TestQueryStatsMiddleware(tests.BaseTest):
+
+    def setUp(self):
+        super(TestQueryStatsMiddleware, self).setUp()
+        self.app = webtest.TestApp(wsgi.QueryStatsMiddleware(QueryingApp()))
+        metrics.reset()
+
+    def test_counts_statements_per_controller_action(self):
+        self.app.get("/resources?queries=2")
+        self.app.get("/resources?queries=3")
+
+        counters = metrics.counters()
+        self.assertEqual(counters['sql.QueryingController.index.requests'], 2)
+        self.assertEqual(
+            counters['sql.QueryingController.index.statements'], 5)
+        self.assertTrue(counters['sql.QueryingController.index.seconds'] > 0)
+
+    def test_headers_are_opt_in(self):
+        response = self.app.get("/resources?queries=2")
+
+        self.assertNotIn('X-Melange-SQL-Statements', response.headers)
+
+        with unit.StubConfig(sql_stats_headers="true"):
+            response = self.app.get("/resources?queries=2")
+
+        self.assertEqual(response.headers['X-Melange-SQL-Statements'], "2")
+        self.assertIn('X-Melange-SQL-Time', response.headers)
+        self.assertIn('X-Melange-SQL-Rows', response.headers)
+
+    def test_request_over_budget_is_only_counted_by_default(self):
+        with unit.StubConfig(sql_query_budget=2):
+            response = self.app.get("/resources?queries=3")
+
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(
+            metrics.counters()['sql.QueryingController.index.over_budget'], 1)
+
+    def test_request_over_budget_fails_when_configured_to(self):
+        with unit.StubConfig(sql_query_budget=2,
+                             sql_query_budget_action="fail"):
+            within_budget = self.app.get("/resources?queries=2")
+            over_budget = self.app.get("/resources?queries=3", status="*")
+
+        self.assertEqual(within_budget.status_int, 200)
+        self.assertEqual(over_budget.status_int, 500)
+        self.assertIn("QueryingController.index ran 3 statements, over the "
+                      "budget of 2", over_budget.body)
+
+    def test_unrouted_requests_are_counted_together(self):
+        self.app.get("/unknown", status="*")
+
+        self.assertEqual(metrics.counters()['sql.unrouted.requests'], 1)
+
 
 class TestFault(tests.BaseTest):
 
@@ -318,3 +418,134 @@ class TestResult(tests.BaseTest):
     def test_data_returns_xml_specific_input_data(self):
         self.assertEqual(wsgi.Result(self.TestData()).data("application/xml"),
                          {'foos': [{'foo': "bar"}, {'foo2': "bar2"}]})
+
+
+class TestMelangeXMLDictSerializer(tests.BaseTest):
+
+    def test_writes_indented_xml(self):
+        serializer = wsgi.MelangeXMLDictSerializer()
+
+        xml = serializer.serialize({'ip_blocks': [{'cidr': "10.0.0.0/8"},
+                                                  {'note': "<a & \"b\">"}]})
+
+        self.assertEqual(xml,
+                         "<ip_blocks>\n"
+                         "    <ip_block>\n"
+                         "        <cidr>10.0.0.0/8</cidr>\n"
+                         "    </ip_block>\n"
+                         "    <ip_block>\n"
+                         "        <note>&lt;a &amp; &quot;b&quot;&gt;</note>\n"
+                         "    </ip_block>\n"
+                         "</ip_blocks>\n")
+
+    def test_writes_empty_collections_as_empty_elements(self):
+        serializer = wsgi.MelangeXMLDictSerializer()
+
+        xml = serializer.serialize({'ip_blocks': (block for block in [])})
+
+        self.assertEqual(xml, "<ip_blocks/>\n")
+
+    def test_encodes_unicode_as_utf8(self):
+        serializer = wsgi.MelangeXMLDictSerializer()
+
+        self.assertEqual(serializer.serialize({'name': u"caf\xe9"}),
+                         "<name>caf\xc3\xa9</name>\n")
+
+
+class StreamingController(wsgi.Controller):
+
+    def index(self, request):
+        return wsgi.Result(pagination.PaginatedDataView(
+            'ip_blocks',
+            (dict(id=str(id)) for id in range(3)),
+            request.url,
+            next_page_marker="2"))
+
+
+class StreamingApp(wsgi.Router):
+
+    def __init__(self):
+        mapper = routes.Mapper()
+        mapper.resource("ip_block", "/ip_blocks",
+                        controller=StreamingController().create_resource())
+        super(StreamingApp, self).__init__(mapper)
+
+
+class TestStreamingResponses(tests.BaseTest):
+
+    def test_streams_collection_without_content_length(self):
+        request = webob.Request.blank("/ip_blocks")
+
+        response = request.get_response(StreamingApp())
+
+        self.assertIsNone(response.content_length)
+        self.assertTrue('{"id": "0"}' in list(response.app_iter))
+
+    def test_streams_json_collection(self):
+        response = webtest.TestApp(StreamingApp()).get("/ip_blocks")
+
+        self.assertEqual(response.json['ip_blocks'],
+                         [dict(id="0"), dict(id="1"), dict(id="2")])
+        self.assertEqual(response.json['ip_blocks_links'][0]['rel'], "next")
+
+    def test_streams_xml_collection(self):
+        response = webtest.TestApp(StreamingApp()).get(
+            "/ip_blocks", headers={'Accept': "application/xml"})
+
+        self.assertEqual(response.content_type, "application/xml")
+        self.assertEqual([block.find('id').text
+                          for block in response.xml.findall('ip_block')],
+                         ["0", "1", "2"])
+        self.assertEqual(response.xml.find('link').attrib['rel'], "next")
+
+
+class TestMultiProcessServer(tests.BaseTest):
+
+    def setUp(self):
+        super(TestMultiProcessServer, self).setUp()
+        self.server = wsgi.MultiProcessServer(2)
+        self.server.running = True
+        self.mock.StubOutWithMock(wsgi.os, 'fork')
+        self.mock.StubOutWithMock(wsgi.os, 'wait')
+
+    def test_restarts_worker_that_exited(self):
+        self.server.children = {11: time.time() - 10, 12: time.time() - 10}
+        wsgi.os.wait().AndReturn((11, 256))
+        wsgi.os.fork().AndReturn(13)
+        self.mock.ReplayAll()
+
+        self.server._wait_for_worker()
+
+        self.assertEqual(sorted(self.server.children.keys()), [12, 13])
+
+    def test_does_not_restart_workers_after_stop(self):
+        self.server.children = {11: time.time() - 10}
+        self.server.running = False
+        wsgi.os.wait().AndReturn((11, 0))
+        self.mock.ReplayAll()
+
+        self.server._wait_for_worker()
+
+        self.assertEqual(self.server.children, {})
+
+    def test_ignores_interrupted_wait(self):
+        self.server.children = {11: time.time() - 10}
+        wsgi.os.wait().AndRaise(OSError(errno.EINTR, "Interrupted"))
+        self.mock.ReplayAll()
+
+        self.server._wait_for_worker()
+
+        self.assertEqual(self.server.children.keys(), [11])
+
+    def test_stop_terminates_all_workers(self):
+        self.mock.StubOutWithMock(wsgi.os, 'kill')
+        self.server.children = {11: time.time(), 12: time.time()}
+        wsgi.os.kill(11, signal.SIGTERM)
+        wsgi.os.kill(12, signal.SIGTERM)
+        wsgi.os.wait().AndReturn((11, 0))
+        wsgi.os.wait().AndReturn((12, 0))
+        self.mock.ReplayAll()
+
+        self.server._stop_workers()
+
+        self.assertEqual(self.server.children, {})
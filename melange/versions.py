@@ -17,8 +17,8 @@
 
 import os
 import routes
-from xml.dom import minidom
 
+from melange.common import utils
 from melange.common import wsgi
 
 
@@ -47,18 +47,17 @@ class Version(object):
     def url(self):
         return os.path.join(self.base_url, self.name)
 
-    def to_xml(self):
-        doc = minidom.Document()
-        version_elem = doc.createElement("version")
-        version_elem.setAttribute("name", self.name)
-        version_elem.setAttribute("status", self.status)
-        links_elem = doc.createElement("links")
-        link_elem = doc.createElement("link")
-        link_elem.setAttribute("href", self.url())
-        link_elem.setAttribute("rel", "self")
-        links_elem.appendChild(link_elem)
-        version_elem.appendChild(links_elem)
-        return version_elem
+    def to_xml(self, indent=""):
+        link = utils.xml_tag("link", dict(href=self.url(), rel="self"),
+                             empty=True)
+        return "".join(["%s%s\n" % (indent,
+                                     utils.xml_tag("version",
+                                                   dict(name=self.name,
+                                                        status=self.status))),
+                        "%s    <links>\n" % indent,
+                        "%s        %s\n" % (indent, link),
+                        "%s    </links>\n" % indent,
+                        "%s</version>\n" % indent])
 
 
 class VersionsDataView(object):
@@ -96,6 +96,19 @@ setup(name='melange',
                'bin/melange-manage',
                'bin/melange-delete-deallocated-ips',
                ],
+      entry_points={
+          'melange.ipv4_generators': [
+              'db_based = melange.ipv4.db_based_ip_generator',
+          ],
+          'melange.mac_generators': [
+              'db_based = melange.mac.db_based_mac_generator',
+          ],
+          'melange.ipv6_generators': [
+              'tenant_based = melange.ipv6.tenant_based_generator:'
+              'TenantBasedIpV6Generator',
+              'rfc2462 = melange.ipv6.rfc2462_generator:RFC2462IpV6Generator',
+          ],
+      },
       py_modules=[],
       namespace_packages=['melange'],
       )
@@ -0,0 +1,418 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Benchmarks allocation, deallocation and listing under concurrent load.
+
+Builds a dataset of ip blocks spread over networks, half of them with a
+policy of unusable ranges and octets, plus a mac address range and a block
+bulk filled with addresses so queries run against a realistically sized
+ip_addresses table. Then runs every scenario with operations spread over
+concurrent green threads and prints, as json, the throughput, latency
+percentiles, allocation retries and sql statements per operation of each.
+
+The dataset is kept between runs unless --rebuild is given, so generator
+plugins can be compared against the same data:
+
+    tools/benchmark_allocation.py sqlite:////tmp/bench.sqlite \\
+        --addresses 1000000 > db_based.json
+    tools/benchmark_allocation.py sqlite:////tmp/bench.sqlite \\
+        --ipv4-generator my_generator --baseline db_based.json
+
+With --baseline the run fails if a scenario got slower or ran more
+statements per operation than the baseline allows.
+
+"""
+
+import collections
+import contextlib
+import gettext
+import json
+import logging
+import optparse
+import os
+import random
+import sys
+import time
+
+import eventlet
+import netaddr
+import sqlalchemy as sql
+import webob
+
+gettext.install('melange', unicode=1)
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'melange', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from melange import ipv4
+from melange import mac
+from melange.common import config
+from melange.common import metrics
+from melange.common import utils
+from melange.db import db_api
+from melange.db.sqlalchemy import tables
+from melange.ipam import models
+
+
+LOG = logging.getLogger('melange.tools.benchmark_allocation')
+
+TENANT = "benchmark"
+FILLER_TENANT = "benchmark_filler"
+FILLER_CIDR = "100.64.0.0/10"
+MAC_RANGE_CIDR = "BC:76:4E:00:00:00/24"
+BLOCKS_PER_NETWORK = 4
+
+
+class Dataset(object):
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.network_ids = sorted(set(block.network_id for block in blocks))
+        self.allocated_ips = []
+
+
+def build_dataset(conf, options):
+    try:
+        existing = models.IpBlock.find_all(tenant_id=TENANT).all()
+    except sql.exc.DBAPIError:
+        existing = []
+    if existing and not options.rebuild:
+        LOG.info("Reusing dataset of %d blocks" % len(existing))
+        return Dataset(existing)
+
+    reset_db(conf, options.config_file)
+    policies = []
+    for index in range(options.policies):
+        policy = models.Policy.create(name="policy%d" % index,
+                                      tenant_id=TENANT)
+        policy.create_unusable_range(offset=0, length=index % 8 + 1)
+        policy.create_unusable_ip_octet(octet=255)
+        policies.append(policy)
+
+    blocks = []
+    for index in range(options.blocks):
+        policy = policies[index % len(policies)] if policies else None
+        blocks.append(models.IpBlock.create(
+            cidr="10.%d.%d.0/24" % (index >> 8 & 255, index & 255),
+            network_id="network%d" % (index / BLOCKS_PER_NETWORK),
+            tenant_id=TENANT,
+            type=models.IpBlock.PRIVATE_TYPE,
+            policy_id=policy.id if policy and index % 2 else None))
+
+    models.MacAddressRange.create(cidr=MAC_RANGE_CIDR)
+    fill_addresses(conf['sql_connection'], options.addresses)
+    return Dataset(blocks)
+
+
+def reset_db(conf, config_file):
+    # NOTE: migration 002 loads the config file named on the command line
+    # into Config, so it is given only that and conf is restored after.
+    argv = sys.argv
+    sys.argv = [argv[0], "--config-file", config_file]
+    try:
+        with stdout_to_stderr():
+            db_api.db_reset(conf, ipv4.plugin(), mac.plugin())
+    finally:
+        sys.argv = argv
+        config.Config.instance = conf
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """Keeps what setup prints, and logging set up in it, out of the report.
+
+    Loading the config adds a log handler writing to the stdout of the time
+    and migrations print their results.
+
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+def fill_addresses(sql_connection, count, batch_size=10000):
+    """Bulk inserts allocated addresses into a block no scenario uses."""
+    filler = models.IpBlock.create(cidr=FILLER_CIDR,
+                                   network_id="filler",
+                                   tenant_id=FILLER_TENANT,
+                                   type=models.IpBlock.PRIVATE_TYPE)
+    first = netaddr.IPNetwork(FILLER_CIDR).first
+    engine = sql.create_engine(sql_connection)
+    now = utils.utcnow()
+    for offset in range(0, count, batch_size):
+        engine.execute(tables.ip_addresses.insert(),
+                       [dict(id=utils.generate_uuid(),
+                             address=str(netaddr.IPAddress(first + index)),
+                             ip_block_id=filler.id,
+                             used_by_tenant_id=FILLER_TENANT,
+                             created_at=now,
+                             updated_at=now,
+                             marked_for_deallocation=False)
+                        for index in range(offset,
+                                           min(offset + batch_size, count))])
+    engine.dispose()
+
+
+def create_interface():
+    return models.Interface.create(vif_id_on_device=utils.generate_uuid(),
+                                   device_id="benchmark",
+                                   tenant_id=TENANT)
+
+
+def get(app, path):
+    response = webob.Request.blank(path).get_response(app)
+    if response.status_int != 200:
+        raise RuntimeError("GET %s returned %s" % (path, response.status))
+
+
+def allocate_ip(dataset, app, operations):
+    def prepare():
+        return [(random.choice(dataset.blocks), create_interface())
+                for i in range(operations)]
+
+    def operate(block, interface):
+        dataset.allocated_ips.append(block.allocate_ip(interface=interface))
+    return prepare, operate
+
+
+def network_allocate_ips(dataset, app, operations):
+    def prepare():
+        return [(random.choice(dataset.network_ids), create_interface())
+                for i in range(operations)]
+
+    def operate(network_id, interface):
+        network = models.Network.find_by(network_id, tenant_id=TENANT)
+        dataset.allocated_ips.extend(
+            network.allocate_ips(interface=interface))
+    return prepare, operate
+
+
+def allocate_mac(dataset, app, operations):
+    def prepare():
+        return [(create_interface(),) for i in range(operations)]
+
+    def operate(interface):
+        models.MacAddressRange.allocate_next_free_mac(
+            interface_id=interface.id)
+    return prepare, operate
+
+
+def deallocate_ip(dataset, app, operations):
+    def prepare():
+        return [(ip,) for ip in dataset.allocated_ips[:operations]]
+
+    def operate(ip):
+        ip.deallocate()
+    return prepare, operate
+
+
+def reclaim(dataset, app, operations):
+    def prepare():
+        blocks = db_api.find_all_blocks_with_deallocated_ips()
+        return [(block,) for block in dict((block.id, block)
+                                           for block in blocks).values()]
+
+    def operate(block):
+        block.delete_deallocated_ips(deallocated_by_func=utils.utcnow)
+    return prepare, operate
+
+
+def list_ip_blocks(dataset, app, operations):
+    def prepare():
+        return [("/ipam/tenants/%s/ip_blocks?limit=100" % TENANT,)
+                for i in range(operations)]
+
+    def operate(path):
+        get(app, path)
+    return prepare, operate
+
+
+def list_ip_addresses(dataset, app, operations):
+    def prepare():
+        return [("/ipam/tenants/%s/ip_blocks/%s/ip_addresses?limit=100"
+                 % (TENANT, random.choice(dataset.blocks).id),)
+                for i in range(operations)]
+
+    def operate(path):
+        get(app, path)
+    return prepare, operate
+
+
+SCENARIOS = collections.OrderedDict([
+    ('allocate_ip', allocate_ip),
+    ('network_allocate_ips', network_allocate_ips),
+    ('allocate_mac', allocate_mac),
+    ('deallocate_ip', deallocate_ip),
+    ('reclaim', reclaim),
+    ('list_ip_blocks', list_ip_blocks),
+    ('list_ip_addresses', list_ip_addresses),
+    ])
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def run_scenario(scenario, dataset, app, operations, concurrency):
+    prepare, operate = scenario(dataset, app, operations)
+    arguments = prepare()
+    latencies = []
+    totals = dict(errors=0, statements=0)
+    counters_before = metrics.counters()
+
+    def timed(args):
+        with db_api.statement_stats() as stats:
+            started_at = time.time()
+            try:
+                operate(*args)
+            except Exception:
+                LOG.exception("Operation failed")
+                totals['errors'] += 1
+            latencies.append(time.time() - started_at)
+        totals['statements'] += stats.statements
+
+    pool = eventlet.GreenPool(concurrency)
+    started_at = time.time()
+    for args in arguments:
+        pool.spawn_n(timed, args)
+    pool.waitall()
+    seconds = time.time() - started_at
+
+    counters = metrics.counters()
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'operations': count,
+        'errors': totals['errors'],
+        'seconds': seconds,
+        'throughput': count / seconds if seconds else None,
+        'latency_ms': dict((name, value * 1000 if value is not None
+                            else None)
+                           for name, value in [
+                               ('p50', percentile(latencies, 0.5)),
+                               ('p90', percentile(latencies, 0.9)),
+                               ('p99', percentile(latencies, 0.99)),
+                               ('max', percentile(latencies, 1.0))]),
+        'statements_per_operation': (float(totals['statements']) / count
+                                     if count else None),
+        'retries': dict((name, counters.get("ipam.%s" % name, 0) -
+                         counters_before.get("ipam.%s" % name, 0))
+                        for name in ["ip_allocation_retries",
+                                     "mac_allocation_retries"]),
+        }
+
+
+def regressions(results, baseline, tolerance):
+    """Lists scenarios whose p99 or statement count grew past tolerance."""
+    found = []
+    for name, result in results.items():
+        previous = baseline['scenarios'].get(name)
+        if not previous:
+            continue
+        for label, current, before in [
+                ("p99 latency", result['latency_ms']['p99'],
+                 previous['latency_ms']['p99']),
+                ("statements per operation",
+                 result['statements_per_operation'],
+                 previous['statements_per_operation'])]:
+            if current and before and current > before * (1 + tolerance):
+                found.append("%s: %s went from %.2f to %.2f"
+                             % (name, label, before, current))
+    return found
+
+
+def load_conf(options, sql_connection):
+    conf, app = config.Config.load_paste_app(
+        'melangeapp_v1_0', {'config_file': options.config_file}, None)
+    conf['sql_connection'] = sql_connection
+    if options.ipv4_generator:
+        conf['ipv4_generator'] = options.ipv4_generator
+    return conf, app
+
+
+if __name__ == '__main__':
+    oparser = optparse.OptionParser(usage="%prog [options] [SQL_CONNECTION]")
+    oparser.add_option('--config-file',
+                       default=os.path.join(possible_topdir, 'etc',
+                                            'melange',
+                                            'melange.conf.sample'),
+                       help="Melange config file. Default: %default")
+    oparser.add_option('--blocks', type=int, default=1000,
+                       help="Ip blocks to allocate from. Default: %default")
+    oparser.add_option('--policies', type=int, default=100,
+                       help="Policies shared by half of the blocks. "
+                       "Default: %default")
+    oparser.add_option('--addresses', type=int, default=100000,
+                       help="Addresses bulk inserted into a filler block. "
+                       "Default: %default")
+    oparser.add_option('--rebuild', action='store_true', default=False,
+                       help="Rebuild the dataset even if one exists")
+    oparser.add_option('--ipv4-generator',
+                       help="ipv4_generator plugin to benchmark")
+    oparser.add_option('--scenario', action='append',
+                       choices=SCENARIOS.keys(),
+                       help="Scenario to run, may be repeated. Default: all")
+    oparser.add_option('--operations', type=int, default=1000,
+                       help="Operations per scenario. Default: %default")
+    oparser.add_option('--concurrency', type=int, default=10,
+                       help="Green threads per scenario. Default: %default")
+    oparser.add_option('--baseline',
+                       help="Results of an earlier run to compare against")
+    oparser.add_option('--tolerance', type=float, default=0.2,
+                       help="Growth over the baseline counted as a "
+                       "regression. Default: %default")
+    (options, args) = oparser.parse_args()
+    sql_connection = (args[0] if args
+                      else "sqlite:////tmp/melange_benchmark.sqlite")
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARN)
+    with stdout_to_stderr():
+        conf, app = load_conf(options, sql_connection)
+        db_api.configure_db(conf, ipv4.plugin(), mac.plugin())
+    dataset = build_dataset(conf, options)
+
+    results = collections.OrderedDict()
+    for name in options.scenario or SCENARIOS.keys():
+        results[name] = run_scenario(SCENARIOS[name], dataset, app,
+                                     options.operations, options.concurrency)
+
+    report = {
+        'ipv4_generator': conf.get('ipv4_generator',
+                                   "melange.ipv4.db_based_ip_generator"),
+        'dataset': dict(blocks=len(dataset.blocks),
+                        policies=options.policies,
+                        addresses=options.addresses),
+        'operations': options.operations,
+        'concurrency': options.concurrency,
+        'scenarios': results,
+        }
+    print json.dumps(report, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            found = regressions(results, json.load(baseline_file),
+                                options.tolerance)
+        if found:
+            sys.exit("Regressions:\n%s" % "\n".join(found))
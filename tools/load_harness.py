@@ -0,0 +1,290 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Replays api traffic against the whole melange wsgi stack in process.
+
+Loads the melange paste app from the config file, so requests go through
+version routing, middleware, controllers and serialization exactly as in
+the server, but without a network. The default workload is a synthetic
+boot storm: --instances instances booted concurrently the way nova does,
+half through the v0.1 and half through the v1.0 api, then torn down again.
+A workload file replays recorded traffic instead, such as a file written
+by the recording filter; each line is a json request, {"method": ...,
+"path": ..., "body": ...}, and requests sharing a "session" value are
+replayed in order, one session per green thread.
+
+Prints, as json, the latency percentiles and sql statements of every
+route, named by method, api version and controller action, e.g.:
+
+    tools/load_harness.py sqlite:////tmp/load.sqlite --instances 500 \\
+        --concurrency 50
+
+"""
+
+import collections
+import contextlib
+import gettext
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+import uuid
+
+import eventlet
+import webob
+
+gettext.install('melange', unicode=1)
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'melange', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from melange import ipv4
+from melange import mac
+from melange.common import config
+from melange.common import wsgi
+from melange.db import db_api
+
+
+LOG = logging.getLogger('melange.tools.load_harness')
+
+TENANT = "load_harness"
+
+
+class Recorder(object):
+    """Collects latencies and statement counts per route."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.statements = collections.defaultdict(list)
+        self.errors = collections.defaultdict(int)
+
+    def request(self, app, method, path, body=None):
+        request = webob.Request.blank(path, method=method)
+        if body is not None:
+            request.body = json.dumps(body)
+            request.content_type = "application/json"
+        with db_api.statement_stats() as stats:
+            started_at = time.time()
+            response = request.get_response(app)
+            elapsed = time.time() - started_at
+        route = "%s %s %s" % (method,
+                              path.split("/")[1],
+                              wsgi.routed_action(request.environ))
+        self.latencies[route].append(elapsed)
+        self.statements[route].append(stats.statements)
+        if response.status_int >= 400:
+            self.errors[route] += 1
+            LOG.warn("%s %s returned %s" % (method, path, response.status))
+        return response
+
+    def report(self):
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            statements = self.statements[route]
+            routes[route] = {
+                'requests': len(latencies),
+                'errors': self.errors[route],
+                'latency_ms': dict((name, percentile(latencies, fraction)
+                                    * 1000)
+                                   for name, fraction in [('p50', 0.5),
+                                                          ('p90', 0.9),
+                                                          ('p99', 0.99),
+                                                          ('max', 1.0)]),
+                'statements': dict(mean=(float(sum(statements))
+                                         / len(statements)),
+                                   max=max(statements)),
+                }
+        return routes
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def setup_requests(networks):
+    requests = [("POST", "/v1.0/ipam/mac_address_ranges",
+                 {'mac_address_range': {'cidr': "BC:76:4E:00:00:00/24"}})]
+    for index in range(networks):
+        requests.append(
+            ("POST", "/v1.0/ipam/tenants/%s/ip_blocks" % TENANT,
+             {'ip_block': {'cidr': "10.%d.0.0/16" % index,
+                           'network_id': "network%d" % index,
+                           'type': "private"}}))
+    return requests
+
+
+def boot_session(index, networks):
+    """The calls nova makes to boot an instance with one interface."""
+    device_id = str(uuid.uuid4())
+    vif_id = str(uuid.uuid4())
+    network = {'id': "network%d" % (index % networks), 'tenant_id': TENANT}
+    if index % 2:
+        boot = [
+            ("POST", "/v0.1/ipam/interfaces",
+             {'interface': {'id': vif_id,
+                            'tenant_id': TENANT,
+                            'device_id': device_id,
+                            'network': network}}),
+            ("GET", "/v0.1/ipam/tenants/%s/networks/%s/interfaces/%s/"
+             "ip_allocations" % (TENANT, network['id'], vif_id), None),
+            ("GET", "/v0.1/ipam/tenants/%s/interfaces/%s"
+             % (TENANT, vif_id), None),
+            ]
+        teardown = [
+            ("DELETE", "/v0.1/ipam/interfaces/%s" % vif_id, None),
+            ]
+    else:
+        boot = [
+            ("PUT", "/v1.0/ipam/instances/%s/interfaces" % device_id,
+             {'instance': {'tenant_id': TENANT,
+                           'interfaces': [{'virtual_interface_id': vif_id,
+                                           'network': network}]}}),
+            ("GET", "/v1.0/ipam/instances/%s/interfaces" % device_id, None),
+            ]
+        teardown = [
+            ("DELETE", "/v1.0/ipam/instances/%s/interfaces" % device_id,
+             None),
+            ]
+    return boot, teardown
+
+
+def load_workload(path):
+    """Groups the requests in a workload file into sessions."""
+    sessions = collections.OrderedDict()
+    with open(path) as workload_file:
+        for number, line in enumerate(workload_file):
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            session = sessions.setdefault(request.get('session', number), [])
+            session.append((request['method'],
+                            request['path'],
+                            request.get('body')))
+    return sessions.values()
+
+
+def run_sessions(app, recorder, sessions, concurrency):
+    def run_session(requests):
+        for method, path, body in requests:
+            try:
+                recorder.request(app, method, path, body)
+            except Exception:
+                LOG.exception("%s %s failed" % (method, path))
+
+    pool = eventlet.GreenPool(concurrency)
+    started_at = time.time()
+    for requests in sessions:
+        pool.spawn_n(run_session, requests)
+    pool.waitall()
+    elapsed = time.time() - started_at
+    count = sum(len(requests) for requests in sessions)
+    return dict(requests=count,
+                seconds=elapsed,
+                throughput=count / elapsed if elapsed else None)
+
+
+def reset_db(conf, config_file):
+    # NOTE: migration 002 loads the config file named on the command line
+    # into Config, so it is given only that and conf is restored after.
+    argv = sys.argv
+    sys.argv = [argv[0], "--config-file", config_file]
+    try:
+        with stdout_to_stderr():
+            db_api.db_reset(conf, ipv4.plugin(), mac.plugin())
+    finally:
+        sys.argv = argv
+        config.Config.instance = conf
+
+
+@contextlib.contextmanager
+def stdout_to_stderr():
+    """Keeps what setup prints, and logging set up in it, out of the report.
+
+    Loading the config adds a log handler writing to the stdout of the time
+    and migrations print their results.
+
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    oparser = optparse.OptionParser(usage="%prog [options] [SQL_CONNECTION]")
+    oparser.add_option('--config-file',
+                       default=os.path.join(possible_topdir, 'etc',
+                                            'melange',
+                                            'melange.conf.sample'),
+                       help="Melange config file. Default: %default")
+    oparser.add_option('--instances', type=int, default=200,
+                       help="Instances in the boot storm. Default: %default")
+    oparser.add_option('--networks', type=int, default=10,
+                       help="Networks the instances are booted on. "
+                       "Default: %default")
+    oparser.add_option('--concurrency', type=int, default=20,
+                       help="Green threads replaying sessions. "
+                       "Default: %default")
+    oparser.add_option('--workload',
+                       help="File of recorded requests to replay instead "
+                       "of the boot storm")
+    oparser.add_option('--keep-db', action='store_true', default=False,
+                       help="Replay against the existing database instead "
+                       "of recreating it")
+    (options, args) = oparser.parse_args()
+    sql_connection = (args[0] if args
+                      else "sqlite:////tmp/melange_load_harness.sqlite")
+
+    logging.basicConfig(stream=sys.stderr, level=logging.ERROR)
+    with stdout_to_stderr():
+        conf, app = config.Config.load_paste_app(
+            'melange', {'config_file': options.config_file}, None)
+        conf['sql_connection'] = sql_connection
+        db_api.configure_db(conf, ipv4.plugin(), mac.plugin())
+    if not options.keep_db:
+        reset_db(conf, options.config_file)
+
+    recorder = Recorder()
+    phases = collections.OrderedDict()
+    if options.workload:
+        phases['replay'] = run_sessions(app, recorder,
+                                        load_workload(options.workload),
+                                        options.concurrency)
+    else:
+        phases['setup'] = run_sessions(app, recorder,
+                                       [setup_requests(options.networks)], 1)
+        sessions = [boot_session(index, options.networks)
+                    for index in range(options.instances)]
+        phases['boot'] = run_sessions(app, recorder,
+                                      [boot for boot, teardown in sessions],
+                                      options.concurrency)
+        phases['teardown'] = run_sessions(
+            app, recorder, [teardown for boot, teardown in sessions],
+            options.concurrency)
+
+    print json.dumps(dict(concurrency=options.concurrency,
+                          phases=phases,
+                          routes=recorder.report()),
+                     indent=2, sort_keys=True)
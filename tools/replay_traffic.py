@@ -0,0 +1,143 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2011 OpenStack LLC.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Replays traffic recorded by the recording filter against a melange server.
+
+Requests are sent at the times they were recorded, relative to the first
+one, divided by --speed, so --speed 4 replays an hour of traffic in
+fifteen minutes. Prints, as json, the response statuses, how many differ
+from the recorded ones, latency percentiles and how far behind schedule
+requests were sent, e.g.:
+
+    tools/replay_traffic.py traffic-1234.ndjson http://test-melange:9898 \\
+        --speed 2
+
+Replay against a test deployment only; recorded writes are replayed too.
+
+"""
+
+import collections
+import json
+import optparse
+import time
+import urlparse
+
+import eventlet
+from eventlet.green import httplib
+
+
+def load_records(paths):
+    records = []
+    for path in paths:
+        with open(path) as record_file:
+            records.extend(json.loads(line) for line in record_file
+                           if line.strip())
+    return sorted(records, key=lambda record: record['time'])
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[int(round(fraction * (len(sorted_values) - 1)))]
+
+
+def distribution(values):
+    values = sorted(values)
+    return dict((name, percentile(values, fraction))
+                for name, fraction in [('p50', 0.5), ('p90', 0.9),
+                                       ('p99', 0.99), ('max', 1.0)])
+
+
+class Replayer(object):
+
+    def __init__(self, url, timeout):
+        parts = urlparse.urlparse(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.statuses = collections.defaultdict(int)
+        self.mismatched = 0
+        self.latencies = []
+        self.lags = []
+
+    def send(self, record, scheduled_at):
+        started_at = time.time()
+        self.lags.append((started_at - scheduled_at) * 1000)
+        headers = dict(record.get('headers') or {})
+        body = None
+        if record.get('body') is not None:
+            body = json.dumps(record['body'])
+            headers['Content-Type'] = "application/json"
+        connection = httplib.HTTPConnection(self.host, self.port,
+                                            timeout=self.timeout)
+        try:
+            connection.request(record['method'], self.prefix + record['path'],
+                               body, headers)
+            response = connection.getresponse()
+            response.read()
+            self.statuses[str(response.status)] += 1
+            status = response.status
+        except Exception as error:
+            self.statuses[error.__class__.__name__] += 1
+            status = None
+        finally:
+            connection.close()
+        self.latencies.append((time.time() - started_at) * 1000)
+        if status != record.get('status'):
+            self.mismatched += 1
+
+    def replay(self, records, speed, concurrency):
+        pool = eventlet.GreenPool(concurrency)
+        started_at = time.time()
+        first = records[0]['time'] if records else 0
+        for record in records:
+            scheduled_at = started_at + (record['time'] - first) / speed
+            delay = scheduled_at - time.time()
+            if delay > 0:
+                eventlet.sleep(delay)
+            pool.spawn_n(self.send, record, scheduled_at)
+        pool.waitall()
+        elapsed = time.time() - started_at
+        return dict(requests=len(records),
+                    seconds=elapsed,
+                    throughput=len(records) / elapsed if elapsed else None,
+                    statuses=dict(self.statuses),
+                    mismatched_statuses=self.mismatched,
+                    latency_ms=distribution(self.latencies),
+                    lag_ms=distribution(self.lags))
+
+
+if __name__ == '__main__':
+    oparser = optparse.OptionParser(usage="%prog [options] FILE... URL")
+    oparser.add_option('--speed', type=float, default=1.0,
+                       help="Replay rate as a multiple of the recorded "
+                       "rate. Default: %default")
+    oparser.add_option('--concurrency', type=int, default=1000,
+                       help="Most requests in flight at once. "
+                       "Default: %default")
+    oparser.add_option('--timeout', type=float, default=30,
+                       help="Seconds to wait for a response. "
+                       "Default: %default")
+    (options, args) = oparser.parse_args()
+    if len(args) < 2:
+        oparser.error("FILE and URL are required")
+
+    replayer = Replayer(args[-1], options.timeout)
+    report = replayer.replay(load_records(args[:-1]), options.speed,
+                             options.concurrency)
+    print json.dumps(report, indent=2, sort_keys=True)